@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+#Non-interactive import of a campaign of images, described in a manifest file.
+#The .csv files are read and checked in parallel, then all the slices are
+#committed to the database at once: if any file is wrong, nothing is imported.
+#The database is only locked for the writing, once all the files are read.
+#The micrographs (.jpg files with the same names) are then converted to tiles, one at a time.
+#
+#Usage, from the command line:    python batch_import.py manifest.csv
+#or in Python:                    batch_import.import_manifest('manifest.csv')
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+import os, sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import database
+import tiles
+from database import fields_meta, get_meta, logger
+
+#Columns of the manifest. For a circular specimen, img_width is 0 (or empty) and
+#r_outer (and r_inner, if hollow) are given instead of img_height, as in new_image().
+#x_c and y_c (center of a circular specimen) are optional.
+manifest_columns = ['ID_specimen', 'slice', 'file', 'img_width', 'img_height', 'r_outer', 'r_inner', 'x_c', 'y_c']
+
+
+def read_manifest(manifest):
+    """
+    Reads a manifest file and completes the metadata of each image.
+
+    Parameters
+    ----------
+    manifest:   Path of the manifest, .csv or .yaml. A .yaml file contains a list
+                of images, each with the fields of the manifest (see manifest_columns).
+
+    Returns
+    -------
+    df:         Manifest, with the fields of the metadata
+    errors:     List of errors found in the manifest
+
+    """
+    if manifest.endswith('.yaml') or manifest.endswith('.yml'):
+        import yaml
+        with open(manifest, 'r') as file:
+            df = pd.DataFrame(yaml.safe_load(file))
+    else:
+        df = pd.read_csv(manifest, dtype={'ID_specimen': str})
+
+    errors = []
+    for col in ['ID_specimen', 'slice', 'file']:
+        if col not in df.columns:
+            errors.append('Missing column {:s} in manifest'.format(col))
+    if len(errors) > 0:
+        return df, errors
+
+    #Rows without ID or file are rejected. The IDs may be read as numbers (ex. from a .yaml file).
+    for row in df.loc[df.ID_specimen.isnull() | df.file.isnull()].itertuples():
+        errors.append('Line {:d}: ID_specimen or file missing'.format(row.Index + 1))
+    if len(errors) > 0:
+        return df, errors
+    df['ID_specimen'] = df.ID_specimen.astype(str)
+    df['file'] = df.file.astype(str)
+
+    for col in manifest_columns:
+        if col not in df.columns:
+            df[col] = np.nan
+    for col in ['slice', 'img_width', 'img_height', 'r_outer', 'r_inner', 'x_c', 'y_c']:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    df['img_width'] = df.img_width.fillna(0)
+    df['r_inner'] = df.r_inner.fillna(0)
+
+    #Dimensions, as calculated by new_image()
+    circ = df.img_width == 0
+    df['img_area_mm2'] = np.where(circ, np.pi*(df.r_outer**2 - df.r_inner**2)/1e6, df.img_width*df.img_height/1e6)
+    df['img_height'] = np.where(circ, (df.img_area_mm2/np.pi)**0.5*1000, df.img_height)
+    df['filename'] = df.file.apply(os.path.basename)
+
+    for row in df.itertuples():
+        line = 'Line {:d} ({}, slice {}): '.format(row.Index + 1, row.ID_specimen, row.slice)
+        if not (row.slice >= 1 and row.slice == int(row.slice)):
+            errors.append(line + 'slice must be a positive integer')
+        if not row.img_area_mm2 > 0:
+            errors.append(line + 'dimensions missing or invalid')
+        if not os.path.exists(_path(row.file)):
+            errors.append(line + 'file {:s} not found'.format(row.file))
+
+    duplicates = df.loc[df.duplicated(['ID_specimen', 'slice'], keep=False)]
+    for (ID_spec, slice), group in duplicates.groupby(['ID_specimen', 'slice']):
+        errors.append('Slice {} of {} appears {:d} times'.format(slice, ID_spec, len(group)))
+
+    return df, errors
+
+
+def _path(file):
+    #Files are looked for in the data folder, as in new_image(), unless a path is given
+    if os.path.dirname(file) == '':
+        return os.path.join('data', file)
+    return file
+
+
+def _read_file(i, file, ID_spec, slice, x_c, y_c):
+    #Reads one .csv file, in a worker process. Returns the data, or the error message.
+    try:
+        data = pd.concat(database.read_csv_chunks(_path(file), ID_spec, slice, x_c, y_c), ignore_index=True)
+    except (OSError, KeyError, ValueError) as error:
+        return i, None, '{:s}: {}'.format(file, error)
+    return i, data, None
+
+
+def _build_tiles(files):
+    #Converts the micrographs to tiles, if there are any (see tiles.py). Not needed for the import.
+    #Done in this process, one image at a time: each image is decoded whole in memory.
+    for file in files:
+        image_file = _path(file).replace('csv', 'jpg')
+        if os.path.exists(image_file):
+            try:
+                tiles.build_tiles(image_file)
+            except (OSError, ValueError) as error:
+                print('Warning, image {:s} not converted: {}'.format(image_file, error))
+
+
+def import_manifest(manifest, processes = None):
+    """
+    Imports all the images listed in a manifest, without asking anything to the user.
+    The .csv files are read and checked in parallel. If all of them are correct,
+    the data and metadata of all the slices are written in the database at once,
+    replacing any existing data on the same specimens and slices.
+    The log records the same entries as new_image(). The micrographs of the slices
+    imported are then converted to tiles.
+
+    Parameters
+    ----------
+    manifest:   Path of the manifest (see read_manifest)
+    processes:  Number of worker processes. Default: number of processors.
+
+    Returns
+    -------
+    ok:         TRUE if the images were imported
+
+    """
+    df, errors = read_manifest(manifest)
+    if len(errors) > 0:
+        print('Errors in manifest, nothing imported:')
+        print('\n'.join(errors))
+        return False
+    df['slice'] = df.slice.astype(int)
+
+    meta = get_meta()
+    keep = ~meta.set_index(['ID_specimen', 'slice']).index.isin(df.set_index(['ID_specimen', 'slice']).index)
+    new_meta = df.assign(n_divis_x = 0, n_divis_y = 0, divis_area_mm2 = np.nan)
+    new_meta['r_outer'] = np.nan         #Outer radius is fitted by def_pol_coord()
+    meta = pd.concat([meta.loc[keep], new_meta.loc[:, fields_meta]], ignore_index=True)
+
+    #The files are read in parallel, before locking the database: other sessions 
+    #only wait for the end of the writing
+    tasks = [(row.Index, row.file, row.ID_specimen, row.slice, row.x_c, row.y_c) for row in df.itertuples()]
+    parts = {}
+    if processes == 1:
+        results = (_read_file(*task) for task in tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(processes)
+        results = (future.result() for future in as_completed([pool.submit(_read_file, *task) for task in tasks]))
+
+    try:
+        for done, (i, data, error) in enumerate(results):
+            if error is not None:
+                errors.append(error)
+            elif len(errors) == 0:
+                row = df.loc[i]
+                parts[(row.ID_specimen, int(row.slice))] = data
+            print('Read {:d}/{:d} files'.format(done + 1, len(tasks)), end='\r')
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    print()
+
+    if len(errors) > 0:
+        print('Errors in .csv files, nothing imported:')
+        print('\n'.join(errors))
+        return False
+
+    counts = database.import_parsed(meta, parts)
+    logger(['Imported new image: Sample {:s}, slice {:d}: {:s}; Dims=({:.3f}, {:.3f}) mm. Area {:.2f} mm2.'\
+                .format(row.ID_specimen, row.slice, row.filename, row.img_width/1000, row.img_height/1000, row.img_area_mm2)
+            for row in df.itertuples()])
+    print('Imported {:d} images, {:d} features.'.format(len(counts), sum(counts.values())))
+
+    _build_tiles(df.file)
+    return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python batch_import.py manifest.csv [processes]')
+        sys.exit(1)
+
+    ok = import_manifest(sys.argv[1], None if len(sys.argv) < 3 else int(sys.argv[2]))
+    sys.exit(0 if ok else 1)
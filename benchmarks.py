@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+#Performance checks of the program, and regression checks of the sessions working at the same time.
+#Run with: python benchmarks.py
+#Each check prints its result. The script ends with an error if a budget is exceeded or a check fails.
+
+import subprocess
+import sys
+import os
+import glob
+
+#Maximum time to import the analysis module in a new Python interpreter (s)
+import_budget = 3.0
+
+#Modules that must not be loaded by the import of the analysis module
+heavy_modules = ['tensorflow', 'keras', 'matplotlib', 'scipy.stats', 'PIL.Image']
+
+
+def bench_import(module = 'analysis', repeat = 3):
+    """
+    Measures the time to import a module in a new interpreter (cold import),
+    and lists the heavy modules loaded by this import.
+
+    Parameters
+    ----------
+    module: Name of the module to import
+    repeat: Number of measurements. The best one is kept.
+
+    Returns
+    -------
+    time:   Import time (s)
+    loaded: List of heavy modules loaded
+
+    """
+    code = ('import sys, time\n'
+            't = time.perf_counter()\n'
+            'import {:s}\n'
+            'print(time.perf_counter() - t)\n'
+            'print(",".join(m for m in {!r} if m in sys.modules))').format(module, heavy_modules)
+    
+    times = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.split('\n')
+        times.append(float(out[0]))
+        loaded = [m for m in out[1].split(',') if m != '']
+        
+    return min(times), loaded
+
+
+def check_import():
+    #Cold import of the analysis module within budget, without heavy dependencies
+    time, loaded = bench_import()
+    print('Import of analysis: {:.2f} s (budget {:.2f} s). Heavy modules loaded: {:s}'\
+          .format(time, import_budget, ', '.join(loaded) if len(loaded) > 0 else 'none'))
+    return time <= import_budget and len(loaded) == 0
+
+
+
+def bench_sindex(n = 1000000, queries = 200, seed = 0):
+    """
+    Measures the time of rectangle and nearest neighbour queries on the spatial index
+    of a synthetic slice, and of the same rectangles found by scanning all the features.
+
+    Parameters
+    ----------
+    n:          Number of features
+    queries:    Number of queries
+    seed:       Seed of the random generator
+
+    Returns
+    -------
+    t_index:    Time per rectangle query with the index (s)
+    t_scan:     Time per rectangle query by scanning (s)
+    t_nearest:  Time per query of the 10 nearest features (s)
+    same:       TRUE if both ways found the same features
+
+    """
+    import time
+    import numpy as np
+    import spatial
+    
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(0, 20000, n)
+    y = rng.uniform(0, 15000, n)
+    sindex = spatial.GridIndex(x, y)
+    corners = rng.uniform(0, 19000, (queries, 2))
+    
+    same = True
+    t = time.perf_counter()
+    found = [sindex.rect(cx, cx + 1000, cy, cy + 1000) for cx, cy in corners]
+    t_index = (time.perf_counter() - t)/queries
+    t = time.perf_counter()
+    for (cx, cy), rows in zip(corners, found):
+        scan = np.flatnonzero((x > cx) & (x < cx + 1000) & (y > cy) & (y < cy + 1000))
+        same &= np.array_equal(scan, rows)
+    t_scan = (time.perf_counter() - t)/queries
+    t = time.perf_counter()
+    for cx, cy in corners:
+        sindex.nearest(cx, cy, 10)
+    t_nearest = (time.perf_counter() - t)/queries
+    
+    return t_index, t_scan, t_nearest, same
+
+
+def check_sindex():
+    #Rectangle queries on the spatial index right, and much faster than a scan of the slice
+    t_index, t_scan, t_nearest, same = bench_sindex()
+    print('Spatial index, 1e6 features: rectangle {:.2f} ms (scan {:.2f} ms), 10 nearest {:.2f} ms. Same features: {:s}'\
+          .format(t_index*1e3, t_scan*1e3, t_nearest*1e3, str(same)))
+    return same == True and t_index*5 < t_scan
+
+
+
+#Largest error of the binned densities, relative to the peak of the density of gaussian_kde
+density_tolerance = 1e-4
+
+
+def bench_density(n = 20000, n_large = 1000000, seed = 0):
+    """
+    Compares the densities of density.log_density (binned, FFT) with scipy.stats.gaussian_kde
+    on lognormal sizes, for counts and for areas (weighted), and measures their times.
+
+    Parameters
+    ----------
+    n:          Number of sizes of the comparison
+    n_large:    Number of sizes of the measurement of the binned density alone
+    seed:       Seed of the random generator
+
+    Returns
+    -------
+    error:      Largest relative error of the counts and areas densities
+    t_binned:   Time of a binned density of n sizes (s)
+    t_kde:      Time of gaussian_kde on n sizes (s)
+    t_large:    Time of a binned density of n_large sizes (s)
+
+    """
+    import time
+    import numpy as np
+    from scipy.stats import gaussian_kde
+    import density
+    
+    rng = np.random.default_rng(seed)
+    sizes = np.exp(rng.normal(1.5, 0.6, n))
+    areas = sizes**2*rng.uniform(0.3, 1, n)
+    x = np.linspace(0, 100, 1000)[1:]
+    
+    error = 0.
+    for weights in [None, areas]:
+        t = time.perf_counter()
+        ref = gaussian_kde(np.log10(sizes), weights = weights)
+        ref.covariance_factor = lambda: 0.18
+        ref._compute_covariance()
+        y_ref = ref(np.log10(x))
+        t_kde = time.perf_counter() - t
+        t = time.perf_counter()
+        y = density.log_density(sizes, x, 0.18, weights)
+        t_binned = time.perf_counter() - t
+        error = max(error, np.abs(y - y_ref).max()/y_ref.max())
+    
+    sizes = np.exp(rng.normal(1.5, 0.6, n_large))
+    t = time.perf_counter()
+    density.log_density(sizes, x, 0.18)
+    t_large = time.perf_counter() - t
+    
+    return error, t_binned, t_kde, t_large
+
+
+def check_density():
+    #Binned densities as accurate as gaussian_kde, and a million sizes in well under a second
+    error, t_binned, t_kde, t_large = bench_density()
+    print('Density of 2e4 sizes: binned {:.1f} ms, gaussian_kde {:.0f} ms, relative error {:.1e} (tolerance {:.0e}). 1e6 sizes: {:.0f} ms'\
+          .format(t_binned*1e3, t_kde*1e3, error, density_tolerance, t_large*1e3))
+    return error <= density_tolerance and t_large < 1.
+
+
+
+def bench_bootstrap(n = 100000, n_boot = 200, seed = 0):
+    """
+    Measures the bootstrap replicates of a density (bootstrap.log_density_replicates) on
+    lognormal sizes, with and without a pool of processes.
+
+    Parameters
+    ----------
+    n:          Number of sizes
+    n_boot:     Number of replicates
+    seed:       Seed of the random generator
+
+    Returns
+    -------
+    same:       TRUE if the replicates with and without pool are identical
+    t_serial:   Time without pool (s)
+    t_pool:     Time with a pool of all the processors (s)
+
+    """
+    import time
+    import numpy as np
+    import bootstrap
+    
+    sizes = np.exp(np.random.default_rng(seed).normal(1.5, 0.6, n))
+    x = np.linspace(0, 100, 1000)[1:]
+    block_size = bootstrap.block_size
+    bootstrap.block_size = n*n_boot//8      #8 blocks, for the pool
+    
+    t = time.perf_counter()
+    y, Y1 = bootstrap.log_density_replicates(sizes, x, n_boot = n_boot, seed = seed, processes = 1)
+    t_serial = time.perf_counter() - t
+    t = time.perf_counter()
+    y, Y2 = bootstrap.log_density_replicates(sizes, x, n_boot = n_boot, seed = seed)
+    t_pool = time.perf_counter() - t
+    bootstrap.block_size = block_size
+    
+    return np.array_equal(Y1, Y2), t_serial, t_pool
+
+
+def check_bootstrap():
+    #Bootstrap replicates reproducible from the seed, whatever the number of processes
+    same, t_serial, t_pool = bench_bootstrap()
+    print('Bootstrap of 1e5 sizes, 200 replicates: {:.2f} s without pool, {:.2f} s with pool. Reproducible: {}'\
+          .format(t_serial, t_pool, same))
+    return same
+
+
+
+def _fail(*args, **kwargs):
+    #Error raised in the middle of a classification session (see check_lease)
+    raise RuntimeError('Failure after the slice was reserved')
+
+
+def _test_database(folder, n = 20):
+    #Database of a single slice of <n> synthetic features, in <folder> (the current directory)
+    import numpy as np
+    import pandas as pd
+    import database
+    
+    rng = np.random.default_rng(0)
+    csv = pd.DataFrame({col: rng.uniform(1, 100, n) for col in database.csv_columns})
+    csv[' '] = np.arange(1, n + 1)
+    csv.to_csv(os.path.join(folder, 'test.csv'), index=False)
+    meta = pd.DataFrame([{'ID_specimen': 'A', 'slice': 1, 'filename': 'test.csv', 'img_width': 100., 'img_height': 100.,
+                          'img_area_mm2': 0.01, 'x_c': np.nan, 'y_c': np.nan, 'r_outer': np.nan,
+                          'n_divis_x': 0, 'n_divis_y': 0, 'divis_area_mm2': np.nan}])
+    database.import_csv(meta, os.path.join(folder, 'test.csv'), 'A', 1)
+
+
+def check_lease():
+    #An error in ID_incl after the slice is reserved releases the reservation for the other sessions
+    import io
+    import builtins
+    import tempfile
+    import contextlib
+    from concurrent.futures import ProcessPoolExecutor
+    import analysis
+    import database
+    
+    cwd = os.getcwd()
+    patched = (analysis.ask_sample, analysis.ask_slice, analysis.get_slice, builtins.input)
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            analysis.ask_sample = lambda *args, **kwargs: 'A'
+            analysis.ask_slice = lambda *args, **kwargs: 1
+            analysis.get_slice = _fail
+            builtins.input = lambda *args: ''
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    analysis.ID_incl(display = False)
+                raised = False
+            except RuntimeError:
+                raised = True
+            
+            #Another session reserves the slice
+            with ProcessPoolExecutor(1) as pool:
+                holder = pool.submit(database.lease_slice, 'A', 1).result()
+        finally:
+            analysis.ask_sample, analysis.ask_slice, analysis.get_slice, builtins.input = patched
+            os.chdir(cwd)
+    
+    released = raised == True and holder is None and len(database._leases) == 0
+    print('Slice reservation released after an error in ID_incl: {}'.format(released))
+    return released
+
+
+def check_journal(sessions = 4):
+    #The journal of a session that died is replayed exactly once, even by several sessions at the same time
+    import tempfile
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+    import database
+    
+    labels = {1: '2', 2: '4', 5: '2'}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            _test_database(folder)
+            
+            #Journal left by a session that died
+            with open(database.journal_pattern.format('dead-0'), 'w') as file:
+                for incl_nb, incl_type in labels.items():
+                    file.write(json.dumps({'time': '2000-01-01 00:00:00', 'ID_specimen': 'A', 'slice': 1, 'incl_nb': incl_nb,
+                                           'incl_type': incl_type, 'id_source': 'user', 'previous': ''}) + '\n')
+            
+            #Sessions reading the database at the same time, then this session
+            with ProcessPoolExecutor(sessions) as pool:
+                for future in [pool.submit(database.get_data) for i in range(sessions)]:
+                    future.result()
+            meta, data = database.get_data()
+            
+            with open('db_incl.log', 'r') as file:
+                replayed = sum('inclusion ID' in line for line in file)
+            left = glob.glob('db_incl*.journal')
+            merged = data.set_index('incl_nb').incl_type.reindex(list(labels)).to_dict() == labels
+        finally:
+            database.clear_cache()
+            os.chdir(cwd)
+    
+    once = replayed == len(labels) and len(left) == 0 and merged == True
+    print('Orphaned journal of {:d} labels, {:d} sessions: {:d} labels replayed, journal removed: {}, labels merged: {}'\
+          .format(len(labels), sessions + 1, replayed, len(left) == 0, merged))
+    return once
+
+
+def check_restore():
+    #The cached density curves are not served again after the database file is replaced by a backup
+    import shutil
+    import tempfile
+    import numpy as np
+    import pandas as pd
+    import database
+    import stats
+    
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            _test_database(folder)
+            stats.get_dens_many(['A'], xlim = [0, 200])
+            shutil.copy(database.db_file, 'backup.h5')
+            
+            #Edit of the data, then restore of the backup
+            meta = database.get_data()[0]
+            csv = pd.read_csv('test.csv')
+            csv.loc[:, ['Area', 'Feret', 'MinFeret']] = csv.loc[:, ['Area', 'Feret', 'MinFeret']]*2
+            csv.to_csv('test.csv', index=False)
+            database.import_csv(meta, 'test.csv', 'A', 1)
+            stats.get_dens_many(['A'], xlim = [0, 200])
+            shutil.copy('backup.h5', database.db_file)
+            database.clear_cache()
+            stats._dens_cache.clear()
+            
+            cached = stats.get_dens_many(['A'], xlim = [0, 200])[1]
+            fresh = stats.get_dens_many(['A'], xlim = [0, 200], cache = False)[1]
+        finally:
+            database.clear_cache()
+            stats._dens_cache.clear()
+            os.chdir(cwd)
+    
+    same = np.allclose(cached, fresh, equal_nan = True)
+    print('Density curves after a restore of the database match the data: {}'.format(same))
+    return same
+
+
+if __name__ == '__main__':
+    checks = [check_import, check_sindex, check_density, check_bootstrap, check_lease, check_journal, check_restore]
+    failed = [check.__name__ for check in checks if check() == False]
+    if len(failed) > 0:
+        print('Failed: {:s}'.format(', '.join(failed)))
+        sys.exit(1)
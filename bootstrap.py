@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+#Confidence intervals of the statistics of a specimen.
+#The number of features of a specimen is taken as a Poisson count: the intervals of the
+#inclusions per mm2 are exact (Garwood), and the area fraction, a sum of a Poisson number
+#of areas, has a normal interval with variance sum(area^2).
+#The bands of the density curves are found by bootstrap: the features are resampled
+#with replacement, the number of features of each replicate is drawn from a Poisson law,
+#and the curve of each replicate is calculated with the bandwidth of the specimen.
+#The replicates are drawn as matrices of indexes, a block of replicates at a time, and the
+#blocks are spread over a pool of processes. Each block has its own random stream spawned
+#from the seed, so the results only depend on the seed, not on the number of processes.
+#Scipy is imported only by the functions that need it.
+
+#Commonly used libraries
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import density
+
+#Number of resampled features of a block of replicates (bounds the memory used by a block)
+block_size = 4000000
+
+#Data of the specimen resampled by the replicates of a process (see _set_task)
+_task = None
+
+
+def poisson_ci(count, level = 0.95):
+    """
+    Exact (Garwood) confidence interval of the mean of a Poisson law, given an observed count.
+
+    Parameters
+    ----------
+    count:      Observed count, or array of counts
+    level:      Confidence level
+
+    Returns
+    -------
+    low, high : Bounds of the interval (0 for the low bound of a count of 0)
+
+    """
+    from scipy.stats import chi2
+
+    count = np.asarray(count, dtype=float)
+    alpha = 1 - level
+    low = np.where(count > 0, chi2.ppf(alpha/2, 2*count)/2, 0.)
+    high = chi2.ppf(1 - alpha/2, 2*(count + 1))/2
+    return low, high
+
+
+def area_fraction_ci(areas, img_area, level = 0.95):
+    """
+    Confidence interval of an area fraction, sum(areas)/img_area, taking the number of
+    features as a Poisson count (compound Poisson law, normal approximation).
+
+    Parameters
+    ----------
+    areas:      Areas of the features
+    img_area:   Observed area, in the same unit
+    level:      Confidence level
+
+    Returns
+    -------
+    fraction :  Area fraction
+    low, high : Bounds of the interval (the low bound is at least 0)
+
+    """
+    from scipy.stats import norm
+
+    areas = np.asarray(areas, dtype=float)
+    fraction = areas.sum()/img_area
+    half = norm.ppf(0.5 + level/2)*np.sqrt(np.sum(areas**2))/img_area
+    return fraction, max(fraction - half, 0.), fraction + half
+
+
+def _set_task(task):
+    #Data resampled by the replicates (process initializer)
+    global _task
+    _task = task
+
+
+def _replicates(seed, n_rep):
+    #Curves of a block of replicates, from the binned features of _task
+    i, w0, w1, h, step, n_feat = _task
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, n_feat, (n_rep, n_feat))
+
+    #Number of times each feature is drawn by each replicate, then binned weights of the replicates
+    drawn = np.bincount((idx + n_feat*np.arange(n_rep)[:, None]).ravel(), minlength = n_rep*n_feat).reshape(n_rep, n_feat)
+    pos = (i + density.n_grid*np.arange(n_rep)[:, None]).ravel()
+    binned = np.bincount(pos, (drawn*w0).ravel(), minlength = n_rep*density.n_grid)\
+           + np.bincount(pos + 1, (drawn*w1).ravel(), minlength = n_rep*density.n_grid)
+    binned = binned[:n_rep*density.n_grid].reshape(n_rep, density.n_grid)
+    scale = rng.poisson(n_feat, n_rep)/n_feat
+    return density.smooth(binned, h, step)*scale[:, None]
+
+
+def log_density_replicates(sizes, x, cov_fact = 0.18, weights = None, n_boot = 1000, seed = None, processes = None):
+    """
+    Bootstrap replicates of the density of log10 of sizes (see density.log_density),
+    scaled by the number of features, or by their total area if weighted: the curves of
+    stats.get_dens before the division by the observed area.
+
+    Parameters
+    ----------
+    sizes:      Sizes of the features
+    x:          Sizes where the density is evaluated
+    cov_fact:   Covariance factor
+    weights:    Weights of the features (ex. area). Default: same weight.
+    n_boot:     Number of replicates
+    seed:       Seed of the random generator (int). Default: not reproducible.
+    processes:  Number of processes. Default: number of processors. 1: no pool.
+
+    Returns
+    -------
+    y :         Curve of the features, array aligned with x
+    Y :         Array of the curves of the replicates, one row per replicate
+                (NaN if less than 2 different sizes)
+
+    """
+    sizes = np.log10(np.asarray(sizes, dtype=float))
+    weights = np.ones(len(sizes)) if weights is None else np.asarray(weights, dtype=float)
+    with np.errstate(divide='ignore'):
+        points = np.log10(np.asarray(x, dtype=float))
+    with np.errstate(invalid='ignore'):
+        h = density.bandwidth(sizes, cov_fact, weights) if len(sizes) > 1 else np.nan
+    if not (np.isfinite(h) and h > 0):
+        #No bandwidth (see density.kde)
+        return np.full(points.shape, np.nan), np.full((n_boot, len(points)), np.nan)
+    (low, step), i, w0, w1 = density.binning(sizes, h, weights)
+    grid = low + np.arange(density.n_grid)*step
+    y = density.smooth(np.bincount(i, w0, minlength = density.n_grid) + np.bincount(i + 1, w1, minlength = density.n_grid), h, step)
+
+    #Blocks of replicates, each with its own random stream
+    per_block = int(np.clip(block_size//max(len(sizes), 1), 1, n_boot))
+    counts = [min(per_block, n_boot - k) for k in range(0, n_boot, per_block)]
+    seeds = np.random.SeedSequence(seed).spawn(len(counts))
+    task = (i, w0, w1, h, step, len(sizes))
+    if processes == 1 or len(counts) == 1:
+        _set_task(task)
+        blocks = [_replicates(s, n) for s, n in zip(seeds, counts)]
+    else:
+        with ProcessPoolExecutor(processes, initializer = _set_task, initargs = (task,)) as pool:
+            blocks = list(pool.map(_replicates, seeds, counts))
+
+    Y = np.concatenate(blocks)
+    Y = np.array([np.interp(points, grid, row, left = 0., right = 0.) for row in Y])
+    return np.interp(points, grid, y, left = 0., right = 0.), Y
+
+
+def band(Y, level = 0.95):
+    """
+    Pointwise percentile band of bootstrap replicates.
+
+    Parameters
+    ----------
+    Y:          Array of replicates, one row per replicate
+    level:      Confidence level
+
+    Returns
+    -------
+    low, high : Bounds of the band, aligned with the columns of Y
+
+    """
+    return tuple(np.percentile(Y, [50*(1 - level), 50*(1 + level)], axis = 0))
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+#Artificial neural network (ANN) recognizing inclusions on the images of the features.
+#TensorFlow is imported when the model is loaded for the first time.
+#classify_all() evaluates all the unidentified features at once, by batches.
+#UncertaintyQueue orders features by uncertainty of the model, for ID_incl (mode 4).
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+import os
+import heapq
+import threading
+
+#Model used by default, saved in <model_name>.json (architecture) and <model_name>.h5 (weights)
+model_name = 'model_incl_01'
+
+#Size of the images fed to the model (pixels)
+img_size = (180, 180)
+
+#Models loaded in the session, and versions of the model files (see model_version)
+_models = {}
+_versions = {}
+
+
+def load_model(name = model_name):
+    """
+    Loads the model from the disk, once per session.
+
+    Parameters
+    ----------
+    name:   Name of the model files, without extension
+
+    Returns
+    -------
+    model:  Keras model
+
+    """
+    if name not in _models:
+        from tensorflow import keras
+        
+        with open(name + '.json', 'r') as json_file:
+            model_json = json_file.read()
+        
+        model = keras.models.model_from_json(model_json)
+        model.load_weights(name + '.h5')
+        _models[name] = model
+        
+    return _models[name]
+
+
+def to_array(images):
+    """
+    Converts images to the array fed to the model.
+
+    Parameters
+    ----------
+    images: List of PIL images of features
+
+    Returns
+    -------
+    batch:  Array of shape (number of images, 180, 180, channels)
+
+    """
+    return np.stack([np.asarray(img.resize(size=img_size), dtype='float32') for img in images])
+
+
+def predict(images, name = model_name):
+    """
+    Evaluates the probability that features are inclusions.
+
+    Parameters
+    ----------
+    images: List of PIL images of features, or array returned by to_array()
+    name:   Name of the model
+
+    Returns
+    -------
+    p_incl: Array of probabilities, one per image
+
+    """
+    if type(images) != np.ndarray:
+        images = to_array(images)
+    
+    pred = load_model(name).predict(images, verbose=0)
+    return 1 - pred[:, 0]
+
+
+def model_version(name = model_name):
+    """
+    Returns the version of a model: its name and a fingerprint of its files,
+    which changes whenever the model is trained again.
+
+    Parameters
+    ----------
+    name:   Name of the model files, without extension
+
+    Returns
+    -------
+    version: String, ex. 'model_incl_01:3f9a0c2b71d4'
+
+    """
+    import hashlib
+    stamp = tuple((os.stat(name + ext).st_mtime_ns, os.stat(name + ext).st_size) for ext in ['.json', '.h5'])
+    if name not in _versions or _versions[name][0] != stamp:
+        digest = hashlib.sha1()
+        for ext in ['.json', '.h5']:
+            with open(name + ext, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+        _versions[name] = (stamp, '{:s}:{:s}'.format(os.path.basename(name), digest.hexdigest()[:12]))
+    return _versions[name][1]
+
+
+def crop_keys(boxes):
+    """
+    Returns the keys identifying the crops fed to the model in the prediction cache:
+    box in pixels, as rounded by PIL, and size of the image fed to the model.
+    A feature whose geometry changes gets a new key.
+
+    Parameters
+    ----------
+    boxes:  Dataframe with the fields xmin, ymin, xmax, ymax (see geometry.crop_boxes)
+
+    Returns
+    -------
+    keys :  Array of strings, ex. '1204,388,1262,431/180x180'
+
+    """
+    pixels = np.round(boxes.loc[:, ['xmin', 'ymin', 'xmax', 'ymax']].values).astype('int64')
+    return np.array(['{:d},{:d},{:d},{:d}/{:d}x{:d}'.format(*box, *img_size) for box in pixels])
+
+
+def predict_features(ID_spec, slice, features, im, name = model_name, batch_size = 256, verbose = False):
+    """
+    Evaluates the probability that features of a slice are inclusions.
+    The predictions already in the cache of the database (same feature, model version and crop)
+    are reused. The others are evaluated by batches, and added to the cache.
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+    features:   Data of features of the slice
+    im:         Micrograph of the slice (see tiles.open_image)
+    name:       Name of the model
+    batch_size: Number of features evaluated at once
+    verbose:    If TRUE, prints the progress
+
+    Returns
+    -------
+    p_incl:     Array of probabilities, one per feature
+    version:    Version of the model
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import database
+    from geometry import crop_boxes
+
+    version = model_version(name)
+    boxes = crop_boxes(features)
+    keys = pd.DataFrame({'incl_nb': features.incl_nb.values.astype('int32'), 'crop': crop_keys(boxes)})
+
+    cache = database.get_predictions(ID_spec, slice, version)
+    p_incl = keys.merge(cache.loc[:, ['incl_nb', 'crop', 'p_incl']], on = ['incl_nb', 'crop'], how = 'left').p_incl.to_numpy(dtype=float)
+    todo = np.flatnonzero(np.isnan(p_incl))
+    if len(todo) == 0:
+        return p_incl, version
+
+    model = load_model(name)
+    boxes = [tuple(box) for box in boxes.iloc[todo].itertuples(index=False)]
+    batches = [boxes[k:k+batch_size] for k in range(0, len(boxes), batch_size)]
+
+    def crop_batch(batch):
+        return to_array([im.crop(box) for box in batch])
+
+    #The next batch is cropped while the model evaluates the current one
+    results = []
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(crop_batch, batches[0])
+        for k in range(len(batches)):
+            batch = future.result()
+            if k + 1 < len(batches):
+                future = pool.submit(crop_batch, batches[k + 1])
+            results.append(1 - model.predict(batch, verbose=0)[:, 0])
+            if verbose == True:
+                print('{:s}, slice {:d}: {:d}/{:d} features'.format(ID_spec, slice, min((k + 1)*batch_size, len(boxes)), len(boxes)), end='\r')
+    if verbose == True:
+        print()
+
+    p_incl[todo] = np.concatenate(results)
+    database.save_predictions(ID_spec, slice, keys.iloc[todo].assign(model_version = version, p_incl = p_incl[todo]))
+    return p_incl, version
+
+
+def classify_all(samples = None, slices = None, name = model_name, batch_size = 256, rescore = False):
+    """
+    Evaluates with the model the probability that every unidentified feature (incl_type '')
+    is an inclusion, and stores it in the field p_incl of the data, with the version of the
+    model in the field model_version. The features are cropped and evaluated by batches.
+    Features already evaluated by the same version of the model are skipped, and the
+    predictions in the cache of the database are reused (see predict_features).
+    As in ID_incl(), features with a feret diameter of 500 microns or more are not evaluated.
+
+    Parameters
+    ----------
+    samples:    Specimen ID, or list of specimen IDs. Default: all.
+    slices:     Slice number, or list of slice numbers. Default: all.
+    name:       Name of the model
+    batch_size: Number of features evaluated at once
+    rescore:    If TRUE, evaluates again the features already evaluated
+
+    Returns
+    -------
+    n :         Number of features evaluated
+
+    """
+    import database
+    import tiles
+
+    version = model_version(name)
+    meta, df = database.get_data(samples = samples, slices = slices, incl_types = [''],
+                                 columns = ['ID_specimen', 'slice', 'incl_nb', 'x', 'y', 'feret', 'min_feret', 'feret_angle', 
+                                            'p_incl', 'model_version'])
+    df = df.loc[df.feret < 500]
+    if rescore == False:
+        df = df.loc[(df.model_version != version) | df.p_incl.isnull()]
+    if len(df) == 0:
+        print('No feature to evaluate')
+        return 0
+
+    n = 0
+    for (ID_spec, slice), part in df.groupby(['ID_specimen', 'slice']):
+        filename = meta.loc[(meta.ID_specimen == ID_spec) & (meta.slice == slice)].filename.iloc[0].replace('csv', 'jpg')
+        im = tiles.open_image(os.path.join('data', filename))
+        p_incl, version = predict_features(ID_spec, slice, part, im, name, batch_size, verbose = True)
+
+        #Stores the results in the data of the slice
+        meta_all, data = database.get_slice(ID_spec, slice)
+        scores = pd.Series(p_incl.astype('float32'), index = part.incl_nb.values)
+        rows = data.incl_nb.isin(scores.index)
+        data.loc[rows, 'p_incl'] = data.loc[rows, 'incl_nb'].map(scores).values.astype('float32')
+        data.loc[rows, 'model_version'] = version
+        if database.save_slices(meta_all, {(ID_spec, slice): data}) == False:
+            return n
+        n += len(scores)
+
+    database.logger('Features evaluated by model {:s}: {:d}.'.format(version, n))
+    return n
+
+
+class UncertaintyQueue:
+    """
+    Features ordered by uncertainty of the model: the features whose probability of being
+    an inclusion is the closest to 0.5 come first. The features are kept in a heap, so
+    taking the next feature or changing the probability of one does not sort the slice again.
+    Iterating over the queue returns the index of the next feature, until the queue is empty.
+    Features removed or updated stay in the heap, and are skipped when they come out.
+    Features without a probability (NaN) are left out.
+    """
+
+    def __init__(self, index, p_incl):
+        self.p_incl = {i: float(p) for i, p in zip(index, p_incl) if not np.isnan(p)}
+        self.heap = [(abs(p - 0.5), i) for i, p in self.p_incl.items()]
+        heapq.heapify(self.heap)
+        self.lock = threading.Lock()    #The queue is read by the thread of viewer.Prefetcher
+
+    def __len__(self):
+        return len(self.p_incl)
+
+    def __contains__(self, i):
+        return i in self.p_incl
+
+    def __iter__(self):
+        while True:
+            with self.lock:
+                while len(self.heap) > 0:
+                    u, i = heapq.heappop(self.heap)
+                    if i in self.p_incl and abs(self.p_incl[i] - 0.5) == u:
+                        break
+                else:
+                    return
+            yield i
+
+    def get(self, i):
+        """
+        Returns the probability that the feature <i> is an inclusion (NaN if not in the queue).
+        """
+        return self.p_incl.get(i, np.nan)
+
+    def update(self, i, p):
+        """
+        Adds a feature, or changes its probability of being an inclusion.
+        """
+        with self.lock:
+            self.p_incl[i] = float(p)
+            heapq.heappush(self.heap, (abs(float(p) - 0.5), i))
+
+    def remove(self, i):
+        """
+        Takes a feature out of the queue, once it is labelled.
+        """
+        with self.lock:
+            self.p_incl.pop(i, None)
+
+    def confident(self, low, high):
+        """
+        Returns the features whose probability of being an inclusion is at most <low>
+        or at least <high>, as a Series of probabilities.
+        """
+        with self.lock:
+            p = pd.Series(self.p_incl, dtype=float)
+        return p.loc[(p <= low) | (p >= high)]
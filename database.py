@@ -0,0 +1,1717 @@
+# -*- coding: utf-8 -*-
+
+#Database of the program: storage of the metadata and data in db_incl.h5,
+#session cache, log and journal of the classifications, coordination of the
+#sessions using the database at the same time.
+#This module only depends on Pandas and Numpy, so it can be imported quickly.
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+import os
+import datetime
+import json
+import time
+import glob
+import socket
+import contextlib
+
+import locks
+import spatial
+from geometry import polar_coords
+
+#Concurrent sessions are coordinated by this module (see _writing): the locks of the HDF5
+#library, which forbid opening the file while another process has it open, are not used.
+os.environ.setdefault('HDF5_USE_FILE_LOCKING', 'FALSE')
+
+#Headers for meta and data Dataframes
+fields_data = ['ID_specimen', 'slice', 'incl_nb', 'x', 'y', 'area', 
+               'sqr_area', 'feret', 'min_feret', 'feret_angle', 'circ', 
+               'round', 'ar', 'solid', 'incl_type', 'r', 'theta', 'division',
+               'p_incl', 'model_version', 'id_source']
+fields_meta = ['ID_specimen', 'slice', 'filename', 'img_width', 'img_height',
+               'img_area_mm2', 'x_c', 'y_c', 'r_outer', 'n_divis_x', 'n_divis_y', 'divis_area_mm2']
+
+#Numerical types of the fields of data. Shape descriptors are kept in single precision.
+dtypes_data = {'slice': 'int32', 'incl_nb': 'int32', 'x': 'float64', 'y': 'float64', 
+               'area': 'float64', 'sqr_area': 'float64', 'feret': 'float64', 'min_feret': 'float64', 
+               'feret_angle': 'float32', 'circ': 'float32', 'round': 'float32', 'ar': 'float32', 
+               'solid': 'float32', 'r': 'float64', 'theta': 'float64', 'division': 'int32',
+               'p_incl': 'float32'}
+
+#Values of the fields added to data since the first version, for the slices stored before.
+#p_incl: probability that the feature is an inclusion, according to the model <model_version> (see classifier.py)
+#id_source: who gave incl_type, 'user' or 'auto' (labelled from p_incl by ID_incl, mode 4). Empty for former labels.
+defaults_data = {'p_incl': np.nan, 'model_version': '', 'id_source': ''}
+
+#Columns of the .csv files exported by ImageJ, and corresponding fields of data
+csv_columns = {' ': 'incl_nb', 'X': 'x', 'Y': 'y', 'Area': 'area', 'Feret': 'feret', 
+               'MinFeret': 'min_feret', 'FeretAngle': 'feret_angle', 'Circ.': 'circ', 
+               'AR': 'ar', 'Round': 'round', 'Solidity': 'solid'}
+
+#Storage layout of the database.
+#The metadata is stored in the table <meta>. The data of each combination of
+#ID_specimen and slice is stored in its own table under the group <data> (see part_key),
+#so an update only rewrites the slices it touches. Tables are compressed and queryable.
+db_file = 'db_incl.h5'
+hdf_options = {'format': 'table', 'complevel': 5, 'complib': 'blosc'}
+data_columns = ['incl_nb', 'incl_type', 'x', 'y', 'area', 'feret']
+min_itemsize = {'incl_type': 2, 'model_version': 40, 'id_source': 4}
+
+#Tables derived from the data of a slice are stored under their own group, with the
+#same name as the table of the slice (see derived_key). They are removed with the slice,
+#and when the slice is imported again, since the features are renumbered.
+#The spatial index of a slice (sindex, see spatial.py) is rewritten with its data.
+#The exclusion zones of a slice (see zones.py) go with it too: the features they removed
+#come back when the slice is imported again, as well as its area.
+derived_groups = ['divisions', 'predictions', 'sindex', 'zones']
+
+
+#Session cache of the database, shared by all the entry points of the module.
+#The cache is keyed by the modification time and size of the database file,
+#so any change made outside of save_data() (other session, manual copy) is detected.
+#<index> gives the key of the table of each slice in the database. The data is cached
+#slice by slice in <parts>, when a slice is read entirely.
+#<seq> and <versions> are the state of the database when it was read (see _read_seq).
+#<sindex> holds the spatial indexes of the slices read (see get_sindex).
+_cache = {'stamp': None, 'meta': None, 'index': None, 'parts': None, 'data': None, 'seq': None, 'versions': None,
+          'sindex': None}
+
+#Coordination of the sessions using the database at the same time.
+#Writes are serialized by a lock on <lock_file>, held by the operating system (see locks.py),
+#so the lock of a session that died is released. <seq_file> holds a sequence number,
+#incremented at the start and at the end of each write (odd while the database is being
+#written), and the version of each slice: the sequence number of the last write that changed it.
+#Reads never wait for the lock: a read is valid if the sequence number did not change
+#while it went on, otherwise it starts again (seqlock). A slice is only saved if no other
+#session changed it since this session read it (see save_slices).
+lock_file = 'db_incl.lock'
+seq_file = 'db_incl.seq'
+_lock = {'file': None, 'depth': 0, 'seq': None, 'versions': None, 'written': None, 'writing': False}
+
+#Versions of the slices read or written by this session, by key of the table
+_seen = {}
+
+
+class _Changed(Exception):
+    #Raised when another session wrote in the database during a read
+    pass
+
+
+def _read_seq():
+    #Returns the sequence number and the versions of the slices.
+    #While this session holds the lock, returns the state before its write.
+    if _lock['depth'] > 0:
+        return _lock['seq'], _lock['versions']
+    try:
+        with open(seq_file, 'r') as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return 0, {}
+    return state['seq'], state['versions']
+
+
+def _write_seq(seq, versions):
+    #Replaces the sequence file at once, so readers never see it half written
+    with open(seq_file + '.tmp', 'w') as file:
+        json.dump({'seq': seq, 'versions': versions}, file)
+    for attempt in range(100):
+        try:
+            os.replace(seq_file + '.tmp', seq_file)
+            return
+        except PermissionError:
+            #Windows: a reader has the file open
+            time.sleep(0.01)
+    os.replace(seq_file + '.tmp', seq_file)
+
+
+def _writer_died():
+    #TRUE if no session holds the lock, although the sequence number is odd
+    with open(lock_file, 'a+') as file:
+        if locks.try_lock(file) == False:
+            return False
+        locks.unlock(file)
+    return True
+
+
+def _stable_seq(timeout = 0.2):
+    #Waits for the end of the write going on, if any, and returns the sequence number and versions.
+    #Returns None if the write did not end within <timeout> (s).
+    end = time.time() + timeout
+    while True:
+        seq, versions = _read_seq()
+        if seq % 2 == 0 or _writer_died():
+            return seq, versions
+        if time.time() > end:
+            return None
+        time.sleep(0.01)
+
+
+@contextlib.contextmanager
+def _locked(write = False):
+    #Holds the lock of the database, so that no other session writes meanwhile. Can be nested.
+    #If <write>, the sequence number is odd until the end, when the versions of the slices
+    #written (added to _lock['written']) are updated.
+    outer = _lock['depth'] == 0
+    if outer:
+        file = open(lock_file, 'a+')
+        locks.lock(file, 'Waiting for another session writing in the database...')
+        seq, versions = _read_seq()
+        _lock.update({'file': file, 'seq': seq + seq % 2, 'versions': versions, 'written': set(), 'writing': False})
+    _lock['depth'] += 1
+    start = write == True and _lock['writing'] == False
+    if start:
+        _lock['writing'] = True
+        _write_seq(_lock['seq'] + 1, _lock['versions'])
+    try:
+        yield
+    finally:
+        if start:
+            seq = _lock['seq']
+            versions = dict(_lock['versions'])
+            for key in _lock['written']:
+                versions[key] = seq + 2
+                _seen[key] = seq + 2
+            _write_seq(seq + 2, versions)
+            if _cache['seq'] == seq:
+                #The session cache was up to date before the write, and was updated with it
+                _cache['seq'] = seq + 2
+                _cache['versions'] = versions
+            _lock.update({'seq': seq + 2, 'versions': versions, 'written': set(), 'writing': False})
+        _lock['depth'] -= 1
+        if outer:
+            locks.unlock(_lock['file'])
+            _lock['file'].close()
+            _lock.update({'file': None, 'seq': None, 'versions': None, 'written': None})
+
+
+def _writing():
+    #Holds the lock of the database during a write (see _locked)
+    return _locked(write = True)
+
+
+def _consistent(read, fallback = True):
+    #Calls <read>, a function reading the database file, until no session wrote in the database 
+    #during the call. Returns the result and the sequence number of the state read.
+    #After a few attempts, reads while holding the lock, so writers can not delay the read forever,
+    #or raises _Changed if not <fallback>.
+    for attempt in range(2):
+        state = _stable_seq()
+        if state is None:
+            continue
+        seq = state[0]
+        try:
+            result = read()
+        except Exception:
+            #The file may be unreadable in the middle of a write
+            if _read_seq()[0] == seq:
+                raise
+            continue
+        if _read_seq()[0] == seq:
+            return result, seq
+    
+    if fallback == False:
+        raise _Changed()
+    with _locked():
+        return read(), _read_seq()[0]
+
+
+def _retry(function, *args):
+    #Calls <function>, which reads the database through the session cache, again if another
+    #session wrote in the database meanwhile, while holding the lock.
+    try:
+        return function(*args)
+    except _Changed:
+        clear_cache()
+    with _locked():
+        return function(*args)
+
+
+def _written(keys):
+    #Records the slices written, to update their versions at the end of the write
+    if _lock['depth'] > 0:
+        _lock['written'].update(keys)
+
+
+def _conflicts(indexes, replace_all = False):
+    #Returns the keys of the slices in <indexes> changed by another session since this session read them.
+    #If <replace_all>, also the slices stored by another session that this session never read.
+    seq, versions = _read_seq()
+    keys = ['/' + part_key(*index) for index in indexes]
+    if replace_all == True:
+        keys = sorted(set(keys) | set(versions))
+        return [key for key in keys if versions.get(key, 0) != _seen.get(key, 0)]
+    return [key for key in keys if key in _seen and versions.get(key, 0) != _seen[key]]
+
+
+def _db_stamp():
+    #Returns a fingerprint of the database file, or None if it does not exist
+    try:
+        st = os.stat(db_file)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def clear_cache():
+    """
+    Empties the session cache. The next call to get_data() rereads the database.
+    """
+    _cache['stamp'] = None
+    _cache['meta'] = None
+    _cache['index'] = None
+    _cache['parts'] = None
+    _cache['data'] = None
+    _cache['seq'] = None
+    _cache['versions'] = None
+    _cache['sindex'] = None
+
+
+def data_stamp():
+    """
+    Returns a string identifying the state of the database: the sequence number of the
+    writes (see _locked), which changes with every write of any session, and the modification
+    time and size of the database file, which change if the file is replaced (ex. backup restored).
+    The labels left by classification sessions that died are merged first, so the state
+    identified includes them. Used to key the results computed from the data (see stats.get_dens_many).
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    stamp : String, ex. '1280-1718203344123456789-52428800'. None if the database does not
+            exist, or if another session is writing it.
+
+    """
+    _merge_orphans()
+    seq = _read_seq()[0]
+    stamp = _db_stamp()
+    if stamp is None or (seq % 2 == 1 and not _writer_died()):
+        return None
+    return '{:d}-{:d}-{:d}'.format(seq, *stamp)
+
+
+def part_key(ID_spec, slice):
+    """
+    Returns the key of the table containing the data of one slice in the database.
+    Characters of the specimen ID that are not valid in a HDF5 node name are escaped.
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+
+    Returns
+    -------
+    key:        Key of the table, ex. 'data/p_809BH_s1'
+
+    """
+    name = ''.join(c if c.isascii() and c.isalnum() else '_{:06x}'.format(ord(c)) for c in ID_spec)
+    return 'data/p_{:s}_s{:d}'.format(name, int(slice))
+
+
+def derived_key(group, ID_spec, slice):
+    #Key of the table derived from the data of a slice in <group>, ex. 'divisions/p_809BH_s1'
+    return part_key(ID_spec, slice).replace('data/', group + '/', 1)
+
+
+def _drop_derived(store, ID_spec, slice):
+    #Removes the tables derived from the data of a slice
+    for group in derived_groups:
+        key = derived_key(group, ID_spec, slice)
+        if key in store:
+            store.remove(key)
+
+
+def _put_sindex(store, ID_spec, slice, df):
+    #Writes the spatial index of the data of a slice, as stored in the database
+    key = derived_key('sindex', ID_spec, slice)
+    if key in store:
+        store.remove(key)
+    store.put(key, spatial.GridIndex.from_data(df).table(), **hdf_options)
+
+
+def _format_meta(meta):
+    #Makes sure the metadata is in the right format
+    meta = meta.loc[:, fields_meta].copy()
+    meta['slice'] = meta.slice.astype(int)
+    meta['n_divis_x'] = meta.n_divis_x.astype(int)
+    meta['n_divis_y'] = meta.n_divis_y.astype(int)
+    for col in ['img_width', 'img_height', 'img_area_mm2', 'x_c', 'y_c', 'r_outer', 'divis_area_mm2']:
+        meta[col] = meta[col].astype(float)
+    
+    return meta.sort_values(['ID_specimen', 'slice']).reset_index(drop=True)
+
+
+def _format_data(data):
+    #Makes sure the data is in the right format
+    data = data.copy()
+    for col, value in defaults_data.items():
+        if col not in data.columns:
+            data[col] = value
+    data['model_version'] = data.model_version.fillna('')
+    data['id_source'] = data.id_source.fillna('')
+    data = data.loc[:, fields_data]
+    
+    data = data.astype(dtypes_data)
+    
+    #Removes any duplicates, keeping those with nonzero division if both zero and nonzero exist
+    data = data.sort_values('division', ascending=False)
+    data = data.drop_duplicates(subset = ['ID_specimen', 'slice', 'incl_nb'])
+    
+    return data.sort_values(['ID_specimen', 'slice', 'incl_nb']).reset_index(drop=True)
+
+
+def _read_store(path):
+    #Reads the metadata and lists the tables of the slices in the database
+    with pd.HDFStore(path, 'r') as store:
+        keys = store.keys()
+        if '/data' in keys:
+            #Former layout, with all the data in a single table
+            return None, None, []
+        
+        if '/meta' in keys:
+            meta = store.select('meta')
+        else:
+            #Empty tables are not stored
+            meta = pd.DataFrame(columns = fields_meta)
+        
+        index = {}
+        outdated = []
+        for key in keys:
+            if key.startswith('/data/'):
+                df = store.select(key, start=0, stop=1)
+                index[(df.ID_specimen.iloc[0], int(df.slice.iloc[0]))] = key
+                if len(set(fields_data) - set(df.columns)) > 0:
+                    outdated.append(key)
+            
+    return meta, index, outdated
+
+
+def _upgrade_parts(keys):
+    #Adds the fields missing in the tables of slices stored by a former version
+    with pd.HDFStore(db_file, 'a') as store:
+        for key in keys:
+            df = _format_data(store.select(key))
+            store.remove(key)
+            store.put(key, df, data_columns = data_columns, min_itemsize = min_itemsize, **hdf_options)
+            _put_sindex(store, df.ID_specimen.iloc[0], df.slice.iloc[0], df)
+
+
+def _read_parts(keys, where = None, columns = None):
+    #Reads the tables of slices in <keys>, keeping only the rows and columns asked for.
+    #Raises _Changed if the database is no longer in the state of the session cache.
+    def read():
+        with pd.HDFStore(db_file, 'r') as store:
+            return [store.select(key, where = where, columns = columns) for key in keys]
+    
+    dfs, seq = _consistent(read, fallback = False)
+    if seq != _cache['seq']:
+        raise _Changed()
+    for key in keys:
+        _seen[key] = _cache['versions'].get(key, 0)
+    return dfs
+
+
+def _load_parts(indexes):
+    #Makes sure the slices in <indexes> are in the session cache
+    missing = [index for index in indexes if index not in _cache['parts']]
+    if len(missing) > 0:
+        for index, df in zip(missing, _read_parts([_cache['index'][index] for index in missing])):
+            _cache['parts'][index] = df
+
+
+def _write_store(path, meta, parts, replace_all = False):
+    #Writes the metadata and the data of the slices in <parts>.
+    #Value None in <parts> removes the data of the slice.
+    #If <replace_all>, removes all the slices that are not in <parts>.
+    written = {}
+    if path == db_file:
+        _written(['/' + part_key(*index) for index in parts])
+    with pd.HDFStore(path, 'a') as store:
+        if '/meta' in store:
+            store.remove('meta')
+        if len(meta) > 0:
+            store.put('meta', meta, **hdf_options)
+        
+        if replace_all == True:
+            keep = ['/' + part_key(*index) for index in parts.keys()]
+            for key in store.keys():
+                if key.startswith('/data/') and key not in keep:
+                    if path == db_file:
+                        _written([key])
+                    store.remove(key)
+                    for group in derived_groups:
+                        if '/' + group + key[5:] in store:
+                            store.remove(group + key[5:])
+        
+        for (ID_spec, slice), df in parts.items():
+            key = part_key(ID_spec, slice)
+            if key in store:
+                store.remove(key)
+            if df is not None and len(df) > 0:
+                store.put(key, df, data_columns = data_columns, min_itemsize = min_itemsize, **hdf_options)
+                _put_sindex(store, ID_spec, slice, df)
+                written[(ID_spec, int(slice))] = df
+            else:
+                _drop_derived(store, ID_spec, slice)
+                written[(ID_spec, int(slice))] = None
+                
+    return written
+
+
+def _migrate_database():
+    #Converts a database in the former layout (single <meta> and <data> tables)
+    #to one table per slice. The new database is written aside, then replaces the old one.
+    meta = _format_meta(pd.read_hdf(db_file, key='meta'))
+    data = _format_data(pd.read_hdf(db_file, key='data'))
+    parts = {(ID_spec, int(slice)): df.reset_index(drop=True) 
+             for (ID_spec, slice), df in data.groupby(['ID_specimen', 'slice'])}
+    
+    _write_store(db_file + '.tmp', meta, parts, replace_all = True)
+    os.replace(db_file + '.tmp', db_file)
+    logger('Converted database to one table per slice.')
+
+
+def _refresh_cache():
+    #Rereads the metadata and the list of slices if the database changed since they were cached.
+    #Returns FALSE if the database does not exist.
+    stamp = _db_stamp()
+    if stamp is None:
+        clear_cache()
+        return False
+    
+    if stamp != _cache['stamp']:
+        if _cache['stamp'] is not None and _lock['depth'] == 0 and _read_seq()[0] % 2 == 1 and not _writer_died():
+            #Another session is writing: the state read before remains a consistent snapshot until the write ends
+            return True
+        
+        (stamp, (meta, index, outdated), versions), seq = _consistent(lambda: (_db_stamp(), _read_store(db_file), _read_seq()[1]))
+        if index is None or len(outdated) > 0:
+            with _writing():
+                #Checked again: another session may have done it meanwhile
+                meta, index, outdated = _read_store(db_file)
+                if index is None:
+                    _migrate_database()
+                    meta, index, outdated = _read_store(db_file)
+                if len(outdated) > 0:
+                    _upgrade_parts(outdated)
+            clear_cache()
+            return _refresh_cache()
+            
+        _cache['stamp'] = stamp
+        _cache['meta'] = meta
+        _cache['index'] = index
+        _cache['parts'] = {}
+        _cache['data'] = None
+        _cache['seq'] = seq
+        _cache['versions'] = versions
+        _cache['sindex'] = {}
+        
+    return True
+
+
+#Basic I/O functions
+def get_data(samples = None, slices = None, incl_types = None, columns = None, copy = True):
+    """
+    Gets data from database and returns it as Pandas Dataframes.
+    
+    The tables are read from the disk only once per session and kept in memory,
+    as long as the database file is not modified.
+    
+    The data can be restricted to some specimens, slices and types of features, 
+    and to some columns. In that case, only the matching rows and columns are read 
+    from the disk (unless the slices are already in memory).
+
+    Parameters
+    ----------
+    samples:    Specimen ID, or list of specimen IDs. Default: all.
+    slices:     Slice number, or list of slice numbers. Default: all.
+    incl_types: List of types of features (field <incl_type>) to keep. Default: all.
+    columns:    List of columns of data to return. Default: all.
+    copy:       If TRUE (default), returns copies that can be modified freely.
+                If FALSE, may return the cached tables, which must be used read-only.
+
+    Returns
+    -------
+    meta : Metadata
+    data : Data
+
+    """
+    
+    #Replays the labels left by classification sessions that died
+    _merge_orphans()
+    
+    #The read starts again if another session writes in the database meanwhile
+    return _retry(_get_data, samples, slices, incl_types, columns, copy)
+
+
+def _get_data(samples, slices, incl_types, columns, copy):
+    #Body of get_data()
+    
+    #Looks for database and asks the user to creat it if does not exist
+    if _refresh_cache() == False:
+        ans = input('Database not found... create? ...: [n] ')
+        meta = pd.DataFrame(columns = fields_meta)
+        data = pd.DataFrame(columns = fields_data if columns is None else columns)
+        if ans == 'y':
+            _write_store(db_file, meta, {})
+            logger('Created database.')
+        return meta, data
+    
+    meta = _cache['meta']
+    
+    if samples is None and slices is None and incl_types is None and columns is None:
+        if _cache['data'] is None:
+            #Assembles all the slices in a single table
+            indexes = sorted(_cache['index'])
+            _load_parts(indexes)
+            if len(indexes) == 0:
+                _cache['data'] = pd.DataFrame(columns = fields_data)
+            else:
+                _cache['data'] = pd.concat([_cache['parts'][index] for index in indexes], ignore_index=True)
+        
+        data = _cache['data']
+        if copy == True:
+            return meta.copy(), data.copy()
+        return meta, data
+    
+    #Selection of the slices
+    if type(samples) == str:
+        samples = [samples]
+    if slices is not None and np.ndim(slices) == 0:
+        slices = [slices]
+    indexes = [index for index in sorted(_cache['index']) 
+               if (samples is None or index[0] in samples) and (slices is None or index[1] in slices)]
+    
+    if samples is not None:
+        meta = meta.loc[meta.ID_specimen.isin(samples)]
+    if slices is not None:
+        meta = meta.loc[meta.slice.isin(slices)]
+    
+    #Slices in memory are filtered there, the others are read from the disk
+    dfs = {index: _cache['parts'][index] for index in indexes if index in _cache['parts']}
+    missing = [index for index in indexes if index not in dfs]
+    if len(missing) > 0:
+        where = None if incl_types is None else 'incl_type in {!r}'.format(list(incl_types))
+        dfs.update(zip(missing, _read_parts([_cache['index'][index] for index in missing], where, columns)))
+    
+    frames = []
+    for index in indexes:
+        df = dfs[index]
+        if index in _cache['parts']:
+            if incl_types is not None:
+                df = df.loc[df.incl_type.isin(incl_types)]
+            if columns is not None:
+                df = df.loc[:, columns]
+        frames.append(df)
+        
+    if len(frames) == 0:
+        data = pd.DataFrame(columns = fields_data if columns is None else columns)
+    else:
+        data = pd.concat(frames, ignore_index=True)
+    
+    if copy == True:
+        return meta.copy(), data
+    return meta, data
+
+
+def get_meta():
+    """
+    Returns a copy of the metadata, without reading the data.
+    """
+    if _refresh_cache() == False:
+        return pd.DataFrame(columns = fields_meta)
+    return _cache['meta'].copy()
+
+
+def get_slice(ID_spec, slice):
+    """
+    Returns the metadata and a copy of the data of one slice.
+    Faster than get_data() when only one slice is needed.
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+
+    Returns
+    -------
+    meta : Metadata (all the specimens)
+    df :   Data of the slice
+
+    """
+    return _retry(_get_slice, ID_spec, slice)
+
+
+def _get_slice(ID_spec, slice):
+    #Body of get_slice()
+    meta = get_meta()
+    if _cache['index'] is not None and (ID_spec, int(slice)) in _cache['index']:
+        _load_parts([(ID_spec, int(slice))])
+        df = _cache['parts'][(ID_spec, int(slice))]
+    else:
+        df = pd.DataFrame(columns = fields_data)
+    
+    return meta, df.copy()
+
+
+def get_sindex(ID_spec, slice):
+    """
+    Returns the spatial index of the features of one slice (see spatial.GridIndex), to select
+    the features of a rectangle, a polygon, a circle, or the nearest ones, without scanning the slice.
+    The positions returned by its queries are the rows of the data returned by get_slice().
+    The index is kept in the session cache. The index of a slice stored by a former version
+    is built from its data and written in the database.
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+
+    Returns
+    -------
+    sindex :    Spatial index. None if the slice is not in the database.
+
+    """
+    if _refresh_cache() == False or (ID_spec, int(slice)) not in _cache['index']:
+        return None
+    index = (ID_spec, int(slice))
+    if index in _cache['sindex']:
+        return _cache['sindex'][index]
+    
+    key = derived_key('sindex', ID_spec, slice)
+    def read():
+        with pd.HDFStore(db_file, 'r') as store:
+            if key in store:
+                return store.select(key)
+    
+    table = _consistent(read)[0]
+    if table is not None:
+        sindex = spatial.GridIndex.from_table(table)
+    else:
+        df = get_slice(ID_spec, slice)[1]
+        sindex = spatial.GridIndex.from_data(df)
+        with _writing():
+            #Only written if the data is still the one the index was built from
+            if len(_conflicts([index])) == 0:
+                stamp = _db_stamp()
+                with pd.HDFStore(db_file, 'a') as store:
+                    _put_sindex(store, ID_spec, slice, df)
+                _keep_cache(stamp)
+    
+    if _cache['sindex'] is not None:
+        _cache['sindex'][index] = sindex
+    return sindex
+
+
+def _update_cache(stamp, meta, written):
+    #Updates the session cache after writing the slices in <written>
+    if stamp is None or stamp != _cache['stamp']:
+        #The database changed since it was cached, it has to be reread.
+        clear_cache()
+        return
+    
+    for index, df in written.items():
+        if df is None:
+            _cache['index'].pop(index, None)
+            _cache['parts'].pop(index, None)
+        else:
+            _cache['index'][index] = '/' + part_key(*index)
+            _cache['parts'][index] = df
+        _cache['sindex'].pop(index, None)
+    _cache['meta'] = meta
+    _cache['data'] = None
+    _cache['stamp'] = _db_stamp()
+
+
+def _merge_meta(meta, indexes, store = None):
+    #Metadata to write with the slices in <indexes>: the rows of <meta> for these slices,
+    #and the rows in the database for the others
+    if store is None:
+        with pd.HDFStore(db_file, 'r') as store:
+            return _merge_meta(meta, indexes, store)
+    
+    if '/meta' not in store:
+        return meta
+    disk = store.select('meta')
+    if len(indexes) == 0:
+        return _format_meta(disk)
+    indexes = pd.MultiIndex.from_tuples(list(indexes), names = ['ID_specimen', 'slice'])
+    mine = meta.set_index(['ID_specimen', 'slice']).index.isin(indexes)
+    others = ~disk.set_index(['ID_specimen', 'slice']).index.isin(indexes)
+    return _format_meta(pd.concat([disk.loc[others], meta.loc[mine]], ignore_index=True))
+
+
+def _print_conflicts(keys):
+    #Reports the slices that could not be saved
+    print('Not saved: changed by another session since they were read: ' + ', '.join(key.split('/')[-1] for key in keys))
+    print('Read them again (get_data, get_slice) and repeat the operation.')
+
+
+def save_data(meta, data):
+    """
+    Overwrites the database with the metadata and data contained in the Pandas Dataframes in argument.
+    This routine is used by I/O functions to update the database.
+    It can also be used by the user to manually update fields in the database.
+    No confirmation is asked to the user.
+    
+    WARNING: Use only if you know what you are doing. The changes may corrupt the database and are irreversible.
+    ADVICE: Make backup copies of the database regularly.
+
+    Parameters
+    ----------
+    meta: Metadata
+    data: Data
+
+    Returns
+    -------
+    Nothing
+
+    """
+    
+    try:
+        meta = _format_meta(meta)
+        data = _format_data(data)
+        parts = {(ID_spec, int(slice)): df.reset_index(drop=True) 
+                 for (ID_spec, slice), df in data.groupby(['ID_specimen', 'slice'])}
+        
+        with _writing():
+            stale = _conflicts(parts, replace_all = True)
+            if len(stale) > 0:
+                _print_conflicts(stale)
+                return
+            
+            stamp = _db_stamp()
+            written = _write_store(db_file, meta, parts, replace_all = True)
+            
+            #Keeps the session cache in line with what was just written
+            _cache['stamp'] = stamp
+            _cache['index'] = {}
+            _cache['parts'] = {}
+            _cache['sindex'] = {}
+            _update_cache(stamp, meta, written)
+    
+    except:
+        clear_cache()
+        print('Error writing data. Verify datasets.')
+
+
+def save_slices(meta, parts):
+    """
+    Updates the database with the metadata and the data of the slices contained in <parts>.
+    Only the tables of those slices are rewritten, the data of the other slices is left untouched.
+    Likewise, only the rows of the metadata of those slices are taken from <meta>: the rows of
+    the other slices are the ones in the database, which another session may have changed.
+    Nothing is written if another session changed one of the slices since this session read it.
+    This routine is used by I/O functions to update the database.
+    No confirmation is asked to the user.
+    
+    WARNING: Use only if you know what you are doing. The changes may corrupt the database and are irreversible.
+
+    Parameters
+    ----------
+    meta:   Metadata (all the specimens)
+    parts:  Dictionary {(ID_specimen, slice): data of the slice}. 
+            If the data is None, the slice is removed from the data.
+
+    Returns
+    -------
+    ok:     TRUE if the database was updated
+
+    """
+    
+    try:
+        meta = _format_meta(meta)
+        parts = {(ID_spec, int(slice)): None if df is None else _format_data(df) 
+                 for (ID_spec, slice), df in parts.items()}
+        
+        with _writing():
+            stale = _conflicts(parts)
+            if len(stale) > 0:
+                _print_conflicts(stale)
+                return False
+            
+            meta = _merge_meta(meta, parts)
+            stamp = _db_stamp()
+            written = _write_store(db_file, meta, parts)
+            _update_cache(stamp, meta, written)
+        return True
+    
+    except:
+        clear_cache()
+        print('Error writing data. Verify datasets.')
+        return False
+
+
+def locked_update(update, *args):
+    """
+    Calls a function that reads the database and updates it, while holding the lock of the
+    database: no other session writes between the reading and the update.
+    The functions of this module called by <update> can be used as usual.
+
+    Parameters
+    ----------
+    update:     Function reading and updating the database (ex. with save_slices)
+    args:       Arguments of the function
+
+    Returns
+    -------
+    Result of the function
+
+    """
+    with _writing():
+        return update(*args)
+
+
+def read_csv_chunks(filename, ID_spec, slice, x_c = np.nan, y_c = np.nan, chunksize = 200000):
+    """
+    Reads a .csv file of features exported by ImageJ (see readme file) by chunks,
+    and formats each chunk as the data of the slice.
+
+    Parameters
+    ----------
+    filename:   Path of the .csv file
+    ID_spec:    Specimen ID
+    slice:      Slice number
+    x_c, y_c:   Coordinates of the center of the specimen, if known, to calculate polar coordinates
+    chunksize:  Number of rows read at once
+
+    Returns
+    -------
+    Generator of Dataframes. Raises ValueError if the file is not properly formatted.
+
+    """
+    header = pd.read_csv(filename, nrows=0).columns
+    missing = [col for col in csv_columns if col not in header]
+    if len(missing) > 0:
+        raise ValueError('Missing columns in {:s}: {:s}'.format(filename, ', '.join(missing)))
+    
+    n = 0
+    for df in pd.read_csv(filename, usecols=list(csv_columns), dtype='float64', chunksize=chunksize):
+        df = df.rename(columns=csv_columns)
+        df = df.loc[df.incl_nb.notnull()]       #Eliminate empty rows
+        df['sqr_area'] = df.area**0.5           #Add sqr(Area) data
+        df['ID_specimen'] = ID_spec             #Identifies specimen
+        df['slice'] = slice                     #Identifies slice
+        df['incl_type'] = ''                    #Leaves inclusion type unidentified
+        df['r'], df['theta'] = polar_coords(df.x, df.y, x_c, y_c)
+        df['division'] = 0
+        df = df.assign(**defaults_data).loc[:, fields_data].astype(dtypes_data)
+        df.index = pd.RangeIndex(n, n + len(df))
+        n += len(df)
+        yield df
+
+
+def _staging_key(ID_spec, slice):
+    #Key of the table where the data of a slice is written before replacing the existing data
+    return derived_key('staging', ID_spec, slice)
+
+
+def _append_staging(store, ID_spec, slice, chunks):
+    #Appends chunks of data to the staging table of a slice. Returns the number of rows written.
+    staging = _staging_key(ID_spec, slice)
+    n = 0
+    for df in chunks:
+        if n == 0 and staging in store:
+            store.remove(staging)
+        df.index = pd.RangeIndex(n, n + len(df))
+        store.append(staging, df, data_columns = data_columns, min_itemsize = min_itemsize, 
+                     index = False, **hdf_options)
+        n += len(df)
+    return n
+
+
+def _drop_staging(store):
+    #Removes all the staging tables
+    if '/staging' in store:
+        store.remove('staging')
+
+
+def _commit_staging(store, meta, counts):
+    #Replaces the data of the slices in <counts> ({(ID_specimen, slice): number of rows}) 
+    #by their staging tables, and writes the metadata of these slices. Returns the metadata written.
+    _written(['/' + part_key(*index) for index in counts])
+    meta = _merge_meta(meta, counts, store)
+    for (ID_spec, slice), n in counts.items():
+        key = part_key(ID_spec, slice)
+        if key in store:
+            store.remove(key)
+        _drop_derived(store, ID_spec, slice)
+        if n > 0:
+            staging = _staging_key(ID_spec, slice)
+            store.create_table_index(staging, columns = data_columns)
+            _put_sindex(store, ID_spec, slice, store.select(staging, columns = ['incl_nb', 'x', 'y']))
+            store.get_node(staging)._f_move(newparent = '/data', newname = key.split('/')[-1], 
+                                            createparents = True, overwrite = True)
+    _drop_staging(store)
+    
+    if '/meta' in store:
+        store.remove('meta')
+    store.put('meta', meta, **hdf_options)
+    return meta
+
+
+def _keep_cache(stamp):
+    #After writing derived tables only: the data is unchanged, the session cache remains valid
+    if stamp is not None and stamp == _cache['stamp']:
+        _cache['stamp'] = _db_stamp()
+
+
+def _update_cache_imported(stamp, meta, counts):
+    #Updates the session cache after an import. The slices imported are left out 
+    #of the cache, they will be read when needed.
+    _update_cache(stamp, meta, {index: None for index in counts})
+    if _cache['index'] is not None:
+        for (ID_spec, slice), n in counts.items():
+            if n > 0:
+                _cache['index'][(ID_spec, int(slice))] = '/' + part_key(ID_spec, slice)
+
+
+def import_csv(meta, filename, ID_spec, slice, x_c = np.nan, y_c = np.nan, chunksize = 200000):
+    """
+    Imports the features listed in a .csv file exported by ImageJ (see readme file) in the data of a slice.
+    The file is read by chunks, which are formatted and written directly in the database,
+    so the memory used does not depend on the size of the file. 
+    Any existing data on the slice is replaced when the whole file has been read.
+    The metadata in argument is written at the same time.
+
+    Parameters
+    ----------
+    meta:       Metadata (all the specimens), including the slice imported
+    filename:   Path of the .csv file
+    ID_spec:    Specimen ID
+    slice:      Slice number
+    x_c, y_c:   Coordinates of the center of the specimen, if known, to calculate polar coordinates
+    chunksize:  Number of rows read at once
+
+    Returns
+    -------
+    n:          Number of features imported. -1 if the file could not be read.
+
+    """
+    
+    meta = _format_meta(meta)
+    
+    with _writing():
+        stamp = _db_stamp()
+        with pd.HDFStore(db_file, 'a') as store:
+            try:
+                n = _append_staging(store, ID_spec, slice, read_csv_chunks(filename, ID_spec, slice, x_c, y_c, chunksize))
+                
+            except (OSError, KeyError, ValueError):
+                #Exits if any error in the format of the .csv file.
+                _drop_staging(store)
+                print('Error reading .csv file')
+                return -1
+            
+            #Replaces the data of the slice and updates the metadata
+            meta = _commit_staging(store, meta, {(ID_spec, int(slice)): n})
+        
+        _update_cache_imported(stamp, meta, {(ID_spec, int(slice)): n})
+    return n
+
+
+def import_parsed(meta, parts):
+    """
+    Imports in the database the data of several slices, already read from their .csv files
+    (see read_csv_chunks). The data of all the slices is written at once: any existing data
+    on the same slices is replaced. The metadata in argument is written at the same time.
+    Other sessions only wait for the writing, not for the reading of the files.
+
+    Parameters
+    ----------
+    meta:       Metadata (all the specimens), including the slices imported
+    parts:      Dictionary {(ID_specimen, slice): data of the slice, or list of chunks of data}
+
+    Returns
+    -------
+    counts:     Dictionary {(ID_specimen, slice): number of features imported}
+
+    """
+    meta = _format_meta(meta)
+
+    with _writing():
+        stamp = _db_stamp()
+        counts = {}
+        with pd.HDFStore(db_file, 'a') as store:
+            try:
+                for (ID_spec, slice), chunks in parts.items():
+                    chunks = [chunks] if isinstance(chunks, pd.DataFrame) else chunks
+                    counts[(ID_spec, int(slice))] = _append_staging(store, ID_spec, slice, chunks)
+            except:
+                _drop_staging(store)
+                raise
+
+            meta = _commit_staging(store, meta, counts)
+
+        _update_cache_imported(stamp, meta, counts)
+    return counts
+
+
+def compact_database():
+    """
+    Rewrites the database in a new file to recover the space left by the tables that were rewritten.
+    HDF5 files do not shrink when tables are removed, so it is worth doing from time to time.
+    
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    Nothing
+
+    """
+    with _writing():
+        meta, data = get_data(copy=False)
+        _write_store(db_file + '.tmp', _cache['meta'], _cache['parts'], replace_all = True)
+        
+        #Copies the other tables: derived tables and their descriptions
+        with pd.HDFStore(db_file, 'r') as store, pd.HDFStore(db_file + '.tmp', 'a') as new_store:
+            for key in store.keys():
+                if key != '/meta' and not key.startswith('/data/') and not key.startswith('/sindex/'):
+                    new_store.put(key, store.select(key), **hdf_options)
+        os.replace(db_file + '.tmp', db_file)
+        clear_cache()
+    logger('Compacted database.')
+
+
+#Division schemes, for block maxima analysis.
+#A scheme cuts every slice in blocks: a grid of n_divis_x by n_divis_y blocks for rectangular
+#specimens, n_divis_x angular sectors for circular specimens. The schemes are described in the
+#table <division_schemes>. The division numbers (1, 2...) of the features of a slice are stored
+#in the table divisions/<slice>, next to incl_nb, with one column per scheme.
+fields_schemes = ['name', 'n_divis_x', 'n_divis_y']
+
+
+def get_division_schemes():
+    """
+    Returns the description of the division schemes stored in the database.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    schemes :   Dataframe with the fields name, n_divis_x, n_divis_y
+
+    """
+    if _refresh_cache() == False:
+        return pd.DataFrame(columns = fields_schemes)
+    
+    def read():
+        with pd.HDFStore(db_file, 'r') as store:
+            if '/division_schemes' in store:
+                return store.select('division_schemes')
+        return pd.DataFrame(columns = fields_schemes)
+    
+    return _consistent(read)[0]
+
+
+def get_divisions(samples = None, slices = None, schemes = None):
+    """
+    Returns the division numbers of the features, for some or all the division schemes.
+
+    Parameters
+    ----------
+    samples:    Specimen ID, or list of specimen IDs. Default: all.
+    slices:     Slice number, or list of slice numbers. Default: all.
+    schemes:    Name, or list of names of division schemes. Default: all.
+
+    Returns
+    -------
+    divisions : Dataframe with the fields ID_specimen, slice, incl_nb and one column per scheme.
+                The features of slices not divided by a scheme have division 0.
+
+    """
+    if type(schemes) == str:
+        schemes = [schemes]
+    if type(samples) == str:
+        samples = [samples]
+    if slices is not None and np.ndim(slices) == 0:
+        slices = [slices]
+    if _refresh_cache() == False:
+        return pd.DataFrame(columns = ['ID_specimen', 'slice', 'incl_nb'] + ([] if schemes is None else schemes))
+    
+    names = list(get_division_schemes().name) if schemes is None else schemes
+    indexes = [index for index in sorted(_cache['index']) 
+               if (samples is None or index[0] in samples) and (slices is None or index[1] in slices)]
+    
+    def read():
+        dfs = []
+        with pd.HDFStore(db_file, 'r') as store:
+            for ID_spec, slice in indexes:
+                key = derived_key('divisions', ID_spec, slice)
+                if key not in store:
+                    continue
+                df = store.select(key)
+                df = df.loc[:, ['incl_nb'] + [name for name in names if name in df.columns]]
+                df.insert(0, 'slice', np.int32(slice))
+                df.insert(0, 'ID_specimen', ID_spec)
+                dfs.append(df)
+        return dfs
+    
+    dfs = _consistent(read)[0]
+    if len(dfs) == 0:
+        return pd.DataFrame(columns = ['ID_specimen', 'slice', 'incl_nb'] + names)
+    divisions = pd.concat(dfs, ignore_index=True)
+    divisions['incl_nb'] = divisions.incl_nb.astype('int32')
+    for name in names:
+        divisions[name] = divisions[name].fillna(0).astype(division_dtype(divisions[name].max())) \
+            if name in divisions.columns else np.int16(0)
+    return divisions
+
+
+def division_dtype(n):
+    #Smallest integer type holding division numbers up to <n>
+    return 'int16' if n < 2**15 else 'int32'
+
+
+def save_divisions(schemes, parts):
+    """
+    Writes the division numbers of the features of some slices for one or several schemes.
+    The columns of the other schemes are kept. Schemes with the same names are replaced.
+    No confirmation is asked to the user.
+
+    Parameters
+    ----------
+    schemes:    Dataframe with the fields name, n_divis_x, n_divis_y describing the schemes
+    parts:      Dictionary {(ID_specimen, slice): Dataframe with incl_nb and one column per scheme}
+
+    Returns
+    -------
+    ok:         TRUE if the database was updated
+
+    """
+    if _refresh_cache() == False:
+        print('Database not found')
+        return False
+    
+    names = list(schemes.name)
+    
+    with _writing():
+        #The schemes are read under the lock, so those added meanwhile by another session are kept
+        old = get_division_schemes()
+        schemes = pd.concat([old.loc[~old.name.isin(names)], schemes.loc[:, fields_schemes]], ignore_index=True)
+        schemes = schemes.astype({'n_divis_x': 'int32', 'n_divis_y': 'int32'})
+        stamp = _db_stamp()
+        with pd.HDFStore(db_file, 'a') as store:
+            for (ID_spec, slice), df in parts.items():
+                key = derived_key('divisions', ID_spec, slice)
+                df = df.loc[:, ['incl_nb'] + names].astype({'incl_nb': 'int32'}).set_index('incl_nb')
+                for name in names:
+                    df[name] = df[name].astype(division_dtype(df[name].max()))
+                if key in store:
+                    old_df = store.select(key).set_index('incl_nb')
+                    df = old_df.drop(columns = [name for name in names if name in old_df.columns]).join(df, how='outer')
+                    df = df.fillna(0).astype({col: division_dtype(df[col].max()) for col in df.columns})
+                    store.remove(key)
+                store.put(key, df.reset_index(), **hdf_options)
+        
+            if '/division_schemes' in store:
+                store.remove('division_schemes')
+            store.put('division_schemes', schemes, min_itemsize = {'name': 32}, **hdf_options)
+        _keep_cache(stamp)
+    
+    return True
+
+
+def remove_division_scheme(name):
+    """
+    Removes a division scheme from the database.
+
+    Parameters
+    ----------
+    name:   Name of the scheme
+
+    Returns
+    -------
+    Nothing
+
+    """
+    with _writing():
+        schemes = get_division_schemes()
+        if name not in list(schemes.name):
+            print('No such division scheme')
+            return
+        stamp = _db_stamp()
+        with pd.HDFStore(db_file, 'a') as store:
+            for key in store.keys():
+                if key.startswith('/divisions/'):
+                    df = store.select(key)
+                    if name in df.columns:
+                        store.remove(key)
+                        if len(df.columns) > 2:
+                            store.put(key, df.drop(columns = [name]), **hdf_options)
+            store.remove('division_schemes')
+            if len(schemes) > 1:
+                store.put('division_schemes', schemes.loc[schemes.name != name].reset_index(drop=True), min_itemsize = {'name': 32}, **hdf_options)
+        _keep_cache(stamp)
+    
+    logger('Removed division scheme {:s}.'.format(name))
+
+
+#Exclusion zones.
+#The zones excluded from each slice (see zones.py) are kept in the table zones/<slice>, as the
+#vertices of their outlines: one row per vertex, numbered by zone. A rectangle is given by two
+#opposite corners, a polygon by its vertices in order, a mask by the opposite corners of the
+#rectangles covering it.
+fields_zones = ['zone', 'kind', 'x', 'y']
+
+
+def get_zones(samples = None, slices = None):
+    """
+    Returns the exclusion zones of the slices.
+
+    Parameters
+    ----------
+    samples:    Specimen ID, or list of specimen IDs. Default: all.
+    slices:     Slice number, or list of slice numbers. Default: all.
+
+    Returns
+    -------
+    zones :     Dataframe with the fields ID_specimen, slice, zone, kind, x, y
+
+    """
+    if type(samples) == str:
+        samples = [samples]
+    if slices is not None and np.ndim(slices) == 0:
+        slices = [slices]
+    if _refresh_cache() == False:
+        return pd.DataFrame(columns = ['ID_specimen', 'slice'] + fields_zones)
+    
+    indexes = [index for index in sorted(_cache['index']) 
+               if (samples is None or index[0] in samples) and (slices is None or index[1] in slices)]
+    
+    def read():
+        dfs = []
+        with pd.HDFStore(db_file, 'r') as store:
+            for ID_spec, slice in indexes:
+                key = derived_key('zones', ID_spec, slice)
+                if key in store:
+                    df = store.select(key)
+                    df.insert(0, 'slice', np.int32(slice))
+                    df.insert(0, 'ID_specimen', ID_spec)
+                    dfs.append(df)
+        return dfs
+    
+    dfs = _consistent(read)[0]
+    if len(dfs) == 0:
+        return pd.DataFrame(columns = ['ID_specimen', 'slice'] + fields_zones)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def save_zones(parts):
+    """
+    Replaces the exclusion zones of some slices. The data and the metadata are not changed:
+    see zones.apply_zones() to exclude zones. No confirmation is asked to the user.
+
+    Parameters
+    ----------
+    parts:      Dictionary {(ID_specimen, slice): Dataframe with the fields zone, kind, x, y}
+
+    Returns
+    -------
+    Nothing
+
+    """
+    if _refresh_cache() == False:
+        return
+    
+    with _writing():
+        stamp = _db_stamp()
+        with pd.HDFStore(db_file, 'a') as store:
+            for (ID_spec, slice), df in parts.items():
+                key = derived_key('zones', ID_spec, slice)
+                if key in store:
+                    store.remove(key)
+                if len(df) > 0:
+                    df = df.loc[:, fields_zones].astype({'zone': 'int32', 'x': 'float64', 'y': 'float64'})
+                    store.put(key, df.reset_index(drop=True), min_itemsize = {'kind': 8}, **hdf_options)
+        _keep_cache(stamp)
+
+
+#Prediction cache.
+#The probabilities given by the models are kept in the table predictions/<slice>, by feature,
+#version of the model and crop (box in pixels and size of the image fed to the model, see
+#classifier.crop_keys), so a feature is never evaluated twice by the same model on the same crop.
+fields_predictions = ['incl_nb', 'model_version', 'crop', 'p_incl']
+
+
+def get_predictions(ID_spec, slice, model_version = None):
+    """
+    Returns the predictions stored for the features of a slice.
+
+    Parameters
+    ----------
+    ID_spec:        Specimen ID
+    slice:          Slice number
+    model_version:  Version of the model (see classifier.model_version). Default: all.
+
+    Returns
+    -------
+    predictions :   Dataframe with the fields incl_nb, model_version, crop, p_incl
+
+    """
+    if _refresh_cache() == False:
+        return pd.DataFrame(columns = fields_predictions)
+    key = derived_key('predictions', ID_spec, slice)
+    where = None if model_version is None else 'model_version == {!r}'.format(model_version)
+    
+    def read():
+        with pd.HDFStore(db_file, 'r') as store:
+            if key not in store:
+                return pd.DataFrame(columns = fields_predictions)
+            return store.select(key, where = where)
+    
+    predictions = _consistent(read)[0]
+    return predictions.drop_duplicates(subset = ['incl_nb', 'model_version', 'crop'], keep = 'last').reset_index(drop=True)
+
+
+def save_predictions(ID_spec, slice, predictions):
+    """
+    Adds predictions to the cache of a slice. They replace any prediction stored
+    for the same features, model versions and crops.
+
+    Parameters
+    ----------
+    ID_spec:        Specimen ID
+    slice:          Slice number
+    predictions:    Dataframe with the fields incl_nb, model_version, crop, p_incl
+
+    Returns
+    -------
+    Nothing
+
+    """
+    if _refresh_cache() == False or len(predictions) == 0:
+        return
+    predictions = predictions.loc[:, fields_predictions].astype({'incl_nb': 'int32', 'p_incl': 'float32'})
+    key = derived_key('predictions', ID_spec, slice)
+    
+    #Appended, the duplicates are dropped when reading
+    with _writing():
+        stamp = _db_stamp()
+        with pd.HDFStore(db_file, 'a') as store:
+            store.append(key, predictions, data_columns = ['incl_nb', 'model_version'], index = False,
+                         min_itemsize = {'model_version': 40, 'crop': 48}, **hdf_options)
+        _keep_cache(stamp)
+
+
+def logger(text, time=None):
+    """
+    Timestamps and appends entries to the log file db_incl.log.
+
+    Parameters
+    ----------
+    text:   Description of the change, or list of descriptions
+    time:   Timestamp of the entry, or list of timestamps. Default: now.
+
+    Returns
+    -------
+    Nothing
+
+    """
+    if type(text) == str:
+        text = [text]
+        time = [time]
+    elif time is None:
+        time = [None]*len(text)
+    
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with open('db_incl.log', 'a+') as file:
+        for t, line in zip(time, text):
+            file.write('{:s}:\t{:s}\n'.format(now if t is None else t, line))
+
+
+#Journal of the classifications made in ID_incl().
+#Each label is appended to the journal file and flushed immediately, the file is synced
+#on the disk every <sync_every> labels, and the labels are merged in the database every
+#<merge_every> labels and when the session ends.
+#Each session has its own journal, db_incl.<host>-<process>.journal, locked while the session
+#is open (see locks.py), so several users can classify at the same time. The journal of a
+#session that died is no longer locked: it is replayed by the next call to get_data().
+#A label is merged only if the feature still has the type it had when it was shown:
+#if another session classified it meanwhile, its label is kept and the conflict is logged.
+journal_pattern = 'db_incl.{:s}.journal'
+_session = '{:s}-{:d}'.format(socket.gethostname(), os.getpid())
+_journal = {'file': None, 'path': None, 'unsynced': 0, 'pending': 0, 'sync_every': 10, 'merge_every': 200, 'busy': False}
+
+#Slices reserved by this session (see lease_slice), with their open lease files
+lease_dir = 'db_incl.leases'
+_leases = {}
+
+
+def journal_open(sync_every=10, merge_every=200):
+    """
+    Opens the journal for a classification session. Labels left by sessions that died are merged first.
+
+    Parameters
+    ----------
+    sync_every:     Number of labels between two syncs of the journal file on the disk
+    merge_every:    Number of labels between two merges in the database
+
+    Returns
+    -------
+    Nothing
+
+    """
+    if _journal['file'] is not None:
+        journal_close()
+    _merge_orphans()
+    
+    path = journal_pattern.format(_session)
+    file = open(path, 'a+')
+    locks.lock(file)
+    _journal['file'] = file
+    _journal['path'] = path
+    _journal['unsynced'] = 0
+    _journal['pending'] = 0
+    _journal['sync_every'] = sync_every
+    _journal['merge_every'] = merge_every
+
+
+def journal_write(ID_spec, slice, incl_nb, incl_type, source='user', p_incl=None, version=None, previous=''):
+    """
+    Records the classification of a feature in the journal.
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+    incl_nb:    Index of the feature
+    incl_type:  Type of feature (see ID_incl)
+    source:     'user' if the feature was classified by the user, 'auto' if from the prediction of the model
+    p_incl:     Probability that the feature is an inclusion, for an automatic label
+    version:    Version of the model that gave p_incl
+    previous:   Type of the feature when it was shown (unidentified by default)
+
+    Returns
+    -------
+    Nothing
+
+    """
+    entry = {'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 
+             'ID_specimen': ID_spec, 'slice': int(slice), 'incl_nb': int(incl_nb), 
+             'incl_type': incl_type, 'id_source': source, 'previous': previous}
+    if p_incl is not None:
+        entry['p_incl'] = float(p_incl)
+        entry['model_version'] = version
+    file = _journal['file']
+    file.write(json.dumps(entry) + '\n')
+    file.flush()
+    
+    _journal['unsynced'] += 1
+    _journal['pending'] += 1
+    if _journal['unsynced'] >= _journal['sync_every']:
+        os.fsync(file.fileno())
+        _journal['unsynced'] = 0
+    if _journal['pending'] >= _journal['merge_every']:
+        journal_merge()
+
+
+def journal_merge():
+    """
+    Merges the labels recorded in the journal of the current session in the database.
+    """
+    file = _journal['file']
+    if file is None:
+        return
+    
+    file.flush()
+    os.fsync(file.fileno())
+    if _merge_journal(_journal['path']) == False:
+        return
+    
+    file.seek(0)
+    file.truncate()
+    _journal['unsynced'] = 0
+    _journal['pending'] = 0
+
+
+def journal_close():
+    """
+    Merges the labels recorded in the journal in the database and closes the journal.
+    """
+    if _journal['file'] is None:
+        return
+    
+    journal_merge()
+    file, path = _journal['file'], _journal['path']
+    _journal['file'] = None
+    _journal['path'] = None
+    _close_journal(file, path, os.path.getsize(path) == 0)
+
+
+def _close_journal(file, path, remove):
+    #Unlocks and closes a journal, and removes it if <remove>.
+    #Where possible, it is removed while still locked, so no other session replays it meanwhile.
+    if remove == True and os.name != 'nt':
+        os.remove(path)
+    locks.unlock(file)
+    file.close()
+    if remove == True and os.name == 'nt':
+        #Windows: open files can not be removed
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _merge_orphans():
+    #Replays the journals of the sessions that died, and removes them.
+    #Journals still locked belong to sessions at work and are left alone.
+    if _journal['busy'] == True:
+        return
+    for path in glob.glob('db_incl*.journal'):
+        if path == _journal['path']:
+            continue
+        try:
+            file = open(path, 'r+')
+        except FileNotFoundError:
+            #Removed by its session meanwhile
+            continue
+        if locks.try_lock(file) == False:
+            file.close()
+            continue
+        if not os.path.exists(path):
+            #Closed by its session between the listing and the lock
+            locks.unlock(file)
+            file.close()
+            continue
+        _close_journal(file, path, _merge_journal(path))
+
+
+def _merge_journal(path):
+    #Applies the labels of a journal file to the database, and logs them.
+    #Applying the same journal twice gives the same result.
+    if _journal['busy'] == True or not os.path.exists(path):
+        return True
+    
+    entries = []
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                #Incomplete line written when the session died
+                pass
+    if len(entries) == 0:
+        return True
+    
+    _journal['busy'] = True
+    try:
+        #The slices are read and written while holding the write lock, so no label of another session is lost
+        with _writing():
+            if _refresh_cache() == False:
+                return False
+            meta = _cache['meta'].copy()
+            entries = pd.DataFrame(entries)
+            if 'id_source' not in entries.columns:
+                #Journal written by a former version
+                entries['id_source'] = 'user'
+            entries['id_source'] = entries.id_source.fillna('user')
+            for col in ['p_incl', 'model_version', 'previous']:
+                if col not in entries.columns:
+                    entries[col] = np.nan
+            entries['previous'] = entries.previous.fillna('')
+            
+            parts = {}
+            conflicts = []
+            for (ID_spec, slice), df in entries.groupby(['ID_specimen', 'slice'], sort=False):
+                if (ID_spec, int(slice)) not in _cache['index']:
+                    #Slice removed since the labels were recorded
+                    continue
+                _load_parts([(ID_spec, int(slice))])
+                part = _cache['parts'][(ID_spec, int(slice))]
+                
+                labels = df.drop_duplicates('incl_nb', keep='last').set_index('incl_nb')
+                current = part.set_index('incl_nb').incl_type.reindex(labels.index)
+                
+                #Features classified differently by another session since they were shown
+                clash = current.notnull() & (current != labels.previous) & (current != labels.incl_type)
+                conflicts += ['Conflict in inclusion ID. Sample {:s}, slide {:d}, inclusion {:d}: Type {:s} kept, type {:s} of session {:s} dropped.'\
+                                  .format(ID_spec, int(slice), incl_nb, current[incl_nb], labels.incl_type[incl_nb], os.path.basename(path))
+                              for incl_nb in labels.index[clash]]
+                labels = labels.loc[~clash]
+                
+                part = part.copy()
+                mask = part.incl_nb.isin(labels.index)
+                numbers = part.loc[mask, 'incl_nb']
+                part.loc[mask, 'incl_type'] = numbers.map(labels.incl_type).values
+                part.loc[mask, 'id_source'] = numbers.map(labels.id_source).values
+                
+                #Automatic labels keep the prediction they were made from
+                auto = labels.loc[labels.id_source == 'auto']
+                rows = part.incl_nb.isin(auto.index)
+                if rows.any():
+                    part.loc[rows, 'p_incl'] = part.loc[rows, 'incl_nb'].map(auto.p_incl).values.astype('float32')
+                    part.loc[rows, 'model_version'] = part.loc[rows, 'incl_nb'].map(auto.model_version).values
+                parts[(ID_spec, int(slice))] = part
+            
+            if len(parts) > 0 and save_slices(meta, parts) == False:
+                #The journal is kept for a later attempt
+                return False
+        
+        logger(['{:s} inclusion ID. Sample {:s}, slide {:d}, inclusion {:d}: Type {:s}.'.format(
+                    'Automatic' if row.id_source == 'auto' else 'Manual', row.ID_specimen, row.slice, row.incl_nb, row.incl_type) 
+                for row in entries.itertuples()], list(entries.time))
+        if len(conflicts) > 0:
+            logger(conflicts)
+            print('{:d} labels not merged: the features were classified by another session meanwhile (see db_incl.log).'.format(len(conflicts)))
+    
+    finally:
+        _journal['busy'] = False
+    
+    return True
+
+
+def lease_slice(ID_spec, slice):
+    """
+    Reserves a slice for the classification session of this user, so that two users do not
+    classify the same slice at the same time. The reservation lasts until release_slice(),
+    or the end of the session, even if it dies.
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+
+    Returns
+    -------
+    holder:     None if the slice was reserved, otherwise a description of the session holding it
+
+    """
+    if (ID_spec, int(slice)) in _leases:
+        return None
+    os.makedirs(lease_dir, exist_ok=True)
+    path = os.path.join(lease_dir, part_key(ID_spec, slice).split('/')[-1] + '.lease')
+    file = open(path, 'a+')
+    if locks.try_lock(file) == False:
+        file.seek(0)
+        holder = file.read().strip()
+        file.close()
+        return holder if holder != '' else 'another session'
+    
+    file.seek(0)
+    file.truncate()
+    file.write('{:s} ({:s}) since {:s}'.format(os.environ.get('USERNAME', os.environ.get('USER', 'unknown user')), _session, 
+                                              datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    file.flush()
+    _leases[(ID_spec, int(slice))] = file
+    return None
+
+
+def release_slice(ID_spec, slice):
+    """
+    Ends the reservation of a slice made by lease_slice().
+    """
+    file = _leases.pop((ID_spec, int(slice)), None)
+    if file is not None:
+        file.truncate(0)
+        locks.unlock(file)
+        file.close()
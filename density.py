@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+#Kernel density estimates of the sizes of the features, on a logarithmic axis.
+#The values are spread on a regular grid by linear binning, and the grid is convolved
+#with the Gaussian kernel by FFT: the cost grows with the number of values plus the size
+#of the grid, instead of their product as with scipy.stats.gaussian_kde.
+#The bandwidth is the one of gaussian_kde with covariance_factor = cov_fact, so the
+#results are the same (see benchmarks.check_density).
+#This module only depends on Numpy.
+
+#Commonly used libraries
+import numpy as np
+
+#Number of points of the grid
+n_grid = 4096
+
+#Extent of the grid beyond the values, in bandwidths: the kernel is negligible beyond
+margin = 6
+
+
+def bandwidth(values, cov_fact, weights = None):
+    """
+    Bandwidth of the Gaussian kernel, as in scipy.stats.gaussian_kde: cov_fact times the
+    standard deviation of the values (weighted, with the same correction for the bias).
+
+    Parameters
+    ----------
+    values:     Array of values
+    cov_fact:   Covariance factor
+    weights:    Weights of the values. Default: same weight.
+
+    Returns
+    -------
+    h :         Standard deviation of the kernel
+
+    """
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)/np.sum(weights)
+    return cov_fact*float(np.sqrt(np.cov(values, aweights = weights)))
+
+
+def binning(values, h, weights = None):
+    """
+    Linear binning of values on the grid of a density: each value is shared between the
+    two nearest points of the grid. The grid spans the values plus <margin> bandwidths.
+
+    Parameters
+    ----------
+    values:     Array of values
+    h:          Bandwidth of the kernel
+    weights:    Weights of the values. Default: 1.
+
+    Returns
+    -------
+    grid :      (low, step): first point and spacing of the grid
+    i :         Point of the grid below each value
+    w0, w1 :    Weights given to the points i and i + 1
+
+    """
+    weights = np.ones(len(values)) if weights is None else weights
+    low = values.min() - margin*h
+    step = (values.max() + margin*h - low)/(n_grid - 1)
+    pos = (values - low)/step
+    i = np.minimum(np.floor(pos).astype('int64'), n_grid - 2)
+    frac = pos - i
+    return (low, step), i, weights*(1 - frac), weights*frac
+
+
+def smooth(binned, h, step):
+    """
+    Convolves binned values with the Gaussian kernel sampled on the grid, padded so it does
+    not wrap around. Several grids can be convolved at once (one per row).
+
+    Parameters
+    ----------
+    binned:     Array of n_grid weights, or 2D array with one grid per row
+    h:          Bandwidth of the kernel
+    step:       Spacing of the grid
+
+    Returns
+    -------
+    conv :      Array of the same shape: density at the points of the grid
+
+    """
+    k = np.arange(-(n_grid - 1), n_grid)*step
+    kernel = np.exp(-0.5*(k/h)**2)/(h*np.sqrt(2*np.pi))
+    size = 2**int(np.ceil(np.log2(3*n_grid - 2)))
+    conv = np.fft.irfft(np.fft.rfft(binned, size)*np.fft.rfft(kernel, size), size)[..., n_grid - 1:2*n_grid - 1]
+    return np.maximum(conv, 0)
+
+
+def kde(values, points, cov_fact, weights = None):
+    """
+    Gaussian kernel density estimate of values, evaluated at points. The density integrates to 1.
+
+    Parameters
+    ----------
+    values:     Array of values
+    points:     Points where the density is evaluated
+    cov_fact:   Covariance factor, as in gaussian_kde (bandwidth = cov_fact times the standard deviation)
+    weights:    Weights of the values. Default: same weight.
+
+    Returns
+    -------
+    density :   Array aligned with points. 0 far from the values (and at infinite points).
+                NaN if the bandwidth is not defined: less than 2 values, or all equal.
+
+    """
+    values = np.asarray(values, dtype=float)
+    points = np.asarray(points, dtype=float)
+    weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=float)
+    weights = weights/weights.sum()
+    if len(values) < 2:
+        return np.full(points.shape, np.nan)
+    with np.errstate(invalid='ignore'):
+        h = bandwidth(values, cov_fact, weights)
+    if not (np.isfinite(h) and h > 0):
+        #All the values equal (or infinite): no bandwidth
+        return np.full(points.shape, np.nan)
+
+    (low, step), i, w0, w1 = binning(values, h, weights)
+    grid = np.bincount(i, w0, minlength = n_grid) + np.bincount(i + 1, w1, minlength = n_grid)
+    conv = smooth(grid, h, step)
+
+    return np.interp(points, low + np.arange(n_grid)*step, conv, left = 0., right = 0.)
+
+
+def log_density(sizes, x, cov_fact = 0.18, weights = None):
+    """
+    Density of log10 of sizes (ex. feret diameters), evaluated at the sizes x:
+    the same as gaussian_kde(np.log10(sizes), weights) with covariance_factor = cov_fact,
+    evaluated at np.log10(x).
+
+    Parameters
+    ----------
+    sizes:      Sizes of the features
+    x:          Sizes where the density is evaluated. 0 gives a density of 0.
+    cov_fact:   Covariance factor
+    weights:    Weights of the features (ex. area). Default: same weight.
+
+    Returns
+    -------
+    density :   Array aligned with x (per unit of log10 of the size). NaN if less than
+                2 sizes, or all equal (see kde).
+
+    """
+    with np.errstate(divide='ignore'):
+        return kde(np.log10(sizes), np.log10(x), cov_fact, weights)
@@ -1,57 +1,227 @@
 # -*- coding: utf-8 -*-
 
+#Extracts the images of the classified features, to train the artificial neural network.
+#Inclusions (incl_type '2') go to images/Inclusions, the other features classified by the user
+#('1', '3', '4', '5', '6') to images/Other. The crops are read from the tiled copies of the
+#micrographs (see tiles.py), in parallel, slice by slice.
+#
+#The extraction is incremental: images/index.csv records each crop, with its box and
+#the version of the micrograph, and only the new or changed crops are written again.
+#With --format npz, the crops are resized and packed in shards instead of loose .jpg files:
+#images/shards/<slice>.<n>.npz, with arrays images, labels, ID_specimen, slice and incl_nb.
+#
+#Usage:     python extract_images.py [--format npz] [--samples 809BH 810BH] [--processes 4]
+
 #Commonly used libraries
 import pandas as pd
 import numpy as np
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from PIL import Image
-Image.MAX_IMAGE_PIXELS = 1e9
+import database
+import tiles
+import classifier
+from geometry import crop_boxes
 
-import analysis
+#Folders of the crops, per type of feature
+classes = {'2': 'Inclusions', '1': 'Other', '3': 'Other', '4': 'Other', '5': 'Other', '6': 'Other'}
+out_dir = 'images'
+index_file = os.path.join(out_dir, 'index.csv')
+fields_index = ['name', 'ID_specimen', 'slice', 'incl_nb', 'label', 'xmin', 'ymin', 'xmax', 'ymax', 'source']
+shard_size = 5000       #Number of crops per shard
 
-meta, data = analysis.get_data()
 
-for spec in data.loc[data.incl_type=='2'].ID_specimen.unique():
+def image_file(ser_meta):
+    #Micrograph of a slice: .jpg file named as the .csv file, or named after the specimen (former convention)
+    filename = os.path.join('data', ser_meta.filename.replace('csv', 'jpg'))
+    if os.path.exists(filename) or os.path.exists(tiles.tiles_path(filename)):
+        return filename
+    return os.path.join('data', ser_meta.ID_specimen + '.jpg')
 
-    im_filename = os.path.join('data', spec + '.jpg')
-    im = Image.open(im_filename)
 
-    df = data.loc[data.ID_specimen==spec]
-    for index, row in df.loc[df.incl_type=='2'].iterrows():
-        x = row.x
-        y = row.y
-        feret = row.feret
-        feret_min = row.min_feret
-        feret_angle = row.feret_angle
-        
-        width = np.max([np.abs(feret*np.cos(feret_angle*np.pi/180)), feret_min])*2
-        height = np.max([np.abs(feret*np.sin(feret_angle*np.pi/180)), feret_min])*2
-        
-        xmin = x - width/2
-        xmax = x + width/2
-        ymin = y - height/2
-        ymax = y + height/2
+def _source(filename):
+    #Version of a micrograph: size and modification time of the image, or of its tiles if it was removed
+    path = filename if os.path.exists(filename) else tiles.tiles_path(filename)
+    st = os.stat(path)
+    return '{:d}:{:d}'.format(st.st_mtime_ns, st.st_size)
+
+
+def list_crops(samples = None):
+    """
+    Lists the crops to extract, with their boxes in pixels (rounded as PIL does).
+
+    Parameters
+    ----------
+    samples:    Specimen ID, or list of specimen IDs. Default: all.
+
+    Returns
+    -------
+    crops :     Dataframe with the fields of index.csv, plus the path of the micrograph
+
+    """
+    meta, df = database.get_data(samples = samples, incl_types = list(classes),
+                                 columns = ['ID_specimen', 'slice', 'incl_nb', 'x', 'y', 'feret', 'min_feret', 'feret_angle', 'incl_type'])
+    if len(df) == 0:
+        return pd.DataFrame(columns = fields_index + ['file'])
+
+    crops = df.loc[:, ['ID_specimen', 'slice', 'incl_nb']].copy()
+    crops['label'] = df.incl_type.map(classes)
+    crops = crops.join(np.round(crop_boxes(df)).astype('int64'))
+
+    #Former names for slice 1: <specimen>.<incl_nb>.jpg
+    crops['name'] = crops.ID_specimen + np.where(crops.slice == 1, '', '.s' + crops.slice.astype(str)) \
+        + '.' + crops.incl_nb.astype(str) + '.jpg'
+
+    files = {(row.ID_specimen, int(row.slice)): image_file(row) for row in meta.itertuples()}
+    crops['file'] = [files[(ID_spec, int(slice))] for ID_spec, slice in zip(crops.ID_specimen, crops.slice)]
+    missing = [f for f in set(crops.file) if not os.path.exists(f) and not os.path.exists(tiles.tiles_path(f))]
+    if len(missing) > 0:
+        print('Images not found, skipped: ' + ', '.join(sorted(missing)))
+        crops = crops.loc[~crops.file.isin(missing)]
+    sources = {f: _source(f) for f in set(crops.file)}
+    crops['source'] = crops.file.map(sources)
+
+    return crops.loc[:, fields_index + ['file']].reset_index(drop=True)
+
+
+def _extract_jpg(filename, crops):
+    #Writes the crops of one micrograph as .jpg files. Runs in a worker process.
+    im = tiles.open_image(filename, build = False)
+    for row in crops.itertuples():
+        im.crop((row.xmin, row.ymin, row.xmax, row.ymax)).convert('RGB')\
+            .save(os.path.join(out_dir, row.label, row.name), 'JPEG')
+    return len(crops)
+
+
+def _extract_npz(filename, crops, shard):
+    #Writes the crops of one micrograph, resized, in a shard. Runs in a worker process.
+    im = tiles.open_image(filename, build = False)
+    images = np.stack([np.asarray(im.crop((row.xmin, row.ymin, row.xmax, row.ymax)).convert('RGB')
+                                  .resize(classifier.img_size)) for row in crops.itertuples()])
+    np.savez(os.path.join(out_dir, 'shards', shard + '.tmp.npz'), images = images, labels = crops.label.to_numpy(dtype=str),
+             ID_specimen = crops.ID_specimen.to_numpy(dtype=str), slice = crops.slice.to_numpy(), incl_nb = crops.incl_nb.to_numpy())
+    os.replace(os.path.join(out_dir, 'shards', shard + '.tmp.npz'), os.path.join(out_dir, 'shards', shard + '.npz'))
+    return len(crops)
+
+
+def _split(df):
+    #Splits the crops of a micrograph in tasks or shards of at most shard_size crops
+    return [df.iloc[k:k+shard_size] for k in range(0, len(df), shard_size)]
+
+
+def _read_index():
+    #Crops extracted at the last run
+    if os.path.exists(index_file):
+        return pd.read_csv(index_file, dtype = {'name': str, 'ID_specimen': str, 'label': str, 'source': str, 'shard': str})
+    return pd.DataFrame(columns = fields_index + ['shard'])
+
+
+def _unchanged(crops, index):
+    #Returns TRUE for the crops found identical in the index
+    found = crops.loc[:, fields_index].reset_index().merge(index.loc[:, fields_index].drop_duplicates(), 
+                                                           on = fields_index, how = 'inner')
+    return crops.index.isin(found['index'])
+
+
+def extract(samples = None, format = 'jpg', processes = None):
+    """
+    Extracts the crops of the classified features that are new or have changed since the last run.
+
+    Parameters
+    ----------
+    samples:    Specimen ID, or list of specimen IDs. Default: all.
+    format:     'jpg' for one .jpg file per crop, 'npz' for shards of resized crops
+    processes:  Number of worker processes. Default: number of processors.
+
+    Returns
+    -------
+    n :         Number of crops written
+
+    """
+    crops = list_crops(samples)
+    index = _read_index()
+    if samples is not None:
+        #The other specimens are left as they are
+        samples = [samples] if type(samples) == str else samples
+        kept = index.loc[~index.ID_specimen.isin(samples)]
+        index = index.loc[index.ID_specimen.isin(samples)]
+    else:
+        kept = index.iloc[:0]
+    crops['shard'] = None
+    
+    #The crops of the other format are left as they are too
+    other = index.shard.notnull() if format == 'jpg' else index.shard.isnull()
+    kept = pd.concat([kept, index.loc[other]], ignore_index=True)
+    index = index.loc[~other]
+    
+    if format == 'jpg':
+        for label in set(classes.values()):
+            os.makedirs(os.path.join(out_dir, label), exist_ok=True)
         
-        im_out = im.crop((xmin, ymin, xmax, ymax))
-        filename = '{:s}.{:d}.jpg'.format(row.ID_specimen, row.incl_nb)
-        im_out.save('images/Inclusions/{:s}'.format(filename), 'JPEG')
-
-    for index, row in df.loc[df.incl_type.apply(lambda x: x in ['1', '3', '4', '5', '6'])].iterrows():
-        x = row.x
-        y = row.y
-        feret = row.feret
-        feret_min = row.min_feret
-        feret_angle = row.feret_angle
+        #Removes the files of the crops that no longer exist or changed
+        for row in index.loc[~_unchanged(index, crops)].itertuples():
+            path = os.path.join(out_dir, row.label, row.name)
+            if os.path.exists(path):
+                os.remove(path)
         
-        width = np.max([np.abs(feret*np.cos(feret_angle*np.pi/180)), feret_min])*2
-        height = np.max([np.abs(feret*np.sin(feret_angle*np.pi/180)), feret_min])*2
+        done = _unchanged(crops, index) & np.array([os.path.exists(os.path.join(out_dir, label, name)) 
+                                                    for label, name in zip(crops.label, crops.name)], dtype=bool)
+        tasks = [(_extract_jpg, (filename, part)) for filename, df in crops.loc[~done].groupby('file')
+                 for part in _split(df)]
+    
+    else:
+        os.makedirs(os.path.join(out_dir, 'shards'), exist_ok=True)
         
-        xmin = x - width/2
-        xmax = x + width/2
-        ymin = y - height/2
-        ymax = y + height/2
+        #The shards of a slice are rewritten when any of its crops changed
+        tasks = []
+        for (ID_spec, slice), df in crops.groupby(['ID_specimen', 'slice']):
+            old = index.loc[(index.ID_specimen == ID_spec) & (index.slice == slice)]
+            parts = _split(df)
+            shards = ['{:s}.{:d}'.format(database.part_key(ID_spec, slice).split('/')[-1], k) for k in range(len(parts))]
+            changed = len(old) != len(df) or not _unchanged(df, old).all() \
+                or not all(os.path.exists(os.path.join(out_dir, 'shards', shard + '.npz')) for shard in shards)
+            for part, shard in zip(parts, shards):
+                crops.loc[part.index, 'shard'] = shard
+                if changed:
+                    tasks.append((_extract_npz, (part.file.iloc[0], part, shard)))
         
-        im_out = im.crop((xmin, ymin, xmax, ymax))
-        filename = '{:s}.{:d}.jpg'.format(row.ID_specimen, row.incl_nb)
-        im_out.save('images/Other/{:s}'.format(filename), 'JPEG')
\ No newline at end of file
+        #Removes the shards no longer used
+        for shard in set(index.shard) - set(crops.shard):
+            if os.path.exists(os.path.join(out_dir, 'shards', shard + '.npz')):
+                os.remove(os.path.join(out_dir, 'shards', shard + '.npz'))
+    
+    #The tiles are converted or updated here, once per micrograph: the workers only read them
+    for filename in sorted(set(args[0] for function, args in tasks)):
+        tiles.build_tiles(filename)
+    
+    n = 0
+    if len(tasks) > 0:
+        if processes == 1:
+            for function, args in tasks:
+                n += function(*args)
+                print('Written {:d} crops'.format(n), end='\r')
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                for future in as_completed([pool.submit(function, *args) for function, args in tasks]):
+                    n += future.result()
+                    print('Written {:d} crops'.format(n), end='\r')
+        print()
+    
+    index = pd.concat([kept, crops.loc[:, fields_index + ['shard']]], ignore_index=True)
+    index.to_csv(index_file + '.tmp', index=False)
+    os.replace(index_file + '.tmp', index_file)
+    print('{:d} crops: {:d} written, {:d} unchanged.'.format(len(crops), n, len(crops) - n))
+    
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Extracts the images of the classified features.')
+    parser.add_argument('--samples', nargs = '+', help = 'Specimens to extract (default: all)')
+    parser.add_argument('--format', choices = ['jpg', 'npz'], default = 'jpg',
+                        help = 'One .jpg file per crop, or shards of resized crops (default: jpg)')
+    parser.add_argument('--processes', type = int, help = 'Number of worker processes (default: number of processors)')
+    args = parser.parse_args()
+
+    extract(args.samples, args.format, args.processes)
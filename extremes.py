@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+
+#Statistics of extremes of the sizes of the features: peaks over threshold, and block maxima.
+#The sizes of all the specimens are sorted once, in descending order within each specimen,
+#and the statistics of the k largest sizes are read from cumulative sums for all k at once:
+#the paths over k of the exponential and Hill estimators, and the mean excess function.
+#[Ref. Reiss and Thomas, Statistical Analysis of Extreme Values, chap. 5]
+#The maxima of the blocks of all the specimens and division schemes are found by a single
+#groupby, and the Gumbel laws of all the groups are fitted together. The GEV laws are
+#fitted group by group.
+#Scipy is imported only by the functions that need it.
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+
+from database import get_data
+from stats import kept_types
+
+
+def sort_groups(values, groups):
+    """
+    Sorts values in descending order within each group, in a single sort.
+
+    Parameters
+    ----------
+    values:     Array of values
+    groups:     Array of the groups of the values (ex. specimen IDs)
+
+    Returns
+    -------
+    names :     Sorted names of the groups
+    values :    Sorted values, the groups one after the other
+    starts :    Position of the first value of each group, and the number of values at the end
+    rank :      Rank of each sorted value in its group (0 for the largest)
+
+    """
+    codes, names = pd.factorize(np.asarray(groups), sort = True)
+    values = np.asarray(values, dtype=float)
+    order = np.lexsort((-values, codes))
+    starts = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength = len(names)))])
+    rank = np.arange(len(values)) - np.repeat(starts[:-1], np.diff(starts))
+    return names, values[order], starts, rank
+
+
+def exp_quantiles(df, param = 'feret', by = 'ID_specimen'):
+    """
+    Exponential probability plot of the sizes of each group: the sizes in ascending order,
+    against the exponential quantiles -ln(1-P) of their plotting positions P = i/(n+1).
+    Aligned sizes follow an exponential law above the threshold.
+
+    Parameters
+    ----------
+    df:         Dataframe of the features, with the fields <by> and <param>
+    param:      Size of the features
+    by:         Field of the groups
+
+    Returns
+    -------
+    df :        Dataframe with the fields <by>, <param>, i (rank from the smallest), P and q
+
+    """
+    names, values, starts, rank = sort_groups(df[param].values, df[by].values)
+    n = np.repeat(np.diff(starts), np.diff(starts))
+    i = n - rank
+    out = pd.DataFrame({by: np.repeat(names, np.diff(starts)), param: values, 'i': i, 'P': i/(n + 1)})
+    out['q'] = -np.log(1 - out.P)
+    return out.iloc[::-1].sort_values(by, kind='stable').reset_index(drop=True)
+
+
+def pot_paths(df, param = 'feret', by = 'ID_specimen', k_min = 1):
+    """
+    Peak-over-threshold estimators of each group, for all the numbers k of exceedances:
+    the threshold u is the (k+1)-th largest size, and the k largest sizes exceed it.
+    stats.MLE_sig_exp takes the k-th largest size as threshold instead: its value for k
+    is (k-1)/k times the sigma found here for k-1.
+
+    Parameters
+    ----------
+    df:         Dataframe of the features, with the fields <by> and <param>
+    param:      Size of the features
+    by:         Field of the groups
+    k_min:      Smallest number of exceedances
+
+    Returns
+    -------
+    paths :     Dataframe with one row per group and k, with the fields:
+                <by>, k, n (number of sizes of the group), u (threshold),
+                sigma (MLE of the scale of the exponential law of the excesses Y - u,
+                which is also the mean excess over u) and hill (Hill estimator of the
+                tail index: mean of ln(Y/u), for positive sizes)
+
+    """
+    names, values, starts, rank = sort_groups(df[param].values, df[by].values)
+    n = np.repeat(np.diff(starts), np.diff(starts))
+
+    #Sums of the k largest values of each group, and of their logarithms
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.where(values > 0, np.log(values), 0.)
+    base = np.repeat(starts[:-1], np.diff(starts))
+    total = np.cumsum(values)
+    total_log = np.cumsum(logs)
+    k = rank + 1
+    sums = total - np.concatenate([[0.], total])[base]
+    sums_log = total_log - np.concatenate([[0.], total_log])[base]
+
+    #Threshold: next value of the group
+    keep = (k >= k_min) & (k < n)
+    pos = np.flatnonzero(keep)
+    k, u = k[pos], values[pos + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hill = np.where(u > 0, sums_log[pos]/k - np.log(u), np.nan)
+    return pd.DataFrame({by: np.repeat(names, np.diff(starts))[pos], 'k': k, 'n': n[pos], 'u': u,
+                         'sigma': sums[pos]/k - u, 'hill': hill})
+
+
+def fit_gpd(df, param = 'feret', by = 'ID_specimen', k = None, u = None):
+    """
+    Fits a generalized Pareto law on the excesses over a threshold of the sizes of each group,
+    by maximum likelihood: P(Y - u > y | Y > u) = (1 + xi*y/sigma)^(-1/xi). xi = 0 is the
+    exponential law, xi > 0 a heavier tail.
+
+    Parameters
+    ----------
+    df:         Dataframe of the features, with the fields <by> and <param>
+    param:      Size of the features
+    by:         Field of the groups
+    k:          Number of exceedances of each group (the threshold is the (k+1)-th largest size)
+    u:          Threshold, used if k is not given. Default: k = 10% of the sizes of the group.
+
+    Returns
+    -------
+    fits :      Dataframe with one row per group and the fields <by>, n, k, u, xi, sigma
+
+    """
+    from scipy.stats import genpareto
+
+    names, values, starts, rank = sort_groups(df[param].values, df[by].values)
+    fits = []
+    for j, name in enumerate(names):
+        y = values[starts[j]:starts[j + 1]]
+        if k is not None:
+            k_j = min(int(k), len(y) - 1)
+            u_j = y[k_j] if k_j >= 0 else np.nan
+        elif u is not None:
+            k_j = int(np.count_nonzero(y > u))
+            u_j = u
+        else:
+            k_j = len(y)//10
+            u_j = y[k_j]
+        if k_j < 3:
+            fits.append([name, len(y), k_j, u_j, np.nan, np.nan])
+            continue
+        xi, loc, sigma = genpareto.fit(y[:k_j] - u_j, floc = 0)
+        fits.append([name, len(y), k_j, u_j, xi, sigma])
+    return pd.DataFrame(fits, columns = [by, 'n', 'k', 'u', 'xi', 'sigma'])
+
+
+def get_pot(samples = None, param = 'feret', exclude_porosity = True, k_min = 1):
+    """
+    Peak-over-threshold paths of the sizes of the inclusions of each specimen (see pot_paths).
+
+    Parameters
+    ----------
+    samples:            List of specimen IDs. Default: all.
+    param:              Size of the features: 'feret' or 'sqr_area'
+    exclude_porosity:   If TRUE, porosities are left out
+    k_min:              Smallest number of exceedances
+
+    Returns
+    -------
+    paths :             Dataframe of the paths (see pot_paths)
+
+    """
+    meta, data = get_data(samples = samples, incl_types = kept_types(exclude_porosity),
+                          columns = ['ID_specimen', param], copy = False)
+    return pot_paths(data, param, k_min = k_min)
+
+
+#Block maxima: the largest size of each division (block) of the slices, see divide() and
+#geometry.divide_schemes(). The largest inclusion expected in a larger area or volume is
+#predicted from the law of the maxima (Gumbel or GEV) [Ref. Murakami, Metal Fatigue, chap. 13]
+
+#Euler's constant, and asymptotic covariance of the Gumbel MLE (mu, beta), times n/beta^2
+euler_gamma = 0.5772156649015329
+gumbel_cov = np.array([[1 + 6*(1 - euler_gamma)**2/np.pi**2, 6*(1 - euler_gamma)/np.pi**2],
+                       [6*(1 - euler_gamma)/np.pi**2, 6/np.pi**2]])
+
+
+def block_maxima(samples = None, param = 'sqr_area', schemes = None, exclude_porosity = True):
+    """
+    Largest size of the features of each division of the slices, for one or several
+    division schemes, in a single grouped pass. Divisions without any feature, and
+    features without division (division 0), are left out.
+
+    Parameters
+    ----------
+    samples:            List of specimen IDs. Default: all.
+    param:              Size of the features: 'sqr_area' or 'feret'
+    schemes:            Name, or list of names of division schemes (see geometry.divide_schemes).
+                        Default: the field division of the data (see divide()), named 'division'.
+    exclude_porosity:   If TRUE, porosities are left out
+
+    Returns
+    -------
+    maxima :            Dataframe with one row per division and the fields scheme, ID_specimen,
+                        slice, division, max (largest size, microns) and area_mm2 (area of the division)
+
+    """
+    from database import get_divisions, get_division_schemes
+
+    if type(schemes) == str:
+        schemes = [schemes]
+    meta, data = get_data(samples = samples, incl_types = kept_types(exclude_porosity),
+                          columns = ['ID_specimen', 'slice', 'incl_nb', 'division', param])
+    meta = meta.set_index(['ID_specimen', 'slice'])
+
+    #Divisions of each scheme, and number of divisions of the slices
+    if schemes is None:
+        schemes = ['division']
+        n_divis = {'division': (meta.n_divis_x*meta.n_divis_y.where(meta.img_width >= 1, 1)).astype(float)}
+    else:
+        data = data.drop(columns = 'division')\
+            .merge(get_divisions(samples, schemes = schemes), on = ['ID_specimen', 'slice', 'incl_nb'], how = 'left')
+        desc = get_division_schemes().set_index('name')
+        n_divis = {}
+        for name in schemes:
+            if name not in desc.index:
+                print('Division scheme {:s} not found. Use divide_schemes() first.'.format(name))
+                return None
+            n_x, n_y = int(desc.n_divis_x[name]), int(desc.n_divis_y[name])
+            n_divis[name] = pd.Series(np.where(meta.img_width >= 1, n_x*n_y, n_x), index = meta.index, dtype=float)
+
+    long = data.melt(id_vars = ['ID_specimen', 'slice', param], value_vars = schemes, var_name = 'scheme', value_name = 'block')
+    long = long.loc[long.block.fillna(0) > 0]
+    maxima = long.groupby(['scheme', 'ID_specimen', 'slice', 'block'], sort = True)[param].max()\
+        .rename('max').reset_index().rename(columns = {'block': 'division'})
+    maxima['division'] = maxima.division.astype(int)
+
+    n_divis = pd.concat([counts.rename('n_divis').reset_index().assign(scheme = name) for name, counts in n_divis.items()])
+    maxima = maxima.merge(n_divis, on = ['scheme', 'ID_specimen', 'slice'], how = 'left')\
+        .merge(meta.img_area_mm2.reset_index(), on = ['ID_specimen', 'slice'], how = 'left')
+    maxima['area_mm2'] = maxima.img_area_mm2/maxima.n_divis
+    maxima = maxima.drop(columns = ['n_divis', 'img_area_mm2'])
+    return maxima
+
+
+def _codes(maxima, by):
+    #Group of each maximum, and the groups
+    groups = maxima.groupby(by, sort = True).ngroup().values
+    names = maxima.loc[:, by].drop_duplicates().sort_values(by).reset_index(drop = True)
+    return groups, names
+
+
+def fit_gumbel(x, groups, n_iter = 50, tol = 1e-10):
+    """
+    Maximum likelihood fit of Gumbel laws, P(X < x) = exp(-exp(-(x - mu)/beta)), on
+    several groups of values at once. The likelihood equation of beta is solved by Newton
+    iterations run on all the groups together (vectorized), then mu follows.
+
+    Parameters
+    ----------
+    x:          Array of values (ex. block maxima)
+    groups:     Group of each value: integers 0, 1... n_groups - 1
+    n_iter:     Largest number of iterations
+    tol:        Relative tolerance on beta
+
+    Returns
+    -------
+    mu, beta :  Arrays of the parameters of each group (NaN for groups of less than 2
+                distinct values)
+    n :         Number of values of each group
+
+    """
+    x = np.asarray(x, dtype=float)
+    groups = np.asarray(groups)
+    n_groups = groups.max() + 1 if len(groups) > 0 else 0
+    n = np.bincount(groups, minlength = n_groups).astype(float)
+
+    def sums(values):
+        return np.bincount(groups, values, minlength = n_groups)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums(x)/n
+        std = np.sqrt(np.maximum(sums(x**2)/n - mean**2, 0))
+        bottom = np.full(n_groups, np.inf)
+        np.minimum.at(bottom, groups, x)
+        shift = x - bottom[groups]                      #>= 0: the exponentials do not overflow
+        beta = np.where(std > 0, std*np.sqrt(6)/np.pi, np.nan)
+
+        #beta = mean - sum(x w)/sum(w) with w = exp(-x/beta)
+        for i in range(n_iter):
+            w = np.exp(-shift/beta[groups])
+            s0 = sums(w)
+            m1 = sums(shift*w)/s0
+            m2 = sums(shift**2*w)/s0
+            g = beta - (mean - bottom) + m1
+            step = g/(1 + (m2 - m1**2)/beta**2)
+            beta = np.maximum(beta - step, beta/10)
+            if np.all(~(np.abs(step) > tol*beta)):
+                break
+
+        mu = bottom - beta*np.log(sums(np.exp(-shift/beta[groups]))/n)
+    return mu, beta, n
+
+
+def _return_level(params, y, dist):
+    #Size of the maximum of T blocks, y = -ln(-ln(1 - 1/T)): quantile of the law of the maxima
+    mu, sigma = params[0], params[1]
+    if dist == 'gumbel' or params[2] == 0:
+        return mu + sigma*y
+    xi = params[2]
+    return mu + sigma*(np.exp(xi*y) - 1)/xi
+
+
+def _hessian(f, theta):
+    #Hessian of a function of a few parameters, by central differences
+    theta = np.asarray(theta, dtype=float)
+    h = 1e-4*np.maximum(np.abs(theta), 1e-2)
+    H = np.zeros((len(theta), len(theta)))
+    for i in range(len(theta)):
+        for j in range(len(theta)):
+            e_i = np.eye(len(theta))[i]*h[i]
+            e_j = np.eye(len(theta))[j]*h[j]
+            H[i, j] = (f(theta + e_i + e_j) - f(theta + e_i - e_j) - f(theta - e_i + e_j) + f(theta - e_i - e_j))/(4*h[i]*h[j])
+    return H
+
+
+def fit_block_maxima(maxima, dist = 'gumbel', area = None, volume = None, level = 0.95, by = ['scheme', 'ID_specimen']):
+    """
+    Fits the law of the block maxima of each specimen (all its slices together) and each
+    division scheme, by maximum likelihood, and predicts the largest size expected in a
+    target area or volume, with its confidence interval (delta method).
+    The target is T times the block: T = area/area of a block, or, for a volume, T = volume/V0
+    with V0 = h*S0, S0 the area of a block and h the mean of the maxima [Murakami].
+    The Gumbel laws of all the groups are fitted together (see fit_gumbel). The GEV laws are
+    fitted one group at a time, by scipy's optimizer, and their covariance is taken from a
+    numerical Hessian: with hundreds of groups, much slower than the Gumbel fit.
+
+    Parameters
+    ----------
+    maxima:     Dataframe of block maxima (see block_maxima)
+    dist:       'gumbel', or 'gev' (generalized extreme value law, shape xi; xi = 0 is Gumbel)
+    area:       Target area (mm2)
+    volume:     Target volume (mm3), used if area is not given
+    level:      Confidence level
+    by:         Fields of the groups fitted separately
+
+    Returns
+    -------
+    fits :      Dataframe with one row per group and the fields <by>, n (number of blocks),
+                area_mm2 (mean area of a block), mu, sigma (scale, beta of the Gumbel law),
+                xi (0 for Gumbel), their standard errors se_mu, se_sigma, se_xi, and if a target
+                is given, T, x_max (largest size expected, microns) and x_low, x_high (interval)
+
+    """
+    from scipy.stats import norm
+
+    groups, fits = _codes(maxima, by)
+    x = maxima['max'].values.astype(float)
+    n = np.bincount(groups, minlength = len(fits)).astype(float)
+    fits['n'] = n.astype(int)
+    fits['area_mm2'] = np.bincount(groups, maxima.area_mm2.values, minlength = len(fits))/n
+
+    #Number of blocks in the target
+    if area is not None:
+        T = area/fits.area_mm2.values
+    elif volume is not None:
+        h = np.bincount(groups, x, minlength = len(fits))/n/1000
+        T = volume/(h*fits.area_mm2.values)
+    else:
+        T = None
+    if T is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = -np.log(-np.log1p(-1/T))
+
+    cov = np.full((len(fits), 3, 3), np.nan)
+    if dist == 'gumbel':
+        mu, sigma, n = fit_gumbel(x, groups)
+        xi = np.zeros(len(fits))
+        cov[:, :2, :2] = gumbel_cov*(sigma**2/n)[:, None, None]
+        cov[:, 2, :] = 0
+        cov[:, :, 2] = 0
+    else:
+        from scipy.stats import genextreme
+
+        mu = np.full(len(fits), np.nan)
+        sigma = np.full(len(fits), np.nan)
+        xi = np.full(len(fits), np.nan)
+        order = np.argsort(groups, kind = 'stable')
+        starts = np.concatenate([[0], np.cumsum(n.astype(int))])
+        for j in range(len(fits)):
+            xj = x[order[starts[j]:starts[j + 1]]]
+            if len(xj) < 3 or np.ptp(xj) == 0:
+                continue
+            c, mu[j], sigma[j] = genextreme.fit(xj)
+            xi[j] = -c                                  #Scipy's shape is -xi
+            nll = lambda p: genextreme.nnlf((-p[2], p[0], p[1]), xj)
+            with np.errstate(all='ignore'):
+                H = _hessian(nll, [mu[j], sigma[j], xi[j]])
+                if np.all(np.isfinite(H)) and np.linalg.det(H) > 0:
+                    cov[j] = np.linalg.inv(H)
+
+    fits['mu'] = mu
+    fits['sigma'] = sigma
+    fits['xi'] = xi
+    with np.errstate(invalid='ignore'):
+        for i, name in enumerate(['mu', 'sigma', 'xi']):
+            fits['se_' + name] = np.sqrt(cov[:, i, i])
+
+    if T is not None:
+        z = norm.ppf(0.5 + level/2)
+        x_max = np.full(len(fits), np.nan)
+        se = np.full(len(fits), np.nan)
+        for j in range(len(fits)):
+            p = np.array([mu[j], sigma[j], xi[j]])
+            x_max[j] = _return_level(p, y[j], dist)
+            #Gradient of the return level in (mu, sigma, xi), by central differences for xi
+            grad = np.array([1., (x_max[j] - mu[j])/sigma[j], 0.])
+            if dist != 'gumbel':
+                d = 1e-5
+                grad[2] = (_return_level(p + [0, 0, d], y[j], dist) - _return_level(p - [0, 0, d], y[j], dist))/(2*d)
+            se[j] = np.sqrt(grad @ cov[j] @ grad) if np.all(np.isfinite(cov[j])) else np.nan
+        fits['T'] = T
+        fits['x_max'] = x_max
+        fits['x_low'] = x_max - z*se
+        fits['x_high'] = x_max + z*se
+    return fits
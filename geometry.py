@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+#Geometry of the specimens: polar coordinates of the features of circular specimens,
+#division of the slices in blocks, and points inside polygons.
+#The functions work on whole columns at once, so they can be used on any number of slices.
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+
+
+def polar_coords(x, y, x_c, y_c):
+    """
+    Converts cartesian coordinates to polar coordinates relative to a center.
+    Works on scalars as well as on arrays or columns, and the center can be
+    different for every point.
+
+    Parameters
+    ----------
+    x, y:       Coordinates of the points
+    x_c, y_c:   Coordinates of the center
+
+    Returns
+    -------
+    r :         Radial coordinate
+    theta :     Azimutal coordinate. 0 <= theta < 2*pi
+
+    """
+    dx = np.subtract(x, x_c)
+    dy = np.subtract(y, y_c)
+    r = np.hypot(dx, dy)
+    theta = np.mod(np.arctan2(dy, dx), 2*np.pi)
+    #A tiny negative angle is rounded up to 2*pi by the modulo, it is set back to 0
+    theta = np.where(theta >= 2*np.pi, 0., theta)
+
+    if np.ndim(theta) == 0:
+        return float(r), float(theta)
+    if isinstance(dx, pd.Series):
+        return r, pd.Series(theta, index=dx.index)
+    return r, theta
+
+
+def set_polar(data, meta):
+    """
+    Calculates the polar coordinates of the features of several slices in a single pass,
+    each slice with its own center as recorded in the metadata.
+    The features of the slices with no center keep their coordinates.
+
+    Parameters
+    ----------
+    data:   Data of one or several slices
+    meta:   Metadata, including the slices in data
+
+    Returns
+    -------
+    data :  Copy of the data, with updated fields r and theta
+
+    """
+    data = data.copy()
+    centers = meta.set_index(['ID_specimen', 'slice']).loc[:, ['x_c', 'y_c']]
+    centers = centers.reindex(pd.MultiIndex.from_arrays([data.ID_specimen, data.slice.astype(int)]))
+    known = (centers.x_c.notnull() & centers.y_c.notnull()).values
+
+    r, theta = polar_coords(data.x.values[known], data.y.values[known],
+                            centers.x_c.values[known], centers.y_c.values[known])
+    data.loc[known, 'r'] = r
+    data.loc[known, 'theta'] = theta
+
+    return data
+
+
+def recompute_polar(samples = None, slices = None, centers = None):
+    """
+    Recalculates the polar coordinates of the features of all the slices that have a
+    center defined in the metadata (circular specimens), or only of some of them.
+    Only the slices recalculated are rewritten in the database.
+    No confirmation is asked to the user.
+
+    Parameters
+    ----------
+    samples:    Specimen ID, or list of specimen IDs. Default: all.
+    slices:     Slice number, or list of slice numbers. Default: all.
+    centers:    Dictionary {(ID_specimen, slice): (x_c, y_c)} of new centers, written
+                in the metadata before the calculation. Only these slices are recalculated
+                if samples and slices are not specified.
+
+    Returns
+    -------
+    n :         Number of slices recalculated
+
+    """
+    #Imported here, the database module uses the functions above
+    from database import get_meta, get_data, save_slices, logger
+
+    meta = get_meta()
+    if centers is not None:
+        for (ID_spec, slice), (x_c, y_c) in centers.items():
+            row = (meta.ID_specimen == ID_spec) & (meta.slice == slice)
+            meta.loc[row, 'x_c'] = x_c
+            meta.loc[row, 'y_c'] = y_c
+
+    #Slices selected having a center
+    if type(samples) == str:
+        samples = [samples]
+    if slices is not None and np.ndim(slices) == 0:
+        slices = [slices]
+    selected = meta.x_c.notnull() & meta.y_c.notnull()
+    if samples is not None:
+        selected &= meta.ID_specimen.isin(samples)
+    if slices is not None:
+        selected &= meta.slice.isin(slices)
+    if centers is not None and samples is None and slices is None:
+        selected &= meta.set_index(['ID_specimen', 'slice']).index.isin(list(centers))
+    indexes = list(zip(meta.loc[selected].ID_specimen, meta.loc[selected].slice.astype(int)))
+    if len(indexes) == 0:
+        return 0
+
+    data = get_data(samples = sorted(set(index[0] for index in indexes)),
+                    slices = sorted(set(index[1] for index in indexes)))[1]
+    data = data.loc[data.set_index(['ID_specimen', 'slice']).index.isin(indexes)]
+    data = set_polar(data, meta)
+
+    parts = {(ID_spec, int(slice)): df for (ID_spec, slice), df in data.groupby(['ID_specimen', 'slice'])}
+    if save_slices(meta, parts) == False:      #The metadata, with the new centers, is written as well
+        return 0
+    logger(['Polar coordinates recalculated: Sample {:s}, slice {:d}.'.format(ID_spec, slice)
+            for ID_spec, slice in sorted(parts)])
+
+    return len(parts)
+
+
+def division_numbers(data, meta, n_divis_x, n_divis_y = 1):
+    """
+    Calculates the division (block) of the features of several slices in a single pass.
+    Rectangular slices are cut in a grid of n_divis_x by n_divis_y blocks spanning the
+    features of the slice, numbered 1, 2... row by row. Circular slices (img_width = 0)
+    are cut in n_divis_x angular sectors, numbered 1, 2... from theta = 0.
+    Features with no polar coordinates in a circular slice get division 0.
+
+    Parameters
+    ----------
+    data:       Data of one or several slices, with at least the fields ID_specimen, slice, x, y, theta
+    meta:       Metadata, including the slices in data
+    n_divis_x:  Number of divisions in x, or of angular sectors
+    n_divis_y:  Number of divisions in y
+
+    Returns
+    -------
+    division :  Array of division numbers, aligned with data
+
+    """
+    slices = [data.ID_specimen, data.slice.astype(int)]
+    widths = meta.set_index(['ID_specimen', 'slice']).img_width
+    circ = (widths.reindex(pd.MultiIndex.from_arrays(slices)) < 1).values
+
+    #Blocks of rectangular slices, slightly larger than the extent of the features (as divide())
+    x = data.x.values
+    y = data.y.values
+    x_min = data.x.groupby(slices).transform('min').values
+    y_min = data.y.groupby(slices).transform('min').values
+    div_width = (data.x.groupby(slices).transform('max').values - x_min)/n_divis_x*1.01
+    div_height = (data.y.groupby(slices).transform('max').values - y_min)/n_divis_y*1.01
+    with np.errstate(divide='ignore', invalid='ignore'):
+        div_x = np.nan_to_num(np.floor_divide(x - x_min, div_width))
+        div_y = np.nan_to_num(np.floor_divide(y - y_min, div_height))
+    rect = div_x + 1 + div_y*n_divis_x
+
+    #Sectors of circular slices
+    theta = data.theta.values.astype(float)
+    sector = np.minimum(np.floor_divide(np.nan_to_num(theta, nan=-1.), 2*np.pi/n_divis_x), n_divis_x - 1) + 1
+
+    division = np.where(circ, sector, rect)
+    return division.astype('int32')
+
+
+def divide_schemes(schemes, samples = None):
+    """
+    Stores one or several division schemes, computed for all the slices in a single pass.
+    Used to sweep block sizes in block maxima analysis. The division numbers are read
+    with database.get_divisions(). The field division of the data (see divide()) is not changed.
+    No confirmation is asked to the user.
+
+    Parameters
+    ----------
+    schemes:    Dictionary {name: (n_divis_x, n_divis_y)}, or list of (n_divis_x, n_divis_y),
+                named 'g<n_divis_x>x<n_divis_y>'. For circular specimens, n_divis_x is the
+                number of angular sectors and n_divis_y is ignored.
+    samples:    Specimen ID, or list of specimen IDs. Default: all.
+
+    Returns
+    -------
+    ok:         TRUE if the database was updated
+
+    """
+    #Imported here, the database module uses the functions above
+    from database import get_data, save_divisions, logger
+
+    if type(schemes) != dict:
+        schemes = {'g{:d}x{:d}'.format(n_x, n_y): (n_x, n_y) for n_x, n_y in schemes}
+    for name, (n_x, n_y) in schemes.items():
+        if int(n_x) < 1 or int(n_y) < 1:
+            print('Scheme {:s}: enter non-null positive integers'.format(name))
+            return False
+
+    meta, data = get_data(samples = samples, columns = ['ID_specimen', 'slice', 'incl_nb', 'x', 'y', 'theta'])
+    if len(data) == 0:
+        print('No data')
+        return False
+
+    for name, (n_x, n_y) in schemes.items():
+        data[name] = division_numbers(data, meta, int(n_x), int(n_y))
+
+    parts = {(ID_spec, int(slice)): df for (ID_spec, slice), df in data.groupby(['ID_specimen', 'slice'])}
+    desc = pd.DataFrame([{'name': name, 'n_divis_x': int(n_x), 'n_divis_y': int(n_y)} for name, (n_x, n_y) in schemes.items()])
+    if save_divisions(desc, parts) == False:
+        return False
+    logger(['Division scheme {:s}: ({:d}, {:d}) divisions on {:d} slices.'.format(name, int(n_x), int(n_y), len(parts))
+            for name, (n_x, n_y) in schemes.items()])
+
+    return True
+
+
+def points_in_polygon(x, y, xs, ys):
+    """
+    Tells which points are inside a polygon, by the even-odd rule: a point is inside if
+    a ray starting from it crosses the edges of the polygon an odd number of times.
+    The edges are tested one after the other, on all the points at once.
+
+    Parameters
+    ----------
+    x, y:       Coordinates of the points
+    xs, ys:     Coordinates of the vertices of the polygon, in order. The polygon is closed
+                by joining the last vertex to the first one.
+
+    Returns
+    -------
+    inside :    Boolean array, aligned with the points
+
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    inside = np.zeros(x.shape, dtype=bool)
+    for x1, y1, x2, y2 in zip(xs, ys, np.roll(xs, -1), np.roll(ys, -1)):
+        #Edges crossing the horizontal line through the point, on the right of the point
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (y - y1)*(x2 - x1)/(y2 - y1)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def crop_boxes(data, scale = 2):
+    """
+    Calculates the boxes used to view or crop the features: rectangles centered on the
+    features, twice as large as the projections of the feret diameter (at least twice the
+    minimum feret diameter).
+
+    Parameters
+    ----------
+    data:   Data, with at least the fields x, y, feret, min_feret, feret_angle
+    scale:  Size of the box relative to the feature
+
+    Returns
+    -------
+    boxes : Dataframe with the fields xmin, ymin, xmax, ymax, aligned with data
+
+    """
+    angle = data.feret_angle.values.astype(float)*np.pi/180
+    feret = data.feret.values
+    feret_min = data.min_feret.values
+    width = np.maximum(np.abs(feret*np.cos(angle)), feret_min)*scale
+    height = np.maximum(np.abs(feret*np.sin(angle)), feret_min)*scale
+
+    return pd.DataFrame({'xmin': data.x.values - width/2, 'ymin': data.y.values - height/2,
+                         'xmax': data.x.values + width/2, 'ymax': data.y.values + height/2}, index = data.index)
@@ -29,6 +29,24 @@ for heat in heats:
             name_dict['{:s}-{:d} {:d}ac'.format(heat, bar, cut)] = '{:s}-{:s} {:d}ac'.format(heat, roman_bars[bar], cut)
 
 
+xlim=[2,100]
+
+#Density curves of all the samples, calculated in one pass per range and parameters 
+#the first time they are needed (and cached, see get_dens_many)
+all_samples = commercial_samples + ht_samples + ac_samples
+curves = {}
+
+def dens(sample, xlim = xlim, param = 'feret', weighted = False):
+    #Density curve of a sample, as returned by get_dens
+    key = (tuple(xlim), param, weighted)
+    if key not in curves:
+        x, Y = analysis.get_dens_many(all_samples, param = param, xlim = xlim, weighted = weighted)
+        curves[key] = (x, dict(zip(all_samples, Y)))
+    x, Y = curves[key]
+    if sample not in Y:
+        Y[sample] = analysis.get_dens(sample, param = param, xlim = xlim, weighted = weighted)[1]
+    return x, Y[sample]
+
 
 #Density of inclusion per sample            
 fig1 = analysis.dens_per_sample(commercial_samples)
@@ -51,15 +69,15 @@ for heat in heats:
         colors = ['C0', 'C1']
         for k in range(len(cuts)):
             sample = bar_ID + ' {:d}ht'.format(cuts[k])
-            x, y = analysis.get_dens(sample, xlim=xlim)
+            x, y = dens(sample, xlim=xlim)
             ax[i, j].semilogx(x, y, label = '{:d}ht'.format(cuts[k]), color = colors[k], linestyle = 'solid')
             
             sample = bar_ID + ' {:d}ac'.format(cuts[k])
-            x, y = analysis.get_dens(sample, xlim=xlim)
+            x, y = dens(sample, xlim=xlim)
             ax[i, j].semilogx(x, y, label = '{:d}ac'.format(cuts[k]), color = colors[k], linestyle = 'dashed')
             
             sample = bar_ID + ' {:d}ac'.format(cut)
-            x, y = analysis.get_dens(sample, xlim=xlim)
+            x, y = dens(sample, xlim=xlim)
             ax[i, j].semilogx(x, y, label = '{:d}ht'.format(cut))
             
         ax[i, j].set_xlabel('Feret diameter (\si{\micro\metre})')
@@ -90,11 +108,11 @@ for heat in heats:
         colors = ['C0', 'C1']
         for k in range(len(cuts)):
             sample = bar_ID + ' {:d}ht'.format(cuts[k])
-            x, y = analysis.get_dens(sample, xlim=xlim, weighted=True)
+            x, y = dens(sample, xlim=xlim, weighted=True)
             ax[i, j].semilogx(x, y, label = '{:d}ht'.format(cuts[k]), color = colors[k], linestyle = 'solid')
             
             sample = bar_ID + ' {:d}ac'.format(cuts[k])
-            x, y = analysis.get_dens(sample, xlim=xlim, weighted=True)
+            x, y = dens(sample, xlim=xlim, weighted=True)
             ax[i, j].semilogx(x, y, label = '{:d}ac'.format(cuts[k]), color = colors[k], linestyle = 'dashed')
             
         ax[i, j].set_xlabel('Feret diameter (\si{\micro\metre})')
@@ -113,9 +131,9 @@ for heat in heats:
 #Average distribution per sample - commercial samples
 fig4, ax = plt.subplots(1, 2)
 for sample in commercial_samples:
-    x, y = analysis.get_dens(sample, xlim = xlim)
+    x, y = dens(sample, xlim = xlim)
     ax[0].semilogx(x, y, label = name_dict[sample])
-    x2, y2 = analysis.get_dens(sample, xlim = xlim, weighted=True)
+    x2, y2 = dens(sample, xlim = xlim, weighted=True)
     ax[1].semilogx(x2, y2, label = name_dict[sample])
 
 ax[0].set_xlim(xlim)
@@ -139,13 +157,13 @@ for heat in heats:
         for cut in cuts:
             samples.append(bar_ID + ' {:d}ht'.format(cut))
         
-        x, y1 = analysis.get_dens(samples[0], xlim=xlim)
-        x, y2 = analysis.get_dens(samples[1], xlim=xlim)
+        x, y1 = dens(samples[0], xlim=xlim)
+        x, y2 = dens(samples[1], xlim=xlim)
         y = (y1 + y2)/2
         ax[0].semilogx(x, y, label = '{:s}-{:s}'.format(heat, roman_bars[bar]))
         
-        x, y1 = analysis.get_dens(samples[0], xlim=xlim, weighted=True)
-        x, y2 = analysis.get_dens(samples[1], xlim=xlim, weighted=True)
+        x, y1 = dens(samples[0], xlim=xlim, weighted=True)
+        x, y2 = dens(samples[1], xlim=xlim, weighted=True)
         y = (y1 + y2)/2
         ax[1].semilogx(x, y, label = '{:s}-{:s}'.format(heat, roman_bars[bar]))
 
@@ -169,13 +187,13 @@ for heat in heats:
         for cut in cuts:
             samples.append(bar_ID + ' {:d}ac'.format(cut))
         
-        x, y1 = analysis.get_dens(samples[0], xlim=xlim)
-        x, y2 = analysis.get_dens(samples[1], xlim=xlim)
+        x, y1 = dens(samples[0], xlim=xlim)
+        x, y2 = dens(samples[1], xlim=xlim)
         y = (y1 + y2)/2
         ax[0].semilogx(x, y, label = '{:s}-{:s}'.format(heat, roman_bars[bar]))
         
-        x, y1 = analysis.get_dens(samples[0], xlim=xlim, weighted=True)
-        x, y2 = analysis.get_dens(samples[1], xlim=xlim, weighted=True)
+        x, y1 = dens(samples[0], xlim=xlim, weighted=True)
+        x, y2 = dens(samples[1], xlim=xlim, weighted=True)
         y = (y1 + y2)/2
         ax[1].semilogx(x, y, label = '{:s}-{:s}'.format(heat, roman_bars[bar]))
 
@@ -200,13 +218,13 @@ for heat in heats:
         for cut in cuts:
             samples.append(bar_ID + ' {:d}ac'.format(cut))
         
-        x, y1 = analysis.get_dens(samples[0], xlim=xlim, param='sqr_area')
-        x, y2 = analysis.get_dens(samples[1], xlim=xlim, param='sqr_area')
+        x, y1 = dens(samples[0], xlim=xlim, param='sqr_area')
+        x, y2 = dens(samples[1], xlim=xlim, param='sqr_area')
         y = (y1 + y2)/2
         ax[0].semilogx(x, y, label = '{:s}-{:s}'.format(heat, roman_bars[bar]))
         
-        x, y1 = analysis.get_dens(samples[0], xlim=xlim, weighted=True, param='sqr_area')
-        x, y2 = analysis.get_dens(samples[1], xlim=xlim, weighted=True, param='sqr_area')
+        x, y1 = dens(samples[0], xlim=xlim, weighted=True, param='sqr_area')
+        x, y2 = dens(samples[1], xlim=xlim, weighted=True, param='sqr_area')
         y = (y1 + y2)/2
         ax[1].semilogx(x, y, label = '{:s}-{:s}'.format(heat, roman_bars[bar]))
 
@@ -224,9 +242,9 @@ ax[1].set_title('Inclusion area')
 #Average distribution per sample - commercial samples
 fig8, ax = plt.subplots(1, 2)
 for sample in commercial_samples:
-    x, y = analysis.get_dens(sample, xlim = xlim, param = 'sqr_area')
+    x, y = dens(sample, xlim = xlim, param = 'sqr_area')
     ax[0].semilogx(x, y, label = name_dict[sample])
-    x2, y2 = analysis.get_dens(sample, xlim = xlim, weighted=True, param='sqr_area')
+    x2, y2 = dens(sample, xlim = xlim, weighted=True, param='sqr_area')
     ax[1].semilogx(x2, y2, label = name_dict[sample])
 
 ax[0].set_xlim(xlim)
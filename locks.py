@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+#Locks on files, held by the operating system. A lock is released when the file is closed,
+#and also when the process holding it dies, so a session that crashed never blocks the others.
+#Used to coordinate the sessions working on the same database (see database.py).
+
+#Commonly used libraries
+import os
+import time
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+#Windows locks a range of bytes, which other processes can then not read: a byte far
+#beyond the end of the file is locked, so the content of the file stays readable.
+_offset = 1 << 30
+
+
+def try_lock(file):
+    """
+    Locks an open file, without waiting.
+
+    Parameters
+    ----------
+    file:   Open file object
+
+    Returns
+    -------
+    ok:     TRUE if the lock was obtained, FALSE if another process (or another
+            open file object of this process) holds it
+
+    """
+    try:
+        if os.name == 'nt':
+            file.seek(_offset)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def lock(file, message = None, delay = 0.05):
+    """
+    Locks an open file, waiting as long as another process holds the lock.
+
+    Parameters
+    ----------
+    file:       Open file object
+    message:    Printed if the lock is not obtained at once
+    delay:      Time between two attempts on Windows (s)
+
+    Returns
+    -------
+    Nothing
+
+    """
+    if try_lock(file) == True:
+        return
+    if message is not None:
+        print(message)
+    
+    if os.name == 'nt':
+        while try_lock(file) == False:
+            time.sleep(delay)
+    else:
+        #Waits in the kernel, which wakes up the process when the lock is released
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+
+def unlock(file):
+    """
+    Releases the lock of an open file.
+    """
+    if os.name == 'nt':
+        file.seek(_offset)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+#Comparison of two acquisitions of the same slice, before and after pitting (corrosion):
+#the features of the two acquisitions are registered, paired, and tagged as unchanged,
+#grown (pits grown from inclusions), appeared (new pits) or vanished (dissolved inclusions).
+#The acquisitions are imported as two slices, for example slice 1 before and slice 2 after,
+#or under two specimen IDs.
+#Registration: the displacement between the acquisitions is found by voting over the pairs
+#of the largest features of similar size (and over a few angles if the specimen may have
+#turned), then refined by iterative closest points (ICP) on a sample of the features,
+#with a rigid (rotation and translation, Kabsch) or affine transform.
+#The neighbours are searched with KD-trees (scipy.spatial.cKDTree), so slices with millions
+#of features are compared in seconds.
+#
+#Usage, from the command line:    python pitting.py ID_before slice_before ID_after slice_after [output.csv]
+#or in Python:                    pitting.compare(('A', 1), ('A', 2))
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+import sys
+
+from database import get_data
+from stats import kept_types
+
+#Number of the largest features of each acquisition voting for the displacement
+n_vote = 500
+
+#Largest ratio of the areas of the two features of a voting pair
+vote_area_ratio = 2.
+
+#Largest number of features of each acquisition used by the ICP
+n_icp = 20000
+
+#Fields of the features read for the comparison
+fields_pitting = ['incl_nb', 'x', 'y', 'area', 'feret']
+
+
+def read_features(ID_spec, slice, incl_types = None):
+    """
+    Returns the features of a slice compared by compare().
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+    incl_types: Types of features kept. Default: all but artifacts and out-of-bounds.
+
+    Returns
+    -------
+    df :        Dataframe with the fields incl_nb, x, y, area, feret
+
+    """
+    meta, df = get_data(samples = [ID_spec], slices = [slice],
+                        incl_types = kept_types(False) if incl_types is None else incl_types,
+                        columns = ['ID_specimen', 'slice'] + fields_pitting)
+    return df.loc[:, fields_pitting].reset_index(drop=True)
+
+
+def apply_transform(T, x, y):
+    """
+    Applies a 2D transform to points.
+
+    Parameters
+    ----------
+    T:          Matrix 2x3 [A | t]: the point p goes to A p + t
+    x, y:       Coordinates of the points
+
+    Returns
+    -------
+    x, y :      Transformed coordinates
+
+    """
+    return T[0, 0]*x + T[0, 1]*y + T[0, 2], T[1, 0]*x + T[1, 1]*y + T[1, 2]
+
+
+def fit_transform(p, q, model = 'rigid'):
+    """
+    Least squares transform taking the points p to the points q.
+
+    Parameters
+    ----------
+    p, q:       Arrays n x 2 of paired points
+    model:      'rigid' (rotation and translation, Kabsch algorithm) or 'affine'
+
+    Returns
+    -------
+    T :         Matrix 2x3 (see apply_transform)
+
+    """
+    if model == 'affine':
+        A = np.column_stack([p, np.ones(len(p))])
+        return np.linalg.lstsq(A, q, rcond = None)[0].T
+
+    p_mean = p.mean(axis = 0)
+    q_mean = q.mean(axis = 0)
+    U, S, Vt = np.linalg.svd((p - p_mean).T @ (q - q_mean))
+    if np.linalg.det(Vt.T @ U.T) < 0:                  #No reflection
+        Vt[-1] *= -1
+    R = Vt.T @ U.T
+    return np.column_stack([R, q_mean - R @ p_mean])
+
+
+def vote_displacement(before, after, max_angle = 0.):
+    """
+    Coarse registration: each pair of one of the largest features before and one of the
+    largest features after, of similar areas, votes for the displacement between them.
+    The true displacement gets the votes of all the features present in both acquisitions.
+
+    Parameters
+    ----------
+    before:     Features before (fields x, y, area)
+    after:      Features after
+    max_angle:  Largest rotation between the acquisitions (degrees). 0: translation only.
+
+    Returns
+    -------
+    T :         Matrix 2x3 of the transform from before to after (see apply_transform)
+    votes :     Number of votes of the transform
+    size :      Size of the bins of the votes: accuracy of the displacement (microns)
+
+    """
+    from scipy.spatial import cKDTree
+
+    b = before.nlargest(min(n_vote, len(before)), 'area')
+    a = after.nlargest(min(n_vote, len(after)), 'area')
+
+    #Size of the bins of the displacements: half the typical distance between the voting features
+    d, j = cKDTree(np.column_stack([b.x, b.y])).query(np.column_stack([b.x, b.y]), k = [2])
+    size = max(0.5*float(np.median(d)), 1e-6)
+    extent = max(np.ptp(b.x.values), np.ptp(b.y.values), size)
+    step = np.degrees(size/extent)
+    angles = [0.] if max_angle <= 0 else np.arange(-max_angle, max_angle + step/2, step)
+
+    similar = np.abs(np.log(np.maximum(a.area.values, 1e-12))[None, :] - np.log(np.maximum(b.area.values, 1e-12))[:, None]) <= np.log(vote_area_ratio)
+    best = (-1, None)
+    for angle in angles:
+        c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+        bx = c*b.x.values - s*b.y.values
+        by = s*b.x.values + c*b.y.values
+        dx = (a.x.values[None, :] - bx[:, None])[similar]
+        dy = (a.y.values[None, :] - by[:, None])[similar]
+        if len(dx) == 0:
+            continue
+        kx = np.floor(dx/size).astype('int64')
+        ky = np.floor(dy/size).astype('int64')
+        kx0, ky0 = kx.min(), ky.min()
+        n_y = ky.max() - ky0 + 1
+        keys, counts = np.unique((kx - kx0)*n_y + ky - ky0, return_counts = True)
+        peak = np.argmax(counts)
+        if counts[peak] > best[0]:
+            #Displacement refined by the mean of the votes around the peak
+            center = (np.array([kx0 + keys[peak]//n_y, ky0 + keys[peak] % n_y]) + 0.5)*size
+            near = (np.abs(dx - center[0]) <= 1.5*size) & (np.abs(dy - center[1]) <= 1.5*size)
+            best = (int(counts[peak]), np.array([[c, -s, dx[near].mean()], [s, c, dy[near].mean()]]))
+    return best[1], best[0], size
+
+
+def register(before, after, model = 'rigid', max_angle = 0., n_iter = 30):
+    """
+    Registration of the acquisition after on the acquisition before: coarse displacement
+    by voting (see vote_displacement), refined by iterative closest points. At each iteration
+    the features before are paired with their nearest feature after, the pairs farther
+    apart than 3 times the RMS distance are left out, and the transform is fitted again.
+    The ICP starts on the n_vote largest features of each acquisition, and goes on with 4 times
+    more features at a time, up to n_icp.
+
+    Parameters
+    ----------
+    before:     Features before (fields x, y, area)
+    after:      Features after
+    model:      'rigid' or 'affine'
+    max_angle:  Largest rotation between the acquisitions (degrees)
+    n_iter:     Largest number of iterations
+
+    Returns
+    -------
+    T :         Matrix 2x3 of the transform from before to after (see apply_transform)
+    rms :       RMS distance of the pairs kept (microns)
+    n_pairs :   Number of pairs kept
+
+    """
+    from scipy.spatial import cKDTree
+
+    T, votes, size = vote_displacement(before, after, max_angle)
+    if T is None:
+        return None, np.nan, 0
+
+    #From the largest features to n_icp features: the sets of the largest features before
+    #and after are sparse and correspond, so the first pairs are right
+    gate = 2*size                       #Accuracy of the votes
+    rms = np.nan
+    n_pairs = 0
+    n = n_vote
+    while True:
+        n = min(n, n_icp)
+        p = before.nlargest(min(n, len(before)), 'area').loc[:, ['x', 'y']].values
+        tree = cKDTree(after.nlargest(min(n, len(after)), 'area').loc[:, ['x', 'y']].values)
+        for i in range(n_iter):
+            px, py = apply_transform(T, p[:, 0], p[:, 1])
+            d, j = tree.query(np.column_stack([px, py]), distance_upper_bound = gate, workers = -1)
+            kept = np.isfinite(d)
+            if np.count_nonzero(kept) < 3:
+                break
+            T_new = fit_transform(p[kept], tree.data[j[kept]], model)
+            rms = float(np.sqrt(np.mean(d[kept]**2)))
+            n_pairs = int(np.count_nonzero(kept))
+            done = np.abs(T_new - T).max() < 1e-9*max(1., np.abs(T).max())
+            T = T_new
+            gate = max(3*rms, 1e-6)
+            if done:
+                break
+        if n >= n_icp or n >= max(len(before), len(after)):
+            break
+        n *= 4
+    return T, rms, n_pairs
+
+
+def match(before, after, T, tol, growth = 0.2):
+    """
+    Pairs the features of two registered acquisitions and tags them (see compare).
+
+    Parameters
+    ----------
+    before:     Features before (fields incl_nb, x, y, area, feret)
+    after:      Features after
+    T:          Matrix 2x3 of the transform from before to after (see apply_transform)
+    tol:        Distance of paired features (microns)
+    growth:     Relative growth of the area of a grown feature
+
+    Returns
+    -------
+    pairs :     Dataframe of the pairs and unpaired features (see compare)
+
+    """
+    from scipy.spatial import cKDTree
+
+    b, a = before, after
+
+    #Each feature before is paired with its nearest feature after, and each feature after
+    #keeps the nearest of the features before paired with it
+    bx, by = apply_transform(T, b.x.values, b.y.values)
+    pa = a.loc[:, ['x', 'y']].values
+    d_ba, j_ba = cKDTree(pa, balanced_tree = False, compact_nodes = False).query(np.column_stack([bx, by]), workers = -1)
+    near = d_ba <= tol + 0.5*a.feret.values[j_ba]
+    order = np.lexsort((d_ba, j_ba))
+    order = order[near[order]]
+    first = np.concatenate([[True], j_ba[order][1:] != j_ba[order][:-1]]) if len(order) > 0 else np.zeros(0, dtype=bool)
+    i_b = np.sort(order[first])
+    i_a = j_ba[i_b]
+    paired = np.zeros(len(b), dtype=bool)
+    paired[i_b] = True
+    alone_b = np.flatnonzero(~paired)
+    alone_a = np.ones(len(a), dtype=bool)
+    alone_a[i_a] = False
+    alone_a = np.flatnonzero(alone_a)
+
+    #Features after brought back in the frame before
+    A_inv = np.linalg.inv(T[:, :2])
+    back = (pa[alone_a] - T[:, 2]) @ A_inv.T
+
+    grown = a.area.values[i_a] > b.area.values[i_b]*(1 + growth)
+    pairs = pd.concat([
+        pd.DataFrame({'status': np.where(grown, 'grown', 'unchanged'), 'incl_nb_before': b.incl_nb.values[i_b],
+                      'incl_nb_after': a.incl_nb.values[i_a], 'x': b.x.values[i_b], 'y': b.y.values[i_b],
+                      'area_before': b.area.values[i_b], 'area_after': a.area.values[i_a], 'dist': d_ba[i_b]}),
+        pd.DataFrame({'status': 'vanished', 'incl_nb_before': b.incl_nb.values[alone_b], 'incl_nb_after': -1,
+                      'x': b.x.values[alone_b], 'y': b.y.values[alone_b],
+                      'area_before': b.area.values[alone_b], 'area_after': 0., 'dist': np.nan}),
+        pd.DataFrame({'status': 'appeared', 'incl_nb_before': -1, 'incl_nb_after': a.incl_nb.values[alone_a],
+                      'x': back[:, 0], 'y': back[:, 1],
+                      'area_before': 0., 'area_after': a.area.values[alone_a], 'dist': np.nan})], ignore_index = True)
+
+    return pairs
+
+
+def compare(before, after, model = 'rigid', max_angle = 0., tol = None, growth = 0.2, incl_types = None):
+    """
+    Compares two acquisitions of the same slice, before and after pitting. The acquisition
+    after is registered on the one before (see register), then each feature before is paired
+    with its nearest feature after, if they are closer than tol plus half the feret diameter
+    of the feature after (the centroid of a pit grown from an inclusion may have moved).
+    A feature after paired with several features before keeps the nearest one.
+    The features are tagged:
+        'unchanged':    paired, area grown by less than <growth>
+        'grown':        paired, area grown by more than <growth>
+        'appeared':     feature after without pair (new pit)
+        'vanished':     feature before without pair (dissolved, or inside a pit)
+
+    Parameters
+    ----------
+    before:     (ID_specimen, slice) of the acquisition before
+    after:      (ID_specimen, slice) of the acquisition after
+    model:      Transform between the acquisitions: 'rigid' or 'affine'
+    max_angle:  Largest rotation between the acquisitions (degrees). 0: translation only.
+    tol:        Distance of paired features (microns). Default: 3 times the RMS distance of the registration.
+    growth:     Relative growth of the area of a grown feature
+    incl_types: Types of features compared. Default: all but artifacts and out-of-bounds.
+
+    Returns
+    -------
+    pairs :     Dataframe with one row per pair or unpaired feature, and the fields status,
+                incl_nb_before, incl_nb_after (-1 if none), x, y (coordinates before, or of the
+                feature after brought back in the frame before), area_before, area_after, dist
+    T :         Matrix 2x3 of the transform from before to after (see apply_transform). None if
+                the registration failed.
+
+    """
+    b = read_features(*before, incl_types)
+    a = read_features(*after, incl_types)
+    if len(b) == 0 or len(a) == 0:
+        print('No features to compare')
+        return None, None
+
+    T, rms, n_pairs = register(b, a, model, max_angle)
+    if T is None:
+        print('Registration failed: no pair of features of similar areas')
+        return None, None
+    if tol is None:
+        tol = 3*rms
+
+    pairs = match(b, a, T, tol, growth)
+
+    print('Registration: {:d} pairs, RMS distance {:.2f} um, rotation {:.3f} deg, translation ({:.1f}, {:.1f}) um'\
+          .format(n_pairs, rms, np.degrees(np.arctan2(T[1, 0], T[0, 0])), T[0, 2], T[1, 2]))
+    counts = pairs.status.value_counts()
+    print('\t'.join('{:s}: {:d}'.format(status, int(counts.get(status, 0))) for status in ['unchanged', 'grown', 'appeared', 'vanished']))
+    return pairs, T
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print('Usage: python pitting.py ID_before slice_before ID_after slice_after [output.csv]')
+        sys.exit(1)
+
+    pairs, T = compare((sys.argv[1], int(sys.argv[2])), (sys.argv[3], int(sys.argv[4])))
+    if pairs is None:
+        sys.exit(1)
+    if len(sys.argv) > 5:
+        pairs.to_csv(sys.argv[5], index = False)
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+#Plots of the statistics on the inclusions.
+#Importing this module configures Matplotlib globally.
+
+#Commonly used libraries
+import numpy as np
+import matplotlib.pyplot as plt
+
+#Configuration of Matplotlib grahps to use LaTeX formatting with siunitx library
+import matplotlib as mpl
+from matplotlib import rc
+rc('font',**{'family':'serif','serif':['DejaVu Sans']})
+rc('text', usetex=True)
+mpl.rcParams['errorbar.capsize'] = 3
+mpl.rcParams['lines.markersize'] = 5
+mpl.rcParams['text.latex.preamble']=r'\usepackage{siunitx}'
+
+from database import get_data
+from stats import kept_types
+from density import log_density
+from extremes import exp_quantiles, get_pot
+
+
+def dens_per_sample(samples = None, exclude_porosity = True, ci = True, level = 0.95):
+    """
+    Bar plot of the number of inclusions per mm2 and of their area fraction, per specimen.
+
+    Parameters
+    ----------
+    samples:            List of specimen IDs. Default: all.
+    exclude_porosity:   If TRUE, porosities are left out
+    ci:                 If TRUE, error bars show the confidence intervals, the number of
+                        inclusions being taken as a Poisson count (see bootstrap.py)
+    level:              Confidence level
+
+    Returns
+    -------
+    fig :               Figure
+
+    """
+    from bootstrap import poisson_ci, area_fraction_ci
+    
+    meta, data = get_data(samples = samples, incl_types = kept_types(exclude_porosity), 
+                          columns = ['ID_specimen', 'incl_nb', 'area'])
+    
+    #Specimens with several slices: the features of all the slices over their total area
+    meta = meta.groupby('ID_specimen').agg({'img_area_mm2': 'sum'})\
+        .merge(data.groupby(['ID_specimen']).agg({'incl_nb': 'count', 'area': 'sum'}),\
+                        left_index=True, right_index=True).reset_index()
+
+    #x = np.arange(len(meta.ID_specimen.unique()))
+    y1 = meta.incl_nb/meta.img_area_mm2
+    y2 = meta.area/meta.img_area_mm2/1e3
+    
+    err1 = None
+    err2 = None
+    if ci == True:
+        low, high = poisson_ci(meta.incl_nb.values, level)
+        err1 = np.array([y1 - low/meta.img_area_mm2, high/meta.img_area_mm2 - y1])
+        bounds = np.array([area_fraction_ci(data.area.values[(data.ID_specimen == row.ID_specimen).values], 
+                                            row.img_area_mm2, level)[1:] for row in meta.itertuples()])/1e3
+        err2 = np.array([y2 - bounds[:, 0], bounds[:, 1] - y2])
+
+    
+    fig = plt.figure(dpi=200)
+    ax = fig.gca()
+    ax2 = ax.twinx()
+   
+    y1.plot(kind='bar', ax = ax, width = 0.4, position = 1, color = 'blue', yerr = err1)
+    ax.bar([], [], fillcolor = 'red')
+    y2.plot(kind='bar', ax = ax2, width = 0.4, position = 0, color = 'red', yerr = err2)
+    ax.set_xticklabels(meta.ID_specimen)
+    ax.set_ylabel('Inclusion density (\si{\per\milli\metre\squared})')
+    ax2.set_ylabel(r'Inclusion area density ($\times 10^3$ \si{\milli\metre\per\milli\metre})')
+    ax.set_xlim([-0.5, len(meta)-0.5])
+    
+    colors = {'Inclusion count': 'blue', 'Inclusion area': 'red'}
+    labels = list(colors.keys())
+    handles = [plt.Rectangle((0,0), 1, 1, color = colors[label]) for label in labels]
+    ax.legend(handles, labels, loc= 'upper center', bbox_to_anchor=(0.5, 1.15), ncol=2)
+    
+    plt.gcf().subplots_adjust(bottom=0.30)
+    
+    return fig
+
+def dens_vs_size(samples = None, xlim = [0, 100], param='feret', exclude_porosity = True, weighted = False,
+                 ci = False, level = 0.95, n_boot = 1000, seed = None, processes = None):
+    """
+    Plot of the density of the inclusions per size, per specimen (see stats.get_dens).
+
+    Parameters
+    ----------
+    samples:            List of specimen IDs. Default: all.
+    xlim:               Range of sizes
+    param:              Size of the features: 'feret' or 'sqr_area'
+    exclude_porosity:   If TRUE, porosities are left out
+    weighted:           If TRUE, density of the area of the inclusions
+    ci:                 If TRUE, shows the confidence band of each curve, found by bootstrap
+                        (see bootstrap.log_density_replicates)
+    level:              Confidence level
+    n_boot:             Number of bootstrap replicates
+    seed:               Seed of the random generator, for reproducible bands
+    processes:          Number of processes of the bootstrap. Default: number of processors.
+
+    Returns
+    -------
+    fig :               Figure
+
+    """
+    if ci == True:
+        from bootstrap import log_density_replicates, band
+
+    meta, data = get_data(samples = samples, incl_types = kept_types(exclude_porosity), 
+                          columns = ['ID_specimen', 'incl_nb', 'area', param])
+    
+    #Specimens with several slices: the features of all the slices over their total area
+    areas = meta.groupby('ID_specimen').img_area_mm2.sum()
+    
+    x = np.linspace(data[param].min(), xlim[1], 1000)
+    
+    fig = plt.figure(dpi=200)
+    ax = fig.gca()
+    for k, (ID_spec, df) in enumerate(data.groupby('ID_specimen')):
+        weights = None if weighted == False else df.area.values
+        if ci == True:
+            y, Y = log_density_replicates(df[param].values, x, 0.18, weights, n_boot, 
+                                          None if seed is None else [seed, k], processes)
+            low, high = band(Y, level)
+            ax.fill_between(x, low/areas[ID_spec], high/areas[ID_spec], color = 'C{:d}'.format(k % 10), alpha = 0.3, linewidth = 0)
+        elif weighted == False:
+            y = log_density(df[param].values, x, 0.18)*len(df)
+        else:
+            y = log_density(df[param].values, x, 0.18, weights = weights)*df.area.sum()
+        ax.semilogx(x, y/areas[ID_spec], label = ID_spec, color = 'C{:d}'.format(k % 10))
+        
+    if param == 'feret':
+        ax.set_xlabel('Feret diameter (\si{\micro\metre})')
+    elif param == 'sqr_area':
+        ax.set_xlabel('Sqr. root area $\sqrt{A}$ (\si{\micro\metre})')       
+        
+    if weighted == False:
+        ax.set_ylabel('Inclusion count density (\si{\per\micro\metre\per\milli\metre\squared})')
+    else:
+        ax.set_ylabel('Inclusion area density (\si{\per\micro\metre \micro\metre\squared\per\milli\metre\squared})')
+    ax.set_xlim(xlim)
+    ax.legend()
+    
+    return fig
+
+def plot_feret(rem_artifacts = True):
+    meta, df = get_data(incl_types = kept_types(False) if rem_artifacts == True else None, 
+                        columns = ['ID_specimen', 'feret'])
+    
+    df.loc[:, 'ID_specimen'] = df.ID_specimen.apply(lambda x: x.replace('_', ' '))
+    df = exp_quantiles(df, 'feret')
+    fig = plt.figure(dpi=200)
+    ax = fig.gca()
+    for ech, df1 in df.groupby('ID_specimen'):
+        ax.plot(df1.feret, df1.q, marker='.', label=ech)
+    ax.set_xlabel('Feret diameter (\si{\micro\metre})')
+    ax.set_ylabel('Exponential quantiles, $-\ln(1-F)$')
+    ax.legend()
+    return fig
+
+def plot_sqra(rem_artifacts = True):
+    meta, df = get_data(incl_types = kept_types(False) if rem_artifacts == True else None, 
+                        columns = ['ID_specimen', 'sqr_area'])
+
+    df.loc[:, 'ID_specimen'] = df.ID_specimen.apply(lambda x: x.replace('_', ' '))
+    df = exp_quantiles(df, 'sqr_area')
+    fig = plt.figure(dpi=200)
+    ax = fig.gca()
+    for ech, df1 in df.groupby('ID_specimen'):
+        ax.plot(df1.sqr_area, df1.q, marker='.', label=ech)
+    ax.set_xlabel('Equivalent diameter, $\sqrt{A}$ (\si{\micro\metre})')
+    ax.set_ylabel('Exponential quantiles, $-\ln(1-F)$')
+    ax.legend()
+    return fig
+
+def plot_pot(samples = None, param = 'feret', kind = 'mean_excess', k_max = None, exclude_porosity = True):
+    """
+    Threshold choice for the peak-over-threshold method: plot, per specimen, of
+    the mean excess over the threshold u against u (linear above the threshold
+    where the tail follows a generalized Pareto law, flat for an exponential tail),
+    or of the exponential scale sigma or the Hill estimator against the number k
+    of exceedances (stable where the fit is valid). See extremes.pot_paths.
+
+    Parameters
+    ----------
+    samples:            List of specimen IDs. Default: all.
+    param:              Size of the features: 'feret' or 'sqr_area'
+    kind:               'mean_excess', 'sigma' or 'hill'
+    k_max:              Largest number of exceedances shown. Default: all.
+    exclude_porosity:   If TRUE, porosities are left out
+
+    Returns
+    -------
+    fig :               Figure
+
+    """
+    paths = get_pot(samples, param, exclude_porosity)
+    if k_max is not None:
+        paths = paths.loc[paths.k <= k_max]
+    
+    fig = plt.figure(dpi=200)
+    ax = fig.gca()
+    for ech, df1 in paths.groupby('ID_specimen'):
+        if kind == 'mean_excess':
+            ax.plot(df1.u, df1.sigma, label = ech.replace('_', ' '))
+        else:
+            ax.semilogx(df1.k, df1[kind], label = ech.replace('_', ' '))
+    
+    unit = '(\si{\micro\metre})'
+    if kind == 'mean_excess':
+        ax.set_xlabel('Threshold ' + unit)
+        ax.set_ylabel('Mean excess ' + unit)
+    else:
+        ax.set_xlabel('Number of exceedances $k$')
+        ax.set_ylabel('Exponential scale $\sigma_k$ ' + unit if kind == 'sigma' else 'Hill estimator')
+    ax.legend()
+    return fig
+
+def plot_gumbel(maxima, fits = None):
+    """
+    Gumbel probability plot of block maxima: the maxima of each specimen and division scheme
+    in ascending order, against the reduced variate -ln(-ln(P)) of their plotting positions
+    P = i/(n+1). Maxima following a Gumbel law are aligned.
+
+    Parameters
+    ----------
+    maxima:     Dataframe of block maxima (see extremes.block_maxima)
+    fits:       Fitted laws (see extremes.fit_block_maxima), Gumbel or GEV, drawn as lines. Default: none.
+
+    Returns
+    -------
+    fig :       Figure
+
+    """
+    fig = plt.figure(dpi=200)
+    ax = fig.gca()
+    for k, ((scheme, ech), df1) in enumerate(maxima.groupby(['scheme', 'ID_specimen'])):
+        x = np.sort(df1['max'].values)
+        y = -np.log(-np.log(np.arange(1, len(x) + 1)/(len(x) + 1)))
+        color = 'C{:d}'.format(k % 10)
+        ax.plot(x, y, '.', color = color, label = '{:s} ({:s})'.format(ech.replace('_', ' '), scheme))
+        if fits is not None:
+            fit = fits.loc[(fits.scheme == scheme) & (fits.ID_specimen == ech)]
+            if len(fit) == 1 and np.isfinite(fit.xi.iloc[0]):
+                mu, sigma, xi = fit.mu.iloc[0], fit.sigma.iloc[0], fit.xi.iloc[0]
+                #Quantiles of the law fitted: a line for a Gumbel law, a curve for a GEV law
+                x_fit = mu + sigma*y if xi == 0 else mu + sigma*np.expm1(xi*y)/xi
+                ax.plot(x_fit, y, color = color)
+    ax.set_xlabel('Largest inclusion of the block (\si{\micro\metre})')
+    ax.set_ylabel('Reduced variate, $-\ln(-\ln F)$')
+    ax.legend()
+    return fig
+
+def plot_morph(rem_artifacts = True, x = 'feret', y = 'sqr_area', xlabel = 'Feret diameter (\si{\micro\metre})', ylabel ='Equivalent diameter, $\sqrt{A}$ (\si{\micro\metre})'):
+    meta, data = get_data()
+    
+    fig = plt.figure(dpi=200)
+    ax = fig.gca()
+    
+    ax.plot(data.loc[data.incl_type == ''][x], data.loc[data.incl_type==''][y], color='gray', marker = '.', linestyle = 'none', label = 'Unidentified')
+    ax.plot(data.loc[data.incl_type == '1'][x], data.loc[data.incl_type=='1'][y], color='black', marker = 'x', linestyle = 'none', label = 'Spherical incl./void')
+    ax.plot(data.loc[data.incl_type == '2'][x], data.loc[data.incl_type=='2'][y], color= 'blue', marker = 'o', linestyle = 'none', label = 'Irregular incl.')
+    ax.plot(data.loc[data.incl_type == '3'][x], data.loc[data.incl_type=='3'][y], color = 'red', marker = '^' , linestyle = 'none', label = 'Lack of fusion')
+    
+    if rem_artifacts == False:
+        ax.plot(data.loc[data.incl_type == '4'][x], data.loc[data.incl_type=='4'][y], 'ro', label = 'Scratch')
+        ax.plot(data.loc[data.incl_type == '5'][x], data.loc[data.incl_type=='5'][y], 'r^', label = 'Dust')
+        ax.plot(data.loc[data.incl_type == '6'][x], data.loc[data.incl_type=='6'][y], 'rx', label = 'Other artifact')
+    
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.legend()
+    return fig
+    
+
+def plot_dist():
+
+    meta, data = get_data()
+
+        
+    bins = 10**np.linspace(0, 3, 31)
+    x = 10**(np.linspace(0, 3, 31)[:-1]+0.05)
+
+    fig = plt.figure(dpi=200)
+    ax = fig.gca()
+
+    #y1 = plt.hist(data.feret, bins=bins)[0]
+    ax.hist(data.loc[(data.incl_type=='5')&(data.feret<100)].feret)[0]
+
+
+    #ax.loglog(x, y1, marker='.', label = 'Total')
+    #ax.hist(x, y2, marker='.', label = 'Dust')
+
+    ax.set_xlabel('Feret diameter, (\si{\micro\metre})')
+    ax.set_ylabel('Count')
+    ax.legend()
+    return fig
+    
+def plot_qod(df=0):
+    """
+    Estimates the quality of the data histogram of ratio of artifacts on total observations.
+
+    Parameters
+    ----------
+    Y : Vector of values on which to perform regression. Need not to be ordered.
+    k : Size of the sample. Scalar or vector.
+
+    Returns
+    -------
+    sigma_k : MLE estimate of distribution parameter. Returns scalar or vector
+              depending of k.
+
+    """    
+    
+    if df == 0:
+        meta, data = get_data()
+    else:
+        data = df
+   
+    
+    bins = 10**np.linspace(0, 3, 31)
+    
+    fig = plt.figure(dpi=200)
+    ax = fig.gca()
+    
+    df_ok = data.loc[data.incl_type.apply(lambda x: x not in ['4', '5', '6', '7'])]
+    df_notok = data.loc[data.incl_type.apply(lambda x: x in ['4', '5', '6'])]
+    
+    plt.hist([df_ok.feret, df_notok.feret], bins, stacked=True, log=True, color = ['blue', 'gray'], label = ['OK or unknown', 'Artifacts'])
+    
+    ax.set_xlabel('Feret diameter (\si{micro\metre})')
+    ax.set_ylabel('Density')
+    ax.legend()
+    return fig
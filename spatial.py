@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+#Spatial index of the features of a slice: a uniform grid over the centroids (x, y).
+#The features are sorted by cell of the grid, so the features of a rectangle of cells
+#are read from a few contiguous ranges, without scanning the whole slice.
+#The index of each slice is stored in the database, next to the data (see database.get_sindex).
+#This module only depends on Numpy and Pandas, as the database module which uses it.
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+
+from geometry import points_in_polygon
+
+#Average number of features per cell of the grid
+per_cell = 8
+
+#Fields of the table storing the index in the database
+fields_sindex = ['row', 'incl_nb', 'x', 'y']
+
+
+class GridIndex:
+    """
+    Uniform grid over the centroids of the features of a slice, answering rectangle,
+    polygon, radius and nearest neighbour queries while only looking at the features
+    of the cells concerned.
+    The queries return the positions of the features in the data of the slice as stored
+    in the database (row 0, 1... of the data returned by get_slice), sorted, so the
+    features are selected with df.iloc[rows]. The index is only valid for this order:
+    it does not follow rows added or removed in memory.
+    """
+
+    def __init__(self, x, y, incl_nb = None, rows = None):
+        x = np.asarray(x, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        rows = np.arange(len(x)) if rows is None else np.asarray(rows)
+        incl_nb = rows if incl_nb is None else np.asarray(incl_nb)
+
+        #The grid only depends on the points, so it is rebuilt identically from the table stored
+        n = len(x)
+        self.x0 = float(x.min()) if n > 0 else 0.
+        self.y0 = float(y.min()) if n > 0 else 0.
+        width = float(x.max()) - self.x0 if n > 0 else 0.
+        height = float(y.max()) - self.y0 if n > 0 else 0.
+        self.side = max((width*height*per_cell/max(n, 1))**0.5, max(width, height)*per_cell/max(n, 1))
+        if self.side <= 0:
+            self.side = 1.
+        self.nx = int(width//self.side) + 1
+        self.ny = int(height//self.side) + 1
+
+        cells = self._cells(x, y)
+        if np.any(np.diff(cells) < 0):
+            order = np.argsort(cells, kind='stable')
+            x, y, incl_nb, rows, cells = x[order], y[order], incl_nb[order], rows[order], cells[order]
+        self.x = x
+        self.y = y
+        self.incl_nb = incl_nb.astype('int32')
+        self.rows = rows.astype('int64')
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength = self.nx*self.ny))])
+
+    def __len__(self):
+        return len(self.x)
+
+    @classmethod
+    def from_data(cls, df):
+        """
+        Builds the index of the data of a slice (fields incl_nb, x, y).
+        """
+        return cls(df.x.values, df.y.values, df.incl_nb.values)
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Rebuilds an index from the table stored in the database (see table()).
+        """
+        return cls(table.x.values, table.y.values, table.incl_nb.values, table.row.values)
+
+    def table(self):
+        """
+        Returns the table stored in the database: position in the data, incl_nb
+        and coordinates of the features, sorted by cell of the grid.
+        """
+        return pd.DataFrame({'row': self.rows.astype('int32'), 'incl_nb': self.incl_nb, 'x': self.x, 'y': self.y})
+
+    def _cells(self, x, y):
+        #Cell numbers of points inside the grid, row by row
+        ix = np.minimum(((x - self.x0)//self.side).astype('int64'), self.nx - 1)
+        iy = np.minimum(((y - self.y0)//self.side).astype('int64'), self.ny - 1)
+        return iy*self.nx + ix
+
+    def _span(self, low, high, origin, n):
+        #Range of cells [first, last] covering [low, high] along one axis, or None if outside the grid
+        first = np.floor((low - origin)/self.side)
+        last = np.floor((high - origin)/self.side)
+        if last < 0 or first > n - 1 or first > last:
+            return None
+        return int(max(first, 0)), int(min(last, n - 1))
+
+    def _ranges(self, ix0, ix1, iy0, iy1):
+        #Positions in the sorted arrays of the features of the cells [ix0, ix1] x [iy0, iy1]
+        ranges = [np.arange(self.starts[iy*self.nx + ix0], self.starts[iy*self.nx + ix1 + 1])
+                  for iy in range(iy0, iy1 + 1)]
+        return np.concatenate(ranges) if len(ranges) > 0 else np.zeros(0, dtype='int64')
+
+    def _candidates(self, xmin, xmax, ymin, ymax):
+        #Positions in the sorted arrays of the features of the cells overlapping a rectangle
+        span_x = self._span(xmin, xmax, self.x0, self.nx)
+        span_y = self._span(ymin, ymax, self.y0, self.ny)
+        if len(self) == 0 or span_x is None or span_y is None:
+            return np.zeros(0, dtype='int64')
+        return self._ranges(*span_x, *span_y)
+
+    def rect(self, xmin, xmax, ymin, ymax):
+        """
+        Returns the features strictly inside a rectangle.
+
+        Parameters
+        ----------
+        xmin, xmax: Bounds in x (microns)
+        ymin, ymax: Bounds in y (microns)
+
+        Returns
+        -------
+        rows :      Positions of the features in the data of the slice
+
+        """
+        i = self._candidates(xmin, xmax, ymin, ymax)
+        x, y = self.x[i], self.y[i]
+        return np.sort(self.rows[i[(x > xmin) & (x < xmax) & (y > ymin) & (y < ymax)]])
+
+    def polygon(self, xs, ys):
+        """
+        Returns the features inside a polygon (even-odd rule).
+
+        Parameters
+        ----------
+        xs, ys:     Coordinates of the vertices of the polygon (microns), in order
+
+        Returns
+        -------
+        rows :      Positions of the features in the data of the slice
+
+        """
+        i = self._candidates(np.min(xs), np.max(xs), np.min(ys), np.max(ys))
+        return np.sort(self.rows[i[points_in_polygon(self.x[i], self.y[i], xs, ys)]])
+
+    def radius(self, x, y, r):
+        """
+        Returns the features at a distance strictly less than <r> from a point.
+
+        Parameters
+        ----------
+        x, y:       Coordinates of the point (microns)
+        r:          Radius (microns)
+
+        Returns
+        -------
+        rows :      Positions of the features in the data of the slice
+
+        """
+        i = self._candidates(x - r, x + r, y - r, y + r)
+        return np.sort(self.rows[i[(self.x[i] - x)**2 + (self.y[i] - y)**2 < r**2]])
+
+    def nearest(self, x, y, k = 1):
+        """
+        Returns the <k> features nearest to a point. The cells are visited by rings
+        around the point, until no feature outside the rings can be nearer.
+
+        Parameters
+        ----------
+        x, y:       Coordinates of the point (microns)
+        k:          Number of features
+
+        Returns
+        -------
+        rows :      Positions of the features in the data of the slice, nearest first
+        dist :      Distances of the features to the point (microns)
+
+        """
+        k = min(int(k), len(self))
+        if k < 1:
+            return np.zeros(0, dtype='int64'), np.zeros(0)
+
+        cx = int(np.clip(np.floor((x - self.x0)/self.side), 0, self.nx - 1))
+        cy = int(np.clip(np.floor((y - self.y0)/self.side), 0, self.ny - 1))
+        found = []
+        m = 0
+        while True:
+            #Cells at a distance of m cells from the cell of the point
+            ix0, ix1 = max(cx - m, 0), min(cx + m, self.nx - 1)
+            for iy in {cy - m, cy + m}:
+                if 0 <= iy < self.ny:
+                    found.append(self._ranges(ix0, ix1, iy, iy))
+            for ix in {cx - m, cx + m}:
+                if 0 <= ix < self.nx and m > 0:
+                    found.append(self._ranges(ix, ix, max(cy - m + 1, 0), min(cy + m - 1, self.ny - 1)))
+
+            i = np.concatenate(found)
+            if len(i) >= k:
+                dist = np.hypot(self.x[i] - x, self.y[i] - y)
+                nearest = np.argsort(dist, kind='stable')[:k]
+                #Distance from the point to the cells not visited yet, on the sides where the grid goes on.
+                #The point may be outside the grid: its distance to the grid adds up.
+                out_x = max(self.x0 - x, x - (self.x0 + self.nx*self.side), 0)
+                out_y = max(self.y0 - y, y - (self.y0 + self.ny*self.side), 0)
+                margin = min([np.inf] + [np.hypot(d, out) for d, out, more in
+                                         [(x - (self.x0 + (cx - m)*self.side), out_y, cx - m > 0),
+                                          (self.x0 + (cx + m + 1)*self.side - x, out_y, cx + m < self.nx - 1),
+                                          (y - (self.y0 + (cy - m)*self.side), out_x, cy - m > 0),
+                                          (self.y0 + (cy + m + 1)*self.side - y, out_x, cy + m < self.ny - 1)] if more])
+                if dist[nearest[-1]] <= margin:
+                    return self.rows[i[nearest]], dist[nearest]
+            m += 1
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+#Spatial statistics of the features of a slice: distances to the nearest neighbours,
+#Ripley's K and L functions, and clusters (stringers) found by density (DBSCAN).
+#The neighbours are searched with a KD-tree (scipy.spatial.cKDTree), so the functions
+#stay tractable on slices with millions of features: no loop runs over pairs of features.
+#The edges of the specimen are corrected by the border method: only the features farther
+#from the outline (rectangle of the image, or circle of a circular specimen) than the
+#distance considered are taken as centers. The intensity of the features is taken on the observed
+#area of the slice (hollow part and exclusion zones removed), the borders of the zones are not corrected.
+#Scipy is imported only by the functions that need it.
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+
+from database import get_data
+from stats import kept_types
+
+
+def slice_features(ID_spec, slice, incl_types = None):
+    """
+    Returns the features of a slice used by the spatial statistics, and the metadata of the slice.
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+    incl_types: Types of features kept. Default: all but artifacts, porosities and out-of-bounds.
+
+    Returns
+    -------
+    row :       Metadata of the slice (Series)
+    df :        Data of the features, with the fields incl_nb, x, y, r, theta, feret
+
+    """
+    meta, df = get_data(samples = [ID_spec], slices = [slice],
+                        incl_types = kept_types() if incl_types is None else incl_types,
+                        columns = ['ID_specimen', 'slice', 'incl_nb', 'x', 'y', 'r', 'theta', 'feret'])
+    row = meta.loc[(meta.ID_specimen == ID_spec) & (meta.slice == slice)].iloc[0]
+    return row, df.reset_index(drop=True)
+
+
+def window(row):
+    """
+    Returns the outline of the observed window of a slice: the rectangle of the image
+    (from 0 to img_width and img_height), or the outer circle of a circular specimen.
+
+    Parameters
+    ----------
+    row:        Metadata of the slice (Series)
+
+    Returns
+    -------
+    window :    ('rect', width, height) or ('circle', x_c, y_c, r_outer). None if the
+                circle of a circular specimen is not defined (see def_pol_coord).
+
+    """
+    if row.img_width >= 1:
+        return ('rect', float(row.img_width), float(row.img_height))
+    if np.isnan(row.x_c) or np.isnan(row.y_c) or np.isnan(row.r_outer):
+        return None
+    return ('circle', float(row.x_c), float(row.y_c), float(row.r_outer))
+
+
+def window_area(win):
+    #Area of a window (square microns)
+    if win[0] == 'rect':
+        return win[1]*win[2]
+    return np.pi*win[3]**2
+
+
+def observed_area(row, win):
+    #Area where features are observed (square microns): area of the image of the slice, without
+    #the hollow part of a circular specimen and the exclusion zones. Area of the window if unknown.
+    if row.img_area_mm2 > 0:
+        return row.img_area_mm2*1e6
+    return window_area(win)
+
+
+def border_distance(x, y, win):
+    """
+    Distance of points to the outline of a window (see window). Negative outside.
+
+    Parameters
+    ----------
+    x, y:       Coordinates of the points (microns)
+    win:        Window
+
+    Returns
+    -------
+    b :         Array of distances (microns)
+
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if win[0] == 'rect':
+        return np.minimum(np.minimum(x, win[1] - x), np.minimum(y, win[2] - y))
+    return win[3] - np.hypot(x - win[1], y - win[2])
+
+
+def nn_distances(x, y, k = 1):
+    """
+    Distances of points to their k-th nearest neighbour, found with a KD-tree.
+
+    Parameters
+    ----------
+    x, y:       Coordinates of the points (microns)
+    k:          Rank of the neighbour
+
+    Returns
+    -------
+    d :         Array of distances (microns), aligned with the points. NaN if less than k+1 points.
+    j :         Position of the neighbour of each point (-1 if none)
+
+    """
+    from scipy.spatial import cKDTree
+
+    pts = np.column_stack([x, y]).astype(float)
+    if len(pts) < k + 1:
+        return np.full(len(pts), np.nan), np.full(len(pts), -1)
+    d, j = cKDTree(pts).query(pts, k = [k + 1], workers = -1)
+    return d[:, 0], j[:, 0]
+
+
+def nn_function(ID_spec, slice, r = None, incl_types = None):
+    """
+    Distribution function G(r) of the distances of the features to their nearest neighbour,
+    with border correction, and the value expected if the features were placed at random
+    (complete spatial randomness, CSR): 1 - exp(-lambda*pi*r^2).
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+    r:          Distances at which G is evaluated (microns). Default: 100 values up to
+                3 times the median distance.
+    incl_types: Types of features kept (see slice_features)
+
+    Returns
+    -------
+    G :         Dataframe with the fields r, G, G_csr. None if the outline of the slice is not defined.
+    d :         Distance of each feature to its nearest neighbour (Series, index incl_nb)
+
+    """
+    row, df = slice_features(ID_spec, slice, incl_types)
+    win = window(row)
+    if win is None:
+        print('Outline of the specimen not defined. Use def_pol_coord() first.')
+        return None, None
+
+    d, j = nn_distances(df.x.values, df.y.values)
+    b = border_distance(df.x.values, df.y.values, win)
+    if r is None:
+        r = np.linspace(0, 3*np.nanmedian(d), 100)
+    r = np.asarray(r, dtype=float)
+
+    #Features whose nearest neighbour is at most r, among the features at more than r from the outline
+    order = np.argsort(d)
+    d_sorted = d[order]
+    b_sorted = b[order]
+    G = np.zeros(len(r))
+    for i, ri in enumerate(r):
+        centers = b_sorted >= ri
+        n = np.count_nonzero(centers)
+        if n > 0:
+            G[i] = np.count_nonzero(centers[:np.searchsorted(d_sorted, ri, side='right')])/n
+        else:
+            G[i] = np.nan
+
+    lam = len(df)/observed_area(row, win)
+    G = pd.DataFrame({'r': r, 'G': G, 'G_csr': 1 - np.exp(-lam*np.pi*r**2)})
+    return G, pd.Series(d, index = df.incl_nb.values, name = 'nn_dist')
+
+
+def ripley(ID_spec, slice, r, incl_types = None, edge = 'border'):
+    """
+    Ripley's K function of the features of a slice, and its variance-stabilized form
+    L(r) = sqrt(K(r)/pi). For features placed at random (CSR), K(r) = pi*r^2 and L(r) = r:
+    L(r) > r shows clustering at the scale r, L(r) < r regularity.
+    The pairs are counted by a dual KD-tree traversal, for all the distances at once.
+    With border correction, the centers are grouped by the largest distance at which
+    they are used, and each group is counted once.
+
+    Parameters
+    ----------
+    ID_spec:    Specimen ID
+    slice:      Slice number
+    r:          Distances at which K is evaluated (microns)
+    incl_types: Types of features kept (see slice_features)
+    edge:       'border': only the features at more than r from the outline are centers.
+                'none': all the features are centers (K biased low near the outline).
+
+    Returns
+    -------
+    K :         Dataframe with the fields r, K, L, n_centers. None if the outline of the slice is not defined.
+
+    """
+    from scipy.spatial import cKDTree
+
+    row, df = slice_features(ID_spec, slice, incl_types)
+    win = window(row)
+    if win is None:
+        print('Outline of the specimen not defined. Use def_pol_coord() first.')
+        return None
+
+    pts = np.column_stack([df.x.values, df.y.values])
+    tree = cKDTree(pts)
+    lam = len(pts)/observed_area(row, win)
+    r = np.asarray(r, dtype=float)
+    order = np.argsort(r)
+    r_sorted = r[order]
+
+    #Pairs at most r apart (the pair of a center with itself included), and number of centers
+    pairs = np.zeros(len(r))
+    n_centers = np.zeros(len(r), dtype=int)
+    if edge == 'border':
+        group = np.searchsorted(r_sorted, border_distance(df.x.values, df.y.values, win), side='right') - 1
+        for k in np.unique(group[group >= 0]):
+            centers = pts[group == k]
+            pairs[:k + 1] += cKDTree(centers).count_neighbors(tree, r_sorted[:k + 1])
+            n_centers[:k + 1] += len(centers)
+    elif len(pts) > 0:
+        pairs[:] = tree.count_neighbors(tree, r_sorted)
+        n_centers[:] = len(pts)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        K = np.where(n_centers > 0, (pairs - n_centers)/(lam*n_centers), np.nan)
+    K[order] = K.copy()
+    n_centers[order] = n_centers.copy()
+    return pd.DataFrame({'r': r, 'K': K, 'L': np.sqrt(K/np.pi), 'n_centers': n_centers})
+
+
+def clusters(ID_spec, slice, eps, min_samples = 5, incl_types = None):
+    """
+    Finds clusters of features by density (DBSCAN): a feature with at least min_samples
+    features (itself included) within eps is a core feature; core features within eps of
+    each other belong to the same cluster, and the other features within eps of a core
+    feature join its cluster. The remaining features are noise.
+    The pairs of features within eps are found at once with a KD-tree, and the clusters
+    are the connected components of the graph of core features.
+
+    Parameters
+    ----------
+    ID_spec:        Specimen ID
+    slice:          Slice number
+    eps:            Neighbourhood radius (microns)
+    min_samples:    Number of features in the neighbourhood of a core feature
+    incl_types:     Types of features kept (see slice_features)
+
+    Returns
+    -------
+    labels :        Cluster of each feature (Series, index incl_nb): 0, 1... or -1 for noise
+    summary :       Dataframe with one row per cluster: n, x, y (center), length and angle
+                    (extent and direction of the principal axis, in microns and degrees) and max_feret
+
+    """
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    row, df = slice_features(ID_spec, slice, incl_types)
+    n = len(df)
+    pts = np.column_stack([df.x.values, df.y.values])
+    pairs = cKDTree(pts).query_pairs(eps, output_type = 'ndarray')
+
+    counts = np.bincount(pairs.ravel(), minlength = n) + 1
+    core = counts >= min_samples
+
+    #Clusters of core features
+    both = core[pairs[:, 0]] & core[pairs[:, 1]]
+    graph = coo_matrix((np.ones(np.count_nonzero(both)), (pairs[both, 0], pairs[both, 1])), shape = (n, n))
+    n_comp, comp = connected_components(graph, directed = False)
+    labels = np.full(n, -1)
+    ids = np.unique(comp[core])
+    labels[core] = np.searchsorted(ids, comp[core])
+
+    #Border features join the cluster of a core neighbour
+    for a, c in [(0, 1), (1, 0)]:
+        join = core[pairs[:, c]] & ~core[pairs[:, a]]
+        labels[pairs[join, a]] = labels[pairs[join, c]]
+
+    labels = pd.Series(labels, index = df.incl_nb.values, name = 'cluster')
+    summary = _cluster_summary(df, labels.values)
+    return labels, summary
+
+
+def _cluster_summary(df, labels):
+    #Size, center and principal axis of each cluster
+    grouped = df.assign(cluster = labels).loc[labels >= 0].groupby('cluster')
+    summary = grouped.agg(n = ('incl_nb', 'count'), x = ('x', 'mean'), y = ('y', 'mean'), max_feret = ('feret', 'max'))
+    if len(summary) == 0:
+        return summary.assign(length = [], angle = [])
+
+    #Covariance of the coordinates of each cluster, for the direction of the stringers
+    c = df.loc[labels >= 0].assign(cluster = labels[labels >= 0])
+    c['dx'] = c.x - c.cluster.map(summary.x)
+    c['dy'] = c.y - c.cluster.map(summary.y)
+    c['dxx'] = c.dx**2
+    c['dyy'] = c.dy**2
+    c['dxy'] = c.dx*c.dy
+    cov = c.groupby('cluster')[['dxx', 'dyy', 'dxy']].mean()
+    angle = 0.5*np.arctan2(2*cov.dxy, cov.dxx - cov.dyy)
+    c['along'] = c.dx*np.cos(c.cluster.map(angle)) + c.dy*np.sin(c.cluster.map(angle))
+    summary['length'] = c.groupby('cluster').along.max() - c.groupby('cluster').along.min()
+    summary['angle'] = np.degrees(angle) % 180
+    return summary
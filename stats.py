@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+#Statistics on the inclusions. Scipy is imported only by the functions that need it.
+#The densities per size are estimated by density.py.
+
+#Commonly used libraries
+import numpy as np
+import os
+import glob
+import json
+
+from database import get_data, data_stamp
+from density import log_density
+
+
+def kept_types(exclude_porosity = True):
+    #Types of features kept in the analyses: all but artifacts and out-of-bounds (see ID_incl)
+    if exclude_porosity == True:
+        return ['', '1', '2']
+    else:
+        return ['', '1', '2', '3']
+
+
+def print_stats(ret=False, exclude_porosity = True):
+    """
+    Displays stats per specimen and slice.
+    
+    Displayed information per specimen:
+        -Number of slices
+        -Total area
+        
+    Dislpayed information per slice:
+        -Analysed area
+        -Total number of features (excluding artifacts and out-of-bounds)
+        -Number of features per mm^2
+        -Filename of original data
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+        samp:   List of samples with number of slices analyzed and total area
+        stats:  List of slices, with area, inclusions per mm2 and total inclusion area
+
+    """
+    meta, data = get_data(incl_types = kept_types(exclude_porosity), 
+                          columns = ['ID_specimen', 'slice', 'incl_nb', 'feret', 'area'], copy = False)
+    print('List of specimens studied')
+    print('Spec.\tNb. of slices\tTotal area (mm^2)')
+    for index, row in meta.groupby('ID_specimen')\
+        .agg({'slice': 'nunique', 'img_area_mm2': 'sum'}).iterrows():
+            print('{:s}\t{:d}\t\t{:.1f}'.format(index, int(row.slice), 
+                                              row.img_area_mm2))
+    print('\nStats per image file')
+
+    samp = data.groupby(['ID_specimen', 'slice'])\
+        .agg({'incl_nb': 'count', 'feret': 'max', 'area': 'sum'})
+
+    stats = meta.merge(samp, on=['ID_specimen', 'slice'])
+    stats=stats.sort_values(['ID_specimen', 'slice'])
+    
+
+    print('Spec.\t\tSlice\tArea (mm^2)\tNb. incl.\tIncl. per mm^2\tIncl. area fraction x1e3\tFilename')
+    for index, row in stats.iterrows():
+        print('{:<12}\t{:d}\t{:.2f}\t\t{:d}\t\t{:.2f}\t\t{:.2f}\t\t\t\t{:s}'.format(
+            row.ID_specimen, row.slice, row.img_area_mm2, row.incl_nb, 
+            row.incl_nb/row.img_area_mm2, row.area/row.img_area_mm2/1e3,row.filename))
+            
+    if ret==True:
+        return stats
+    
+def export_stats(filename = 'stats.xlsx', samples = None):
+    df = print_stats(True)\
+        .loc[:, ['ID_specimen', 'filename', 'img_area_mm2', 'incl_nb', 'area']]\
+        .sort_index()
+    
+    if samples != None:
+        df = df.loc[df.ID_specimen.isin(samples)]
+        
+    df.area = df.area/1e6
+    df = df.rename(columns={'area': 'total_incl_area_mm2'})
+    
+    df['incl_per_mm2'] = df.incl_nb/df.img_area_mm2
+    df['incl_area_fract'] = df.total_incl_area_mm2/df.img_area_mm2
+    
+    df.to_excel(filename, index=False)
+
+def get_dens(sample, param = 'feret', exclude_porosity = True, xlim = [0, 100], cov_fact = 0.18, weighted = False):
+    """
+    Density of the features of a sample per size (kernel density estimate on log10 of
+    the size, see density.py), scaled by the number of features per mm2, or, if weighted,
+    by their area per mm2. See get_dens_many() for several samples at once.
+
+    Parameters
+    ----------
+    sample:             Specimen ID
+    param:              Size of the features: 'feret' or 'sqr_area'
+    exclude_porosity:   If TRUE, porosities are left out
+    xlim:               Range of sizes
+    cov_fact:           Covariance factor of the kernel (count density)
+    weighted:           If TRUE, density of the area of the features
+
+    Returns
+    -------
+    x :                 1000 sizes spanning xlim
+    y :                 Density at x
+
+    """
+    x, Y = get_dens_many([sample], param, exclude_porosity, xlim, cov_fact, weighted)
+    return x, Y[0]
+
+
+#Density curves already calculated: in the session, and on the disk in <dens_cache_dir>/<stamp of the database>,
+#one file per curve. The curves of a former state of the database are removed.
+_dens_cache = {}
+dens_cache_dir = 'db_incl.dens'
+
+
+def _dens_key(stamp, sample, param, exclude_porosity, xlim, cov_fact, weighted):
+    #Name of the cached curve of a sample
+    import hashlib
+    desc = json.dumps([sample, param, bool(exclude_porosity), [float(v) for v in xlim], float(cov_fact), bool(weighted)])
+    return os.path.join(dens_cache_dir, stamp, hashlib.sha1(desc.encode()).hexdigest() + '.npy')
+
+
+def _read_dens(key):
+    #Returns a cached curve, or None
+    if key not in _dens_cache:
+        try:
+            _dens_cache[key] = np.load(key)
+        except (OSError, ValueError):
+            return None
+    return _dens_cache[key]
+
+
+def _write_dens(key, y):
+    #Caches a curve, and removes the curves of the former states of the database
+    _dens_cache[key] = y
+    folder = os.path.dirname(key)
+    if not os.path.isdir(folder):
+        import shutil
+        for old in glob.glob(os.path.join(dens_cache_dir, '*')):
+            shutil.rmtree(old, ignore_errors = True)
+        os.makedirs(folder, exist_ok = True)
+    with open(key + '.tmp', 'wb') as file:
+        np.save(file, y)
+    os.replace(key + '.tmp', key)
+
+
+def get_dens_many(samples, param = 'feret', exclude_porosity = True, xlim = [0, 100], cov_fact = 0.18, weighted = False, cache = True):
+    """
+    Densities of the features of several samples per size (see get_dens). The data of all the
+    samples is read and filtered once, and the curves are calculated specimen by specimen
+    in a single grouped pass. The density of a specimen with several slices is scaled by
+    the total area of its slices.
+    The curves are cached, on the disk too, by state of the database and parameters: as long
+    as the database does not change, a curve is calculated only once.
+
+    Parameters
+    ----------
+    samples:            List of specimen IDs
+    param:              Size of the features: 'feret' or 'sqr_area'
+    exclude_porosity:   If TRUE, porosities are left out
+    xlim:               Range of sizes
+    cov_fact:           Covariance factor of the kernel (count density)
+    weighted:           If TRUE, density of the area of the features
+    cache:              If FALSE, the curves are calculated again
+
+    Returns
+    -------
+    x :                 1000 sizes spanning xlim
+    Y :                 Array of densities at x, one row per sample (NaN if no feature,
+                        or less than 2 different sizes)
+
+    """
+    x = np.linspace(xlim[0], xlim[1], 1000)
+    Y = np.full((len(samples), len(x)), np.nan)
+    
+    stamp = data_stamp()
+    keys = [None if stamp is None else _dens_key(stamp, sample, param, exclude_porosity, xlim, cov_fact, weighted) 
+            for sample in samples]
+    todo = []
+    for i, key in enumerate(keys):
+        y = _read_dens(key) if cache == True and key is not None else None
+        if y is None:
+            todo.append(i)
+        else:
+            Y[i] = y
+    if len(todo) == 0:
+        return x, Y
+    
+    names = sorted(set(samples[i] for i in todo))
+    meta, data = get_data(samples = names, incl_types = kept_types(exclude_porosity), 
+                          columns = ['ID_specimen', 'area', param], copy = False)
+    areas = meta.groupby('ID_specimen').img_area_mm2.sum()
+    curves = {}
+    for sample, df in data.groupby('ID_specimen'):
+        if weighted == False:        
+            curves[sample] = log_density(df[param].values, x, cov_fact)*len(df)/areas[sample]
+        else:
+            curves[sample] = log_density(df[param].values, x, 0.18, weights = df.area.values)*df.area.sum()/areas[sample]
+    
+    #Cached only if the database did not change meanwhile
+    unchanged = stamp is not None and data_stamp() == stamp
+    for i in todo:
+        if samples[i] in curves:
+            Y[i] = curves[samples[i]]
+        if unchanged == True:
+            _write_dens(keys[i], Y[i])
+    
+    return x, Y
+
+
+def plot_prob(df, plot=False):
+    df = df.loc[:, ['feret']].sort_values('feret').reset_index(drop=True)
+    df['i'] = df.index+1
+    df['P'] = df.i/(len(df)+1)
+    df['q'] = -np.log(1-df.P)
+    
+    if plot==True:
+        from plots import plt
+        plt.plot(df.feret, df.q, 'k.')
+        plt.xlabel('Feret (um)')
+        plt.ylabel('-ln(1-F)')
+    
+    return df
+
+def plot_prob_sqrsurf(df, plot=False):
+    df = df.loc[:, ['area']].sort_values('area').reset_index(drop=True)
+    df['i'] = df.index+1
+    df['P'] = df.i/(len(df)+1)
+    df['q'] = -np.log(1-df.P)
+    
+    if plot==True:
+        from plots import plt
+        plt.plot(df.area**0.5, df.q, 'k.')
+        plt.xlabel(r'$\sqrt{A}$ (\si{\micro\metre}')
+        plt.ylabel('-ln(1-F)')
+    
+    return df
+
+
+def MLE_sig_exp(Y, k):
+    """
+    Returns Maximum Likelihood Estimate (MLE) of the exponential distribution
+    fitted on the data Y. The regression is done using the k highest values
+    with the peak-over-threshold method. The threshold is set to the lowest
+    value in Y. [Ref. Reiss and Thomas chap. 5]
+    The threshold is the k-th highest value, which is itself one of the k values:
+    the result is (k-1)/k times the sigma of extremes.pot_paths for k-1, where
+    the threshold is the (k+1)-th highest value and the k highest values exceed it.
+
+    Parameters
+    ----------
+    Y : Vector of values on which to perform regression. Need not to be ordered.
+    k : Size of the sample. Scalar or vector, at least 1. If larger than the
+        number of values, all the values are kept.
+
+    Returns
+    -------
+    sigma_k : MLE estimate of distribution parameter. Returns scalar or vector
+              depending of k.
+
+    """
+    
+    #Sums of the k highest values, from a single sort in descending order
+    Y = np.sort(np.asarray(Y, dtype=float))[::-1]
+    sums = np.cumsum(Y)
+    k = np.asarray(k)
+    if np.any(k < 1):
+        raise ValueError('k must be at least 1')
+    
+    #Beyond the size of Y, all the values are kept (the sum is still divided by k)
+    m = np.minimum(k, len(Y))
+    sigma_k = (sums[m - 1] - m*Y[m - 1])/k     #The threshold is the lowest value kept
+    
+    return sigma_k if k.ndim > 0 else float(sigma_k)
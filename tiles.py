@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+#Tiled, multi-resolution copies of the stitched micrographs.
+#A stitched image can weigh several gigapixels: opening it with PIL decodes the whole
+#file before any crop. Each image is therefore converted once, when imported, into
+#data/<name>.tiles.h5, holding the image in tiles of 256 x 256 pixels (compressed
+#HDF5 chunks) at full resolution (level 0) and at resolutions divided by 2, 4, 8...
+#A crop then only decodes the tiles it overlaps, and previews of large zones are
+#read from the coarser levels.
+
+#Commonly used libraries
+import numpy as np
+import os
+import atexit
+import tables
+
+tile_size = 256         #Side of the tiles (pixels)
+preview_size = 1024     #Coarsest level: largest side below this size (pixels)
+
+#Images opened in the session, by path of the tiles file
+_images = {}
+
+
+def tiles_path(image_file):
+    """
+    Returns the path of the tiled copy of an image, ex. data/809BH.tiles.h5 for data/809BH.jpg
+    """
+    return os.path.splitext(image_file)[0] + '.tiles.h5'
+
+
+def _stamp(image_file):
+    #Fingerprint of the source image, to detect that the tiles are out of date
+    st = os.stat(image_file)
+    return '{:d}:{:d}'.format(st.st_mtime_ns, st.st_size)
+
+
+def _up_to_date(image_file):
+    #TRUE if the tiles exist and were made from the current version of the image
+    path = tiles_path(image_file)
+    if not os.path.exists(path):
+        return False
+    if not os.path.exists(image_file):
+        return True     #The original image was removed, the tiles are all there is
+    with tables.open_file(path, 'r') as h5:
+        return getattr(h5.root._v_attrs, 'source_stamp', None) == _stamp(image_file)
+
+
+def build_tiles(image_file, overwrite = False):
+    """
+    Converts an image to tiles at several resolutions. The image is decoded once,
+    and written strip by strip. The coarser levels are computed from the finer ones
+    by averaging blocks of 2 x 2 pixels.
+
+    Parameters
+    ----------
+    image_file: Path of the image (.jpg, .png, .tif...)
+    overwrite:  If FALSE, nothing is done if the tiles are up to date
+
+    Returns
+    -------
+    path:       Path of the tiles file
+
+    """
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = None
+
+    path = tiles_path(image_file)
+    if overwrite == False and _up_to_date(image_file):
+        return path
+    close_image(image_file)
+
+    im = Image.open(image_file)
+    if im.mode not in ['L', 'RGB']:
+        im = im.convert('RGB')
+    width, height = im.size
+    channels = () if im.mode == 'L' else (3,)
+    filters = tables.Filters(complevel = 5, complib = 'blosc')
+
+    with tables.open_file(path + '.tmp', 'w') as h5:
+        h5.root._v_attrs.mode = im.mode
+        h5.root._v_attrs.width = width
+        h5.root._v_attrs.height = height
+
+        #Full resolution
+        level = h5.create_carray('/', 'level0', tables.UInt8Atom(), shape = (height, width) + channels,
+                                 chunkshape = (tile_size, tile_size) + channels, filters = filters)
+        for y in range(0, height, tile_size):
+            level[y:y+tile_size] = np.asarray(im.crop((0, y, width, min(y+tile_size, height))))
+        im.close()
+
+        #Reduced resolutions
+        n = 0
+        while max(level.shape[:2]) > preview_size:
+            h, w = level.shape[:2]
+            n += 1
+            coarse = h5.create_carray('/', 'level{:d}'.format(n), tables.UInt8Atom(),
+                                      shape = ((h + 1)//2, (w + 1)//2) + channels,
+                                      chunkshape = (tile_size, tile_size) + channels, filters = filters)
+            for y in range(0, h, 2*tile_size):
+                strip = level[y:y+2*tile_size].astype(np.uint16)
+                if strip.shape[0] % 2 == 1:
+                    strip = np.concatenate([strip, strip[-1:]], axis=0)
+                if strip.shape[1] % 2 == 1:
+                    strip = np.concatenate([strip, strip[:, -1:]], axis=1)
+                strip = (strip[0::2, 0::2] + strip[1::2, 0::2] + strip[0::2, 1::2] + strip[1::2, 1::2] + 2)//4
+                coarse[y//2:y//2+strip.shape[0]] = strip.astype(np.uint8)
+            level = coarse
+
+        h5.root._v_attrs.levels = n + 1
+        h5.root._v_attrs.source_stamp = _stamp(image_file)
+
+    os.replace(path + '.tmp', path)
+    return path
+
+
+class TiledImage:
+    """
+    Image stored in tiles (see build_tiles). Use open_image() to get one.
+    crop() behaves like the crop() method of PIL images.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.h5 = tables.open_file(path, 'r')
+        attrs = self.h5.root._v_attrs
+        self.mode = attrs.mode
+        self.size = (int(attrs.width), int(attrs.height))
+        self.levels = [self.h5.get_node('/level{:d}'.format(n)) for n in range(int(attrs.levels))]
+
+    def read(self, box, level = 0):
+        """
+        Returns the pixels of a rectangular zone as an array. Only the tiles overlapping
+        the zone are read. Pixels outside of the image are black, as with PIL.
+
+        Parameters
+        ----------
+        box:    (left, upper, right, lower) at full resolution (pixels), as in PIL
+        level:  Level of resolution, 0 for full resolution, n for a resolution divided by 2^n
+
+        Returns
+        -------
+        pixels: Array of shape (height, width) or (height, width, 3), in uint8
+
+        """
+        #Rounding as in PIL
+        x0, y0, x1, y1 = [int(round(float(v)/2**level)) for v in box]
+        if x1 < x0 or y1 < y0:
+            raise ValueError('Invalid box')
+        array = self.levels[level]
+        h, w = array.shape[:2]
+
+        pixels = np.zeros((y1 - y0, x1 - x0) + array.shape[2:], dtype=np.uint8)
+        xa, xb = max(x0, 0), min(x1, w)
+        ya, yb = max(y0, 0), min(y1, h)
+        if xa < xb and ya < yb:
+            pixels[ya-y0:yb-y0, xa-x0:xb-x0] = array[ya:yb, xa:xb]
+        return pixels
+
+    def crop(self, box):
+        """
+        Returns a rectangular zone at full resolution as a PIL image, like PIL's Image.crop().
+
+        Parameters
+        ----------
+        box:    (left, upper, right, lower) (pixels)
+
+        Returns
+        -------
+        im:     PIL image
+
+        """
+        from PIL import Image
+        return Image.fromarray(self.read(box))
+
+    def preview(self, box = None, max_size = preview_size):
+        """
+        Returns a view of a zone, or of the whole image, reduced so its largest side is
+        at most max_size. It is read at the coarsest level that keeps enough details.
+
+        Parameters
+        ----------
+        box:        (left, upper, right, lower) at full resolution (pixels). Default: whole image.
+        max_size:   Largest side of the view (pixels)
+
+        Returns
+        -------
+        im:         PIL image
+
+        """
+        from PIL import Image
+        if box is None:
+            box = (0, 0) + self.size
+        side = max(box[2] - box[0], box[3] - box[1])
+
+        level = 0
+        while level + 1 < len(self.levels) and side/2**(level + 1) >= max_size:
+            level += 1
+        im = Image.fromarray(self.read(box, level))
+        im.thumbnail((max_size, max_size))
+        return im
+
+    def close(self):
+        self.h5.close()
+        _images.pop(self.path, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_image(image_file, build = True):
+    """
+    Returns the tiled copy of an image, converting the image first if needed.
+    The image stays open for the session, so further calls are immediate.
+
+    Parameters
+    ----------
+    image_file: Path of the original image, ex. data/809BH.jpg
+    build:      If FALSE, the tiles are opened read-only as they are, without being checked
+                or converted (ex. in worker processes, once the tiles were prepared)
+
+    Returns
+    -------
+    im:         TiledImage
+
+    """
+    path = tiles_path(image_file)
+    if path in _images and _images[path].h5.isopen:
+        return _images[path]
+    if build == True and not _up_to_date(image_file):
+        print('Converting {:s} to tiles (done once)...'.format(image_file))
+        build_tiles(image_file, overwrite = True)
+    _images[path] = TiledImage(path)
+    return _images[path]
+
+
+def close_image(image_file):
+    #Closes the tiled copy of an image if it is open in the session
+    path = tiles_path(image_file)
+    if path in _images:
+        _images[path].close()
+
+
+@atexit.register
+def _close_all():
+    #Closes the images left open at the end of the session
+    for im in list(_images.values()):
+        im.close()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+#Display of the features during the visual identification (see analysis.ID_incl).
+#The crops and predictions of the next features are prepared in a background thread
+#while the user looks at the current one, and shown in a single window updated in place.
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+import threading
+import queue
+import itertools
+
+import database
+import classifier
+from geometry import crop_boxes
+
+
+class Prefetcher:
+    """
+    Prepares, in a background thread, the crops and predictions of the features in the
+    order they will be shown: the order of <features>, or the indexes given by <order>,
+    taken as they are needed (ex. classifier.UncertaintyQueue). Iterating over it returns,
+    for each feature, its index in the data, its crop (PIL image) and the probability
+    that it is an inclusion.
+    Predictions found in the cache of the database are reused; the new ones are saved
+    in the cache by close().
+    Features with a feret diameter of 500 microns or more are not cropped (crop None).
+    """
+
+    def __init__(self, ID_spec, slice, features, im, name = classifier.model_name, ahead = 8, order = None):
+        self.ID_spec = ID_spec
+        self.slice = slice
+        self.features = features
+        self.order = features.index if order is None else order
+        self.im = im
+        self.name = name
+        self.ahead = ahead
+
+        #Predictions already in the cache
+        self.version = classifier.model_version(name)
+        self.boxes = crop_boxes(features)
+        self.keys = classifier.crop_keys(self.boxes)
+        cache = database.get_predictions(ID_spec, slice, self.version)
+        self.cache = dict(zip(zip(cache.incl_nb, cache.crop), cache.p_incl))
+        self.new = {}
+        self.error = None
+
+        self.queue = queue.Queue(maxsize = ahead)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def _put(self, item):
+        #Waits for a place in the queue. Returns FALSE if the prefetcher was stopped.
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        #Crops the features and evaluates the ones not in the cache, by groups of <ahead> features
+        try:
+            order = iter(self.order)
+            while True:
+                rows = [self.features.index.get_loc(index) for index in itertools.islice(order, self.ahead)]
+                if len(rows) == 0:
+                    break
+                crops = [self.im.crop(tuple(self.boxes.iloc[i])) if self.features.feret.iloc[i] < 500 else None for i in rows]
+                p_incl = [self.cache.get((self.features.incl_nb.iloc[i], self.keys[i]), np.nan) for i in rows]
+                todo = [j for j in range(len(rows)) if crops[j] is not None and np.isnan(p_incl[j])]
+                if len(todo) > 0:
+                    for j, p in zip(todo, classifier.predict([crops[j] for j in todo], self.name)):
+                        p_incl[j] = p
+                        self.new[(self.features.incl_nb.iloc[rows[j]], self.keys[rows[j]])] = p
+                
+                for j, i in enumerate(rows):
+                    if self._put((self.features.index[i], crops[j], p_incl[j])) == False:
+                        return
+        except Exception as error:
+            self.error = error
+        self._put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def close(self):
+        """
+        Stops the background thread and saves the new predictions in the cache.
+        """
+        self.stop.set()
+        self.thread.join()
+        if len(self.new) > 0:
+            keys = list(self.new)
+            database.save_predictions(self.ID_spec, self.slice,
+                pd.DataFrame({'incl_nb': [key[0] for key in keys], 'crop': [key[1] for key in keys],
+                                       'model_version': self.version, 'p_incl': list(self.new.values())}))
+
+
+class Viewer:
+    """
+    Window showing the crops of the features, updated in place.
+    """
+
+    def __init__(self):
+        import matplotlib.pyplot as plt
+        self.plt = plt
+        with plt.rc_context({'text.usetex': False}):
+            self.fig, self.ax = plt.subplots(num = 'Features', figsize = (5, 5))
+        self.ax.set_axis_off()
+        self.artist = None
+        plt.ion()
+        plt.show(block = False)
+
+    def show(self, image, title = ''):
+        """
+        Shows a crop (PIL image) in the window, with a title.
+        """
+        pixels = np.asarray(image)
+        height, width = pixels.shape[:2]
+        if self.artist is None:
+            self.artist = self.ax.imshow(pixels, cmap = 'gray')
+        else:
+            self.artist.set_data(pixels)
+        self.artist.set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
+        self.ax.set_xlim(-0.5, width - 0.5)
+        self.ax.set_ylim(height - 0.5, -0.5)
+        self.ax.set_title(title, usetex = False)
+        self.fig.canvas.draw_idle()
+        self.fig.canvas.flush_events()
+
+    def close(self):
+        self.plt.close(self.fig)
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+#Exclusion zones of the slices: parts of the images left out of the analysis (scale bar,
+#bakelite, scratches...). A zone is a rectangle, a polygon or a raster mask. The zones
+#of each slice are stored in the database (see database.get_zones), the features they
+#contain are removed from the data, and the area of their union is subtracted from the
+#area of the image, so overlapping zones are only counted once.
+#The area of the union is exact: the plane is cut in vertical slabs at every vertex and
+#at every crossing of two edges. Within a slab, the length of the union along y varies
+#linearly with x, so its value in the middle of the slab gives the area of the slab.
+
+#Commonly used libraries
+import pandas as pd
+import numpy as np
+import os
+
+import database
+from database import fields_zones, get_meta, get_slice, get_sindex, get_zones, save_slices, save_zones, logger
+
+#Kinds of zones
+kinds = ['rect', 'polygon', 'mask']
+
+
+def rect_zone(xmin, xmax, ymin, ymax):
+    """
+    Returns a rectangular zone.
+
+    Parameters
+    ----------
+    xmin, xmax: Bounds in x (microns)
+    ymin, ymax: Bounds in y (microns)
+
+    Returns
+    -------
+    zone :      Dataframe with the fields kind, x, y (two opposite corners)
+
+    """
+    return pd.DataFrame({'kind': 'rect', 'x': [xmin, xmax], 'y': [ymin, ymax]})
+
+
+def polygon_zone(xs, ys):
+    """
+    Returns a polygonal zone.
+
+    Parameters
+    ----------
+    xs, ys:     Coordinates of the vertices (microns), in order
+
+    Returns
+    -------
+    zone :      Dataframe with the fields kind, x, y (one row per vertex)
+
+    """
+    return pd.DataFrame({'kind': 'polygon', 'x': np.asarray(xs, dtype=float), 'y': np.asarray(ys, dtype=float)})
+
+
+def mask_zone(mask, x0 = 0., y0 = 0., pixel = 1.):
+    """
+    Returns a zone made of the pixels of a mask. The pixels are gathered in rectangles: runs of
+    pixels along the rows, and runs identical in successive rows.
+
+    Parameters
+    ----------
+    mask:       2D array, nonzero on the pixels excluded. Row 0 is at the top (smallest y),
+                as in the micrographs.
+    x0, y0:     Coordinates of the corner of the first pixel (microns)
+    pixel:      Size of the pixels (microns)
+
+    Returns
+    -------
+    zone :      Dataframe with the fields kind, x, y (two opposite corners per rectangle)
+
+    """
+    mask = np.asarray(mask) != 0
+    padded = np.pad(mask, ((0, 0), (1, 1))).astype('int8')
+    change = np.diff(padded, axis=1)
+    rows, c0 = np.nonzero(change == 1)
+    c1 = np.nonzero(change == -1)[1]
+
+    #Runs with the same columns in successive rows make one rectangle
+    order = np.lexsort((rows, c1, c0))
+    rows, c0, c1 = rows[order], c0[order], c1[order]
+    new = np.ones(len(rows), dtype=bool)
+    new[1:] = (c0[1:] != c0[:-1]) | (c1[1:] != c1[:-1]) | (rows[1:] != rows[:-1] + 1)
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(rows)) - 1
+
+    x = np.column_stack([x0 + c0[first]*pixel, x0 + c1[first]*pixel]).ravel()
+    y = np.column_stack([y0 + rows[first]*pixel, y0 + (rows[last] + 1)*pixel]).ravel()
+    return pd.DataFrame({'kind': 'mask', 'x': x, 'y': y})
+
+
+def read_mask(filename, x0 = 0., y0 = 0., pixel = 1.):
+    """
+    Reads a mask from an image file (ex. .png drawn over the micrograph): the dark pixels
+    (below half of the maximum value) are excluded.
+
+    Parameters
+    ----------
+    filename:   Path of the image
+    x0, y0:     Coordinates of the corner of the first pixel (microns)
+    pixel:      Size of the pixels (microns)
+
+    Returns
+    -------
+    zone :      Dataframe with the fields kind, x, y (see mask_zone)
+
+    """
+    from PIL import Image
+
+    with Image.open(filename) as im:
+        pixels = np.asarray(im.convert('L'))
+    return mask_zone(pixels < 128, x0, y0, pixel)
+
+
+def _shapes(zones):
+    #Rectangles (array of xmin, xmax, ymin, ymax) and polygons (list of (xs, ys)) of zones
+    rects = []
+    polygons = []
+    for (zone, kind), df in zones.groupby(['zone', 'kind'], sort = False):
+        x = df.x.values.astype(float)
+        y = df.y.values.astype(float)
+        if kind == 'polygon':
+            polygons.append((x, y))
+        else:
+            x = x.reshape(-1, 2)
+            y = y.reshape(-1, 2)
+            rects.append(np.column_stack([x.min(axis=1), x.max(axis=1), y.min(axis=1), y.max(axis=1)]))
+    rects = np.concatenate(rects) if len(rects) > 0 else np.zeros((0, 4))
+    return rects, polygons
+
+
+def _crossings(x1, y1, x2, y2, u1, v1, u2, v2):
+    #x coordinates of the crossings of the segments (x1, y1)-(x2, y2) with the segments (u1, v1)-(u2, v2)
+    dx, dy = (x2 - x1)[:, None], (y2 - y1)[:, None]
+    du, dv = (u2 - u1)[None, :], (v2 - v1)[None, :]
+    wx, wy = u1[None, :] - x1[:, None], v1[None, :] - y1[:, None]
+    denom = dx*dv - dy*du
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (wx*dv - wy*du)/denom
+        s = (wx*dy - wy*dx)/denom
+        cross = (denom != 0) & (t > 0) & (t < 1) & (s > 0) & (s < 1)
+        return (x1[:, None] + t*dx)[cross]
+
+
+def _union_length(starts, ends):
+    #Length of the union of intervals
+    if len(starts) == 0:
+        return 0.
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    before = np.concatenate([[-np.inf], reach[:-1]])
+    return float(np.sum(np.maximum(ends - np.maximum(starts, before), 0)))
+
+
+def union_area(zones, bounds = None):
+    """
+    Calculates the exact area of the union of zones, optionally within the bounds of the image.
+
+    Parameters
+    ----------
+    zones:      Dataframe with the fields zone, kind, x, y (zones of one slice)
+    bounds:     (xmin, xmax, ymin, ymax) of the image (microns). Default: no bounds.
+
+    Returns
+    -------
+    area :      Area (square microns)
+
+    """
+    if len(zones) == 0:
+        return 0.
+    rects, polygons = _shapes(zones)
+
+    #Edges of the polygons, and the polygon they belong to
+    edges = [np.column_stack([xs, ys, np.roll(xs, -1), np.roll(ys, -1)]) for xs, ys in polygons]
+    edges = np.concatenate(edges) if len(edges) > 0 else np.zeros((0, 4))
+    owner = np.repeat(np.arange(len(polygons)), [len(xs) for xs, ys in polygons])
+
+    #Horizontal edges of the rectangles and of the bounds
+    flats = rects[:, [0, 2, 1, 2]]
+    flats = np.concatenate([flats, rects[:, [0, 3, 1, 3]]])
+    if bounds is not None:
+        flats = np.concatenate([flats, [[bounds[0], bounds[2], bounds[1], bounds[2]], [bounds[0], bounds[3], bounds[1], bounds[3]]]])
+
+    #Slabs: vertices, and crossings of the edges of polygons with all the edges
+    xs = [rects[:, 0], rects[:, 1], edges[:, 0]]
+    others = np.concatenate([edges, flats])
+    if len(edges) > 0:
+        xs.append(_crossings(*edges.T, *others.T))
+    xs = np.unique(np.concatenate(xs))
+    if bounds is not None:
+        xs = np.unique(np.clip(xs, bounds[0], bounds[1]))
+
+    area = 0.
+    for a, b in zip(xs[:-1], xs[1:]):
+        xm = (a + b)/2
+        inside = (rects[:, 0] < xm) & (rects[:, 1] > xm)
+        starts = [rects[inside, 2]]
+        ends = [rects[inside, 3]]
+
+        #Crossings of the edges of each polygon with the vertical line x = xm, paired by the even-odd rule
+        cut = (np.minimum(edges[:, 0], edges[:, 2]) < xm) & (np.maximum(edges[:, 0], edges[:, 2]) > xm)
+        if np.any(cut):
+            x1, y1, x2, y2 = edges[cut].T
+            y = y1 + (xm - x1)*(y2 - y1)/(x2 - x1)
+            order = np.lexsort((y, owner[cut]))
+            y = y[order]
+            starts.append(y[0::2])
+            ends.append(y[1::2])
+
+        starts = np.concatenate(starts)
+        ends = np.concatenate(ends)
+        if bounds is not None:
+            starts = np.maximum(starts, bounds[2])
+            ends = np.minimum(ends, bounds[3])
+        keep = ends > starts
+        area += (b - a)*_union_length(starts[keep], ends[keep])
+
+    return area
+
+
+def contained(zones, sindex):
+    """
+    Finds the features inside zones, from the spatial index of the slice.
+    Features are inside a rectangle if strictly inside, inside a polygon by the even-odd rule.
+
+    Parameters
+    ----------
+    zones:      Dataframe with the fields zone, kind, x, y (zones of one slice)
+    sindex:     Spatial index of the slice (see database.get_sindex)
+
+    Returns
+    -------
+    rows :      Positions of the features in the data of the slice
+
+    """
+    rects, polygons = _shapes(zones)
+    rows = [sindex.rect(*rect) for rect in rects] + [sindex.polygon(xs, ys) for xs, ys in polygons]
+    return np.unique(np.concatenate(rows)) if len(rows) > 0 else np.zeros(0, dtype='int64')
+
+
+def _bounds(row):
+    #Bounds of the image of a slice, for rectangular images. Circular specimens are not bounded.
+    if row.img_width > 0 and row.img_height > 0:
+        return (0., float(row.img_width), 0., float(row.img_height))
+    return None
+
+
+def apply_zones(zones):
+    """
+    Excludes zones from slices, in a single pass for all the slices.
+    The features inside the zones are removed from the data. The area of the image of each
+    slice is reduced by the area the new zones add to the union of its zones (within the
+    image, for rectangular images), so overlapping zones are only subtracted once.
+    The zones are stored in the database with the other zones of the slice.
+    No confirmation is asked to the user.
+
+    Parameters
+    ----------
+    zones:      Dataframe with the fields ID_specimen, slice, kind, x, y, and zone to tell apart
+                the zones of a slice (see read_zones, rect_zone, polygon_zone, mask_zone)
+
+    Returns
+    -------
+    n :         Number of features removed. -1 if nothing was done.
+
+    """
+    zones = zones.copy()
+    zones['slice'] = zones.slice.astype(int)
+    if 'zone' not in zones.columns:
+        zones['zone'] = 0
+    if not zones.kind.isin(kinds).all():
+        print('Unknown kind of zone: {:s}'.format(', '.join(sorted(set(zones.kind) - set(kinds)))))
+        return -1
+
+    return database.locked_update(_exclude, zones)
+
+
+def _exclude(zones):
+    #Excludes the zones (see apply_zones), while holding the lock of the database
+    meta = get_meta()
+    known = meta.set_index(['ID_specimen', 'slice']).index
+    indexes = sorted(set(zip(zones.ID_specimen, zones.slice)))
+    missing = [index for index in indexes if index not in known]
+    if len(missing) > 0:
+        print('Slices not in the database: {:s}'.format(', '.join('{:s} {:d}'.format(*index) for index in missing)))
+        return -1
+
+    old_zones = get_zones(samples = sorted(set(zones.ID_specimen)), slices = sorted(set(zones.slice)))
+    parts = {}
+    new_parts = {}
+    removed = {}
+    lines = []
+    for index in indexes:
+        ID_spec, slice = index
+        old = old_zones.loc[(old_zones.ID_specimen == ID_spec) & (old_zones.slice == slice), fields_zones]
+        new = zones.loc[(zones.ID_specimen == ID_spec) & (zones.slice == slice)].copy()
+        #New zones numbered after the existing ones
+        first = int(old.zone.max()) + 1 if len(old) > 0 else 1
+        new['zone'] = first + pd.factorize(new.zone)[0]
+        both = pd.concat([old, new.loc[:, fields_zones]], ignore_index=True)
+
+        row = meta.loc[(meta.ID_specimen == ID_spec) & (meta.slice == slice)].iloc[0]
+        bounds = _bounds(row)
+        added = union_area(both, bounds) - union_area(old, bounds)
+        meta.loc[(meta.ID_specimen == ID_spec) & (meta.slice == slice), 'img_area_mm2'] -= added/1e6
+
+        df = get_slice(ID_spec, slice)[1]
+        rows = contained(new, get_sindex(ID_spec, slice))
+        parts[index] = df.drop(df.index[rows])
+        new_parts[index] = both
+        removed[index] = len(rows)
+        lines.append('Excluded {:d} zone(s) in sample {:s}, slice {:d}: {:d} features removed, area removed {:.2f} mm2.'\
+                     .format(new.zone.nunique(), ID_spec, slice, len(rows), added/1e6))
+
+    if save_slices(meta, parts) == False:
+        return -1
+    save_zones(new_parts)
+
+    logger(lines)
+    return sum(removed.values())
+
+
+def read_zones(filename):
+    """
+    Reads a file of exclusion zones for any number of slices, to exclude them with apply_zones().
+    The file (.csv) has the columns ID_specimen, slice, zone, kind, x, y: one row per corner of
+    a rectangle (two opposite corners) or per vertex of a polygon, in order, the rows of a zone
+    sharing the same zone number. A mask is given by a single row with kind 'mask', the path of
+    its image in the column file, the coordinates of its first pixel in x, y and the size of its
+    pixels in the column pixel (see read_mask).
+
+    Parameters
+    ----------
+    filename:   Path of the file
+
+    Returns
+    -------
+    zones :     Dataframe with the fields ID_specimen, slice, zone, kind, x, y
+
+    """
+    df = pd.read_csv(filename, dtype={'ID_specimen': str, 'kind': str})
+    dfs = [df.loc[df.kind != 'mask', ['ID_specimen', 'slice', 'zone', 'kind', 'x', 'y']]]
+    for row in df.loc[df.kind == 'mask'].itertuples():
+        pixel = getattr(row, 'pixel', 1.)
+        mask = read_mask(os.path.join(os.path.dirname(filename), row.file), row.x, row.y, 1. if pd.isnull(pixel) else pixel)
+        dfs.append(mask.assign(ID_specimen = row.ID_specimen, slice = row.slice, zone = row.zone))
+
+    zones = pd.concat(dfs, ignore_index=True)
+    return zones.loc[:, ['ID_specimen', 'slice', 'zone', 'kind', 'x', 'y']]
+
+
+def exclude_file(filename):
+    """
+    Excludes all the zones listed in a file (see read_zones), in a single pass.
+
+    Parameters
+    ----------
+    filename:   Path of the file
+
+    Returns
+    -------
+    n :         Number of features removed. -1 if nothing was done.
+
+    """
+    try:
+        zones = read_zones(filename)
+    except (OSError, KeyError, ValueError):
+        print('Error reading zone file')
+        return -1
+    return apply_zones(zones)